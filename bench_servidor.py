@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+"""
+This module contains a load generator and latency benchmark for the relay in
+servidor.py
+
+It starts the relay, connects simulated clients from a pool of processes and
+measures the throughput, the fan-out latency, using the timestamp embedded
+in every payload, and the CPU and memory used by the relay
+
+The drop policy for slow clients is measured by lowering the high water mark
+of the relay until it applies, e.g. with --server-args "--high-water 20000"
+and 10 senders of 5000 messages/s of 4096 bytes
+"""
+
+import json
+import os
+import selectors
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser, Namespace
+from array import array
+from multiprocessing import Pool
+from socket import create_connection
+from typing import Optional
+
+from framing import FrameDecoder, frame
+
+EXIT_OK = 0
+EXIT_ERR = 1
+
+# Bytes of the payload used by the timestamp
+TIMESTAMP_SIZE = 8
+# Seconds given to the clients to connect before the measure starts
+WARMUP = 1.0
+# Seconds the clients keep reading after the senders stop
+DRAIN = 1.0
+# Seconds between samples of the relay memory
+SAMPLE_INTERVAL = 0.2
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Benchmark of the chat relay")
+    parser.add_argument("--port", type=int, default=7500)
+    parser.add_argument(
+        "--clients", type=int, default=50, help="connected clients"
+    )
+    parser.add_argument(
+        "--senders", type=int, default=5, help="clients that send messages"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=100, help="messages/s of each sender"
+    )
+    parser.add_argument(
+        "--size", type=int, default=64, help="bytes of each message"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10, help="seconds sending"
+    )
+    parser.add_argument(
+        "--processes", type=int, default=os.cpu_count(),
+        help="processes running the clients"
+    )
+    parser.add_argument(
+        "--server-args", default="",
+        help="extra arguments for servidor.py, e.g. \"--workers 4\""
+    )
+    parser.add_argument(
+        "--output", default="bench_servidor.json", help="results file"
+    )
+    parser.add_argument(
+        "--compare", help="results of a previous run to compare with"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=0.1,
+        help="relative change considered a regression"
+    )
+    return parser.parse_args()
+
+
+def run_clients(
+        port: int,
+        clients: int,
+        senders: int,
+        rate: float,
+        size: int,
+        start: float,
+        duration: float
+) -> tuple[int, int, int, array]:
+    """
+    Runs a group of clients in this process, returns the messages sent and
+    received, the flagged frames received and the latencies in microseconds
+    """
+    sel = selectors.DefaultSelector()
+    conns = []
+    for i in range(clients):
+        conn = create_connection(('127.0.0.1', port))
+        conn.setblocking(False)
+        conns.append(conn)
+        sel.register(conn, selectors.EVENT_READ, FrameDecoder())
+    sending = conns[:senders]
+    # The rest of the last message of a sender that its socket didn't take,
+    # it is written once the socket is writable
+    unsent = {}
+
+    def drop(conn):
+        """
+        Forgets a connection the relay closed
+        """
+        sel.unregister(conn)
+        unsent.pop(conn, None)
+        if conn in sending:
+            sending.remove(conn)
+
+    def write(conn, data: memoryview) -> bool:
+        """
+        Sends as much of the data as the socket takes without blocking and
+        keeps the rest, the socket is watched for writing meanwhile, returns
+        False if the connection was closed
+        """
+        try:
+            data = data[conn.send(data):]
+        except BlockingIOError:
+            pass
+        except OSError:
+            drop(conn)
+            return False
+        key = sel.get_key(conn)
+        events = selectors.EVENT_READ
+        if data:
+            unsent[conn] = data
+            events |= selectors.EVENT_WRITE
+        if events != key.events:
+            sel.modify(conn, events, key.data)
+        return True
+
+    padding = b'x' * max(0, size - TIMESTAMP_SIZE)
+    interval = 1 / rate if rate > 0 else duration
+    sent = 0
+    received = 0
+    flagged = 0
+    latencies = array('Q')
+
+    # Wait for every process to be connected
+    time.sleep(max(0, start - time.time()))
+    next_send = time.monotonic()
+    end = next_send + duration
+    stop = end + DRAIN
+
+    while True:
+        now = time.monotonic()
+        if now >= stop:
+            break
+
+        if now < end and now >= next_send:
+            for conn in list(sending):
+                if conn in unsent:
+                    # The relay is not keeping up, skip this message
+                    continue
+                stamp = time.time_ns().to_bytes(TIMESTAMP_SIZE, 'big')
+                if write(conn, memoryview(frame(stamp + padding))):
+                    sent += 1
+            next_send += interval
+
+        timeout = (next_send if now < end else stop) - time.monotonic()
+        for key, events in sel.select(max(0, timeout)):
+            conn = key.fileobj
+            if events & selectors.EVENT_WRITE:
+                if not write(conn, unsent.pop(conn)) or \
+                        not events & selectors.EVENT_READ:
+                    continue
+            try:
+                data = conn.recv(65536)
+            except BlockingIOError:
+                continue
+            except OSError:
+                data = b''
+            if not data:
+                drop(conn)
+                continue
+
+            arrival = time.time_ns()
+            for codec, msg in key.data.feed_raw(data):
+                if codec:
+                    # The relay tells the channel of the next messages after
+                    # dropping some for a slow client, no message is
+                    # compressed since the clients send no hello
+                    flagged += 1
+                    continue
+                sent_at = int.from_bytes(msg[:TIMESTAMP_SIZE], 'big')
+                latencies.append(max(0, arrival - sent_at) // 1000)
+                received += 1
+
+    for conn in conns:
+        conn.close()
+
+    return sent, received, flagged, latencies
+
+
+class Usage:
+    """
+    Samples the CPU time and memory of the relay and its workers
+    """
+    pid: int
+    max_rss: int
+    start_cpu: float
+    running: bool
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.max_rss = 0
+        self.start_cpu = self.cpu()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def pids(self) -> list[int]:
+        """
+        Returns the pid of the relay and the ones of its workers
+        """
+        pids = [self.pid]
+        try:
+            with open(f"/proc/{self.pid}/task/{self.pid}/children") as f:
+                pids += [int(p) for p in f.read().split()]
+        except OSError:
+            pass
+        return pids
+
+    def cpu(self) -> float:
+        """
+        Returns the CPU seconds used by the relay so far
+        """
+        ticks = 0
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                # utime and stime are the fields 14 and 15 of the file
+                ticks += int(fields[11]) + int(fields[12])
+            except OSError:
+                pass
+        return ticks / os.sysconf('SC_CLK_TCK')
+
+    def rss(self) -> int:
+        """
+        Returns the resident memory of the relay in KiB
+        """
+        total = 0
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            total += int(line.split()[1])
+            except OSError:
+                pass
+        return total
+
+    def sample(self):
+        while self.running:
+            self.max_rss = max(self.max_rss, self.rss())
+            time.sleep(SAMPLE_INTERVAL)
+
+    def stop(self) -> float:
+        """
+        Stops sampling and returns the CPU seconds used since the start
+        """
+        self.running = False
+        self.thread.join()
+        return self.cpu() - self.start_cpu
+
+
+def percentile(ordered: list, p: float) -> Optional[float]:
+    """
+    Returns the given percentile of a sorted list of microseconds in ms
+    """
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] / 1000
+
+
+def split(total: int, parts: int) -> list[int]:
+    """
+    Splits an amount in parts as even as possible
+    """
+    return [total // parts + (i < total % parts) for i in range(parts)]
+
+
+def bench(args: Namespace) -> dict:
+    """
+    Runs the benchmark and returns its results
+    """
+    relay = subprocess.Popen(
+        [sys.executable, "servidor.py", str(args.port)]
+        + args.server_args.split(),
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    # Give the relay time to bind
+    time.sleep(0.5)
+    usage = Usage(relay.pid)
+
+    processes = max(1, min(args.processes, args.clients))
+    clients = split(args.clients, processes)
+    senders = split(min(args.senders, args.clients), processes)
+    start = time.time() + WARMUP
+
+    try:
+        with Pool(processes) as pool:
+            results = pool.starmap(run_clients, [
+                (args.port, c, s, args.rate, args.size, start, args.duration)
+                for c, s in zip(clients, senders)
+            ])
+    finally:
+        cpu = usage.stop()
+        relay.terminate()
+        relay.wait()
+
+    sent = sum(r[0] for r in results)
+    received = sum(r[1] for r in results)
+    flagged = sum(r[2] for r in results)
+    latencies = sorted(lat for r in results for lat in r[3])
+    expected = sent * (args.clients - 1)
+
+    return {
+        "config": {
+            "clients": args.clients,
+            "senders": args.senders,
+            "rate": args.rate,
+            "size": args.size,
+            "duration": args.duration,
+            "server_args": args.server_args,
+        },
+        "sent": sent,
+        "received": received,
+        "delivery_ratio": received / expected if expected else None,
+        "flagged_frames": flagged,
+        "throughput_msgs": received / args.duration,
+        "throughput_bytes": received * args.size / args.duration,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+            "p999": percentile(latencies, 0.999),
+            "max": percentile(latencies, 1),
+        },
+        "cpu_seconds": cpu,
+        "cpu_percent": 100 * cpu / (args.duration + DRAIN + WARMUP),
+        "max_rss_kib": usage.max_rss,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    Returns the metrics that got worse than the baseline by more than the
+    threshold
+    """
+    # Metric path and whether bigger is better
+    metrics = [
+        (("throughput_msgs",), True),
+        (("delivery_ratio",), True),
+        (("latency_ms", "p50"), False),
+        (("latency_ms", "p99"), False),
+        (("latency_ms", "p999"), False),
+        (("cpu_seconds",), False),
+        (("max_rss_kib",), False),
+    ]
+
+    regressions = []
+    for path, bigger_is_better in metrics:
+        new, old = results, baseline
+        for key in path:
+            new, old = new.get(key), old.get(key)
+        if not new or not old:
+            continue
+
+        change = (new - old) / old
+        if (bigger_is_better and change < -threshold) or \
+                (not bigger_is_better and change > threshold):
+            regressions.append(
+                f"{'.'.join(path)}: {old:.3f} -> {new:.3f} ({change:+.1%})"
+            )
+
+    return regressions
+
+
+def main():
+    args = parse_args()
+    results = bench(args)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != results["config"]:
+            print("[-] The runs used different configurations")
+
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"[x] Regression in {regression}")
+        if regressions:
+            sys.exit(EXIT_ERR)
+        print("[i] No regressions")
+
+    sys.exit(EXIT_OK)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+"""
+This module contains a join throughput benchmark for the bootstrap server in
+servidor_usuarios.py
+
+It starts a cluster of instances sharing the registry for every requested
+size, registers simulated peers from a pool of processes spreading them
+between the instances, and measures the joins per second until every
+instance hands out the whole peer list and the CPU used by each instance
+
+With --check it fails unless the throughput rises with the instances, which
+needs a core for every instance and some more for the simulated peers
+"""
+
+import json
+import os
+import selectors
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from array import array
+from multiprocessing import Event, Process, Queue
+from socket import create_connection
+
+import capnp
+import msgs_capnp
+from framing import FrameDecoder, decode_msg, encode_msg, frame
+
+EXIT_OK = 0
+EXIT_ERR = 1
+
+# Seconds given to the instances to bind and link with each other, the
+# links refused while the others start are retried after 2 seconds
+WARMUP = 3.0
+# Seconds to wait for every instance to know every peer after the joins
+SETTLE_TIMEOUT = 30.0
+# Seconds between checks of the peer list of the instances
+POLL_INTERVAL = 0.05
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Benchmark of the bootstrap server")
+    parser.add_argument("--port", type=int, default=7900)
+    parser.add_argument(
+        "--instances", default="1,2,4",
+        help="comma separated cluster sizes to measure"
+    )
+    parser.add_argument(
+        "--joins", type=int, default=2000, help="peers registered"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=32,
+        help="joins in flight in every process"
+    )
+    parser.add_argument(
+        "--processes", type=int, default=os.cpu_count(),
+        help="processes running the peers"
+    )
+    parser.add_argument(
+        "--server-args", default="",
+        help="extra arguments for servidor_usuarios.py, e.g. "
+             "\"--replicas 3\""
+    )
+    parser.add_argument(
+        "--output", default="bench_usuarios.json", help="results file"
+    )
+    parser.add_argument(
+        "--check", action="store_true",
+        help="fail if the throughput doesn't rise with the instances"
+    )
+    return parser.parse_args()
+
+
+def run_joins(
+        ports: list[int],
+        first_port: int,
+        joins: int,
+        concurrency: int,
+        start: float,
+        results: Queue,
+        done: Event
+):
+    """
+    Registers peers in this process spreading them between the instances,
+    puts in the queue the latencies from connecting to receiving the peer
+    list in microseconds, the peers stay registered until the event is set
+    """
+    sel = selectors.DefaultSelector()
+    latencies = array('Q')
+    in_flight = 0
+    started = 0
+
+    time.sleep(max(0, start - time.time()))
+
+    reported = False
+    while not done.is_set():
+        if not reported and started == joins and not in_flight:
+            results.put(latencies)
+            reported = True
+
+        while started < joins and in_flight < concurrency:
+            port_msg = msgs_capnp.PeerListeningPort.new_message()
+            # Every simulated peer listens on a different port, it is its id
+            port_msg.port = first_port + started
+            began = time.perf_counter_ns()
+            conn = create_connection(
+                ('127.0.0.1', ports[(first_port + started) % len(ports)])
+            )
+            conn.sendall(frame(encode_msg(port_msg)))
+            conn.setblocking(False)
+            sel.register(conn, selectors.EVENT_READ, [FrameDecoder(), began])
+            started += 1
+            in_flight += 1
+
+        for key, _ in sel.select(POLL_INTERVAL):
+            try:
+                data = key.fileobj.recv(65536)
+            except BlockingIOError:
+                continue
+            if not data:
+                sel.unregister(key.fileobj)
+                continue
+            decoder, began = key.data
+            if began is not None and decoder.feed(data):
+                # The peer list arrived, from now on only the changes do
+                latencies.append((time.perf_counter_ns() - began) // 1000)
+                key.data[1] = None
+                in_flight -= 1
+
+    for key in list(sel.get_map().values()):
+        key.fileobj.close()
+
+
+def known_peers(port: int) -> int:
+    """
+    Returns the length of the peer list an instance hands out
+    """
+    conn = create_connection(('127.0.0.1', port))
+    decoder = FrameDecoder()
+    msgs = []
+    while not msgs:
+        data = conn.recv(1 << 20)
+        if not data:
+            return 0
+        msgs = decoder.feed(data)
+    conn.close()
+    return len(decode_msg(msgs_capnp.ServerRpcMsg, msgs[0]).addrs)
+
+
+def cpu_seconds(pid: int) -> float:
+    """
+    Returns the CPU seconds used by a process so far
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return 0.0
+    # utime and stime are the fields 14 and 15 of the file
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def split(total: int, parts: int) -> list[int]:
+    """
+    Splits an amount in parts as even as possible
+    """
+    return [total // parts + (i < total % parts) for i in range(parts)]
+
+
+def bench(args: Namespace, instances: int) -> dict:
+    """
+    Runs the benchmark against a cluster of the given size
+    """
+    ports = [args.port + i for i in range(instances)]
+    cluster = ",".join(f"127.0.0.1:{port}" for port in ports)
+    servers = [
+        subprocess.Popen(
+            [sys.executable, "servidor_usuarios.py", str(port),
+             "--cluster", cluster] + args.server_args.split(),
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        for port in ports
+    ]
+    time.sleep(WARMUP)
+
+    processes = max(1, min(args.processes, args.joins))
+    joins = split(args.joins, processes)
+    # The ids of the simulated peers, their ports, never overlap
+    firsts = [1 + sum(joins[:i]) for i in range(processes)]
+    start = time.time() + 0.5
+
+    results = Queue()
+    done = Event()
+    workers = [
+        Process(target=run_joins, args=(
+            ports, first, j, args.concurrency, start, results, done
+        ))
+        for first, j in zip(firsts, joins)
+    ]
+    for worker in workers:
+        worker.start()
+
+    try:
+        # The joins are done once every instance knows every peer
+        settled = None
+        time.sleep(max(0, start - time.time()))
+        while time.time() - start < SETTLE_TIMEOUT:
+            counts = [known_peers(port) for port in ports]
+            if all(count >= args.joins for count in counts):
+                settled = time.time() - start
+                break
+            time.sleep(POLL_INTERVAL)
+
+        latencies = sorted(
+            lat for _ in workers for lat in results.get(timeout=SETTLE_TIMEOUT)
+        )
+    finally:
+        cpu = [cpu_seconds(server.pid) for server in servers]
+        done.set()
+        for worker in workers:
+            worker.join()
+        for server in servers:
+            server.terminate()
+        for server in servers:
+            server.wait()
+
+    def percentile(p: float) -> float:
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] \
+            / 1000
+
+    return {
+        "instances": instances,
+        "joins": args.joins,
+        "seconds": settled,
+        "joins_per_second": args.joins / settled if settled else None,
+        "known_peers": counts,
+        "cpu_seconds": cpu,
+        "latency_ms": {
+            "p50": percentile(0.5),
+            "p99": percentile(0.99),
+            "max": percentile(1),
+        },
+    }
+
+
+def check(runs: list[dict]) -> list[str]:
+    """
+    Returns the cluster sizes whose throughput isn't above the one of the
+    next smaller size
+    """
+    failures = []
+    ordered = sorted(runs, key=lambda run: run["instances"])
+    for smaller, bigger in zip(ordered, ordered[1:]):
+        old = smaller["joins_per_second"]
+        new = bigger["joins_per_second"]
+        if not new:
+            failures.append(f"{bigger['instances']} instances didn't settle")
+        elif old and new <= old:
+            failures.append(
+                f"{bigger['instances']} instances: {new:.0f} joins/s, not "
+                f"above the {old:.0f} joins/s of {smaller['instances']}"
+            )
+    return failures
+
+
+def main():
+    args = parse_args()
+    if args.joins + 1 > 0xffff:
+        print(f"At most {0xffff - 1} joins, every peer needs its own port")
+        sys.exit(EXIT_ERR)
+
+    runs = []
+    for instances in [int(n) for n in args.instances.split(",")]:
+        run = bench(args, instances)
+        runs.append(run)
+        rate = run["joins_per_second"]
+        print(
+            f"[i] {instances} instances: "
+            + (f"{rate:.0f} joins/s" if rate else "didn't settle")
+            + f", latency p50 {run['latency_ms']['p50']:.2f}ms"
+            f" p99 {run['latency_ms']['p99']:.2f}ms"
+            f", CPU of the busiest instance {max(run['cpu_seconds']):.2f}s"
+        )
+
+    with open(args.output, 'w') as f:
+        json.dump({"config": vars(args), "runs": runs}, f, indent=2)
+
+    if args.check:
+        failures = check(runs)
+        for failure in failures:
+            print(f"[x] The throughput doesn't scale, {failure}")
+        if failures:
+            sys.exit(EXIT_ERR)
+        print("[i] The throughput rises with the instances")
+
+    sys.exit(EXIT_OK)
+
+
+if __name__ == "__main__":
+    main()
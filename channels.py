@@ -0,0 +1,68 @@
+"""
+This module contains the channels of the relay, clients subscribe to named
+topics and every message is only delivered to the subscribers of the topic it
+was published on
+
+Channel operations travel as frames flagged in the top byte of the header, as
+the codec of a message does, their payload is the name of the channel
+"""
+
+from typing import Generic, Iterable, TypeVar
+
+# Frame flags, a client sends them to the relay to subscribe, unsubscribe and
+# to choose where its next messages are published, the relay sends a TOPIC
+# frame before messages of a different topic than the previous ones
+JOIN = 0xfe
+LEAVE = 0xfd
+TOPIC = 0xfc
+
+# Channel every client is subscribed to and publishes on when it connects, so
+# clients that know nothing about channels see each other as before
+DEFAULT = ""
+
+# Longest channel name accepted, in bytes
+MAX_NAME = 64
+
+T = TypeVar('T')
+
+
+def parse_name(payload: bytes) -> str:
+    """
+    Returns the channel name carried by a frame, raises ValueError if it is
+    not valid
+    """
+    if len(payload) > MAX_NAME:
+        raise ValueError(f"channel name of {len(payload)} bytes is too long")
+    try:
+        return payload.decode()
+    except UnicodeDecodeError:
+        raise ValueError("channel name is not valid UTF-8")
+
+
+class Topics(Generic[T]):
+    """
+    Index from every topic to its subscribers, publishing only looks at the
+    subscribers of the topic and not at every client
+    """
+    subscribers: dict[str, set[T]]
+
+    def __init__(self):
+        self.subscribers = {}
+
+    def __len__(self) -> int:
+        return len(self.subscribers)
+
+    def get(self, topic: str) -> Iterable[T]:
+        return self.subscribers.get(topic, ())
+
+    def subscribe(self, topic: str, subscriber: T):
+        self.subscribers.setdefault(topic, set()).add(subscriber)
+
+    def unsubscribe(self, topic: str, subscriber: T):
+        subscribers = self.subscribers.get(topic)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        # Topics are created by their first subscriber, forget the empty ones
+        if not subscribers:
+            del self.subscribers[topic]
@@ -0,0 +1,177 @@
+"""
+This module contains the on disk store of the file chunks received by a peer,
+chunks are addressed by their hash so a file that was already received, even
+partially or as part of another file, doesn't have to be sent again
+
+The disk access runs on the workers, the index lives on the event loop
+"""
+
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import workers
+
+# Bytes of the BLAKE2b digest that identifies a chunk
+HASH_SIZE = 16
+
+
+def chunk_hash(data: bytes) -> bytes:
+    """
+    Returns the hash that identifies a chunk
+    """
+    return hashlib.blake2b(data, digest_size=HASH_SIZE).digest()
+
+
+class ChunkStore:
+    """
+    A directory with a file per chunk, the least recently used chunks are
+    evicted once their total size goes over the limit
+    """
+    path: str
+    limit: int
+    sizes: OrderedDict
+    total: int
+    writing: set[bytes]
+    pending: int
+    pins: dict[bytes, int]
+    doomed: set[bytes]
+
+    def __init__(self, path: str, limit: int):
+        self.path = path
+        self.limit = limit
+        # Size of every stored chunk by its hash, in least recently used
+        # order
+        self.sizes = OrderedDict()
+        self.total = 0
+        self.writing = set()
+        # Bytes waiting to be written by the workers
+        self.pending = 0
+        # Reads queued on the workers by the hash of their chunk and the
+        # evicted chunks that are removed once they are read
+        self.pins = {}
+        self.doomed = set()
+
+        os.makedirs(path, exist_ok=True)
+        # The modification time of the files keeps the order between runs
+        entries = []
+        for entry in os.scandir(path):
+            try:
+                digest = bytes.fromhex(entry.name)
+                stat = entry.stat()
+            except (ValueError, OSError):
+                continue
+            if len(digest) == HASH_SIZE:
+                entries.append((stat.st_mtime, digest, stat.st_size))
+        for _, digest, size in sorted(entries):
+            self.sizes[digest] = size
+            self.total += size
+        self.evict()
+
+    def __contains__(self, digest: bytes) -> bool:
+        return digest in self.sizes
+
+    def chunk_path(self, digest: bytes) -> str:
+        return os.path.join(self.path, digest.hex())
+
+    def reader(self, digest: bytes) -> Callable[[], bytes]:
+        """
+        Marks a stored chunk as used and returns the function that reads it,
+        to be run on a worker, it raises ValueError if the chunk is corrupted
+
+        The chunk isn't removed from the disk until release is called
+        """
+        self.sizes.move_to_end(digest)
+        self.pins[digest] = self.pins.get(digest, 0) + 1
+        path = self.chunk_path(digest)
+
+        def read() -> bytes:
+            with open(path, 'rb') as f:
+                data = f.read()
+            if chunk_hash(data) != digest:
+                raise ValueError(f"corrupted chunk {digest.hex()}")
+            os.utime(path)
+            return data
+
+        return read
+
+    def release(self, digest: bytes):
+        """
+        Tells that a read returned by reader is over
+        """
+        count = self.pins.pop(digest) - 1
+        if count:
+            self.pins[digest] = count
+        elif digest in self.doomed:
+            self.doomed.discard(digest)
+            self.unlink(digest)
+
+    def forget(self, digest: bytes):
+        """
+        Drops a chunk that couldn't be read from the index
+        """
+        size = self.sizes.pop(digest, None)
+        if size is not None:
+            self.total -= size
+
+    def put(self, digest: bytes, data: bytes):
+        """
+        Stores a chunk, it is readable once the workers write it
+        """
+        if digest in self.sizes:
+            self.sizes.move_to_end(digest)
+            return
+        if digest in self.doomed:
+            # It was evicted but it is still on the disk
+            self.doomed.discard(digest)
+            self.sizes[digest] = len(data)
+            self.total += len(data)
+            self.evict()
+            return
+        if digest in self.writing or len(data) > self.limit:
+            return
+        self.writing.add(digest)
+        self.pending += len(data)
+
+        def write():
+            # Write it under another name so a half written chunk is never
+            # read
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".part")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, self.chunk_path(digest))
+            except OSError:
+                os.unlink(tmp_path)
+                raise
+
+        def written(_, error: Optional[BaseException]):
+            self.writing.discard(digest)
+            self.pending -= len(data)
+            if error is not None:
+                print(f"[x] Error while storing a chunk: {error}")
+                return
+            self.sizes[digest] = len(data)
+            self.total += len(data)
+            self.evict()
+
+        workers.run(write, written)
+
+    def evict(self):
+        """
+        Removes the least recently used chunks until the store fits its limit,
+        the ones being read are removed once their reads are over
+        """
+        while self.total > self.limit:
+            digest, size = self.sizes.popitem(last=False)
+            self.total -= size
+            if digest in self.pins:
+                self.doomed.add(digest)
+            else:
+                self.unlink(digest)
+
+    def unlink(self, digest: bytes):
+        path = self.chunk_path(digest)
+        workers.run(lambda: os.unlink(path))
@@ -1,25 +1,380 @@
+import atexit
+import json
+import os
+import re
+import time
+from argparse import ArgumentParser, Namespace
+from collections import deque
 from select import select
-from socket import create_connection, socket
-from sys import argv, exit, stdin
+from socket import AF_UNIX, SOCK_STREAM, create_connection, socket
+from sys import exit, stderr, stdin
+from typing import Optional
+
+import channels
+import compression
+import localsock
+import msglog
+from framing import FrameDecoder, frame
+
+# Bytes read from the input of a headless run in a single call
+READ_SIZE = 1 << 16
+# Lines read ahead from the input of a headless run, we stop reading when
+# they are not sent as fast as they are read
+MAX_PENDING = 1 << 16
+# Default seconds a headless run keeps receiving after sending everything
+DEFAULT_LINGER = 1.0
+
+# The send time headless runs can put in front of their messages, in
+# nanoseconds since the epoch, to measure the lag of the receivers
+STAMP = re.compile(rb"@(\d+) ")
+
+# Commands that are handled by the client instead of being sent
+COMMANDS = ("/join", "/leave", "/channel")
+
+# Seconds between saves of the offset to resume from
+SAVE_INTERVAL = 1.0
+
+
+class Channels:
+    """
+    The channel our messages are published on and the one the messages being
+    received belong to
+    """
+    publish: str
+    receive: str
+    joined: set[str]
+
+    def __init__(self):
+        self.publish = channels.DEFAULT
+        self.receive = channels.DEFAULT
+        # The channels joined besides the default one
+        self.joined = set()
+
+
+class Resume:
+    """
+    The offset of the relay log the client would resume from, the channels
+    it joined and the id the relay knows its messages by, kept in a file to
+    get the messages sent while it was away the next time it connects
+    """
+    path: str
+    topics: Channels
+    offset: int
+    client_id: int
+    saved_at: float
+    answered: bool
+
+    def __init__(self, path: str, topics: Channels):
+        self.path = path
+        self.topics = topics
+        self.offset = msglog.LATEST
+        self.client_id = int.from_bytes(os.urandom(8), byteorder='big') or 1
+        self.saved_at = time.monotonic()
+        # Whether the server answered with the offset it resumes from, the
+        # messages that arrive before are sent again after it
+        self.answered = False
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            self.offset = int(saved["offset"])
+            topics.joined.update(saved["channels"])
+            # Files saved before the ids existed get a new one
+            self.client_id = int(saved.get("client", self.client_id))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Ignoring the offset file {path}: {e}", file=stderr)
+
+    def frames(self) -> bytes:
+        """
+        Returns the frames that join the channels again and ask for the
+        messages from the offset
+        """
+        frames = [
+            frame(name.encode(), channels.JOIN)
+            for name in sorted(self.topics.joined)
+        ]
+        frames.append(frame(
+            msglog.encode_resume(self.offset, self.client_id), msglog.RESUME
+        ))
+        return b''.join(frames)
+
+    def update(self, offset: int):
+        self.answered = True
+        self.offset = offset
+        if time.monotonic() - self.saved_at >= SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        """
+        Writes the offset and the channels, replacing the file at once
+        """
+        self.saved_at = time.monotonic()
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump({
+                    "offset": self.offset,
+                    "channels": sorted(self.topics.joined),
+                    "client": self.client_id
+                }, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Failed to save the offset {e}", file=stderr)
+
+
+class Report:
+    """
+    What a headless run sent and received, the lag is measured on the
+    messages received with a send time
+    """
+    sent: int
+    sent_bytes: int
+    first_send: Optional[float]
+    last_send: float
+    received: int
+    lags: list[float]
+
+    def __init__(self):
+        self.sent = 0
+        self.sent_bytes = 0
+        self.first_send = None
+        self.last_send = 0.0
+        self.received = 0
+        self.lags = []
+
+    def record_sent(self, amount: int, size: int):
+        now = time.monotonic()
+        if self.first_send is None:
+            self.first_send = now
+        self.last_send = now
+        self.sent += amount
+        self.sent_bytes += size
+
+    def record_received(self, msg: bytes) -> bytes:
+        """
+        Counts a received message, returns it without its send time
+        """
+        self.received += 1
+        match = STAMP.match(msg)
+        if match is None:
+            return msg
+        self.lags.append((time.time_ns() - int(match.group(1))) / 1e6)
+        return msg[match.end():]
+
+    def __repr__(self):
+        elapsed = self.last_send - (self.first_send or self.last_send)
+        lines = [f"Sent {self.sent} messages, {self.sent_bytes} bytes"]
+        if elapsed > 0:
+            lines.append(
+                f"Send rate {self.sent / elapsed:.1f} msgs/s, "
+                f"{self.sent_bytes / elapsed / 1024:.1f} KiB/s"
+            )
+        lines.append(f"Received {self.received} messages")
+        if self.lags:
+            ordered = sorted(self.lags)
+            last = len(ordered) - 1
+            lines.append(
+                f"Receive lag p50 {ordered[round(last * 0.5)]:.2f}ms"
+                f" p99 {ordered[round(last * 0.99)]:.2f}ms"
+                f" max {ordered[last]:.2f}ms"
+            )
+        return "\n".join(lines)
+
+
+class Feeder:
+    """
+    Reads the messages of a headless run in big chunks and hands them out
+    once they are due, at a fixed rate or at the pace they were recorded
+    """
+    fd: int
+    buff: bytes
+    lines: deque
+    eof: bool
+    rate: float
+    replay: bool
+    speed: float
+    start: float
+    first_time: Optional[float]
+    handed: int
+
+    def __init__(self, fd: int, rate: float, replay: bool, speed: float):
+        self.fd = fd
+        self.buff = b''
+        self.lines = deque()
+        self.eof = False
+        # Messages per second, 0 sends them as fast as they are read
+        self.rate = rate
+        # Whether every line starts by the second it was sent at, the
+        # messages are sent with the same gaps divided by the speed
+        self.replay = replay
+        self.speed = speed
+        self.start = time.monotonic()
+        self.first_time = None
+        self.handed = 0
+
+    def wants_input(self) -> bool:
+        return not self.eof and len(self.lines) < MAX_PENDING
+
+    def read(self):
+        """
+        Reads whatever the input has, without waiting for whole lines
+        """
+        data = os.read(self.fd, READ_SIZE)
+        if not data:
+            self.eof = True
+            # The last line may have no line break
+            data = b'\n'
+        lines = (self.buff + data).split(b'\n')
+        self.buff = lines.pop()
+        self.lines.extend(
+            line.rstrip(b'\r') for line in lines if line.strip()
+        )
+
+    def due_at(self, line: bytes) -> float:
+        """
+        Returns when a line has to be sent, raises ValueError if it is
+        replayed and doesn't start by its time
+        """
+        if self.replay:
+            recorded = float(line.split(maxsplit=1)[0])
+            if self.first_time is None:
+                self.first_time = recorded
+            return self.start + (recorded - self.first_time) / self.speed
+        if self.rate > 0:
+            return self.start + self.handed / self.rate
+        return self.start
+
+    def due(self) -> list[str]:
+        """
+        Removes and returns the messages whose time to be sent passed
+        """
+        now = time.monotonic()
+        ready = []
+        while self.lines:
+            line = self.lines[0]
+            try:
+                if self.due_at(line) > now:
+                    break
+            except ValueError:
+                print(f"Skipped a line without a time: {line[:40]!r}",
+                      file=stderr)
+                self.lines.popleft()
+                continue
+            self.lines.popleft()
+            if self.replay:
+                # Drop the time, the rest of the line is the message
+                parts = line.split(maxsplit=1)
+                line = parts[1] if len(parts) > 1 else b''
+            ready.append(line.decode(errors="replace"))
+            self.handed += 1
+        return ready
+
+    def timeout(self) -> Optional[float]:
+        """
+        Returns the seconds until the next message is due, None if we are
+        waiting for the input
+        """
+        if not self.lines:
+            return None
+        try:
+            return max(0.0, self.due_at(self.lines[0]) - time.monotonic())
+        except ValueError:
+            return 0.0
+
+    def done(self) -> bool:
+        return self.eof and not self.lines
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Client of the chat relay")
+    parser.add_argument("address", help="address of the relay")
+    parser.add_argument("port", type=int, help="port of the relay")
+    parser.add_argument(
+        "--input",
+        help="run without interaction sending the lines of this file, - "
+             "reads them from stdin"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="messages per second sent from the input, 0 sends them as fast "
+             "as possible"
+    )
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="every input line starts by the second it was sent at, they are "
+             "sent keeping the same gaps"
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="how many times faster the input is replayed"
+    )
+    parser.add_argument(
+        "--stamp",
+        action="store_true",
+        help="put the send time in front of the messages so the headless "
+             "receivers can measure their lag"
+    )
+    parser.add_argument(
+        "--linger",
+        type=float,
+        default=DEFAULT_LINGER,
+        help="seconds to keep receiving after sending the whole input"
+    )
+    parser.add_argument(
+        "--offset-file",
+        help="keep here the offset and channels to resume from, the relay "
+             "sends the messages missed since if it keeps a log"
+    )
+    parser.add_argument(
+        "--unix",
+        help="unix socket of the relay, by default it is used if the relay "
+             "runs on this host and listens on one"
+    )
+    parser.add_argument(
+        "--tcp",
+        action="store_true",
+        help="connect through TCP even if the relay listens on a unix socket"
+    )
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="don't print the received messages"
+    )
+    return parser.parse_args()
 
 
 def main():
-    # Parse arguments
-    if len(argv) != 3:
-        print(f"Usage\n\t{argv[0]} <address> <port>")
+    args = parse_args()
+    if args.speed <= 0:
+        print(f"Invalid speed {args.speed}")
         exit(1)
 
-    try:
-        # Parse arguments into server address
-        server_address = (argv[1], int(argv[2]))
-        # Try to connect to the server
-        conn = create_connection(server_address)
-    except ValueError as e:
-        print(f"Error while trying to parse arguments {e}")
-        exit(1)
-    except OSError as e:
-        print(f"Failed to connect to server {e}")
-        exit(1)
+    conn = connect(args)
+
+    decoder = FrameDecoder()
+    # Codecs the server accepts, we send plain text until it answers
+    codecs: set[int] = set()
+    topics = Channels()
+
+    # Tell the server which codecs we can decompress
+    conn.sendall(frame(bytes(compression.CODECS), compression.HELLO))
+
+    # Ask for what we missed since the last time
+    resume = None
+    if args.offset_file is not None:
+        resume = Resume(args.offset_file, topics)
+        conn.sendall(resume.frames())
+        atexit.register(resume.save)
+
+    if args.input is not None:
+        run_headless(conn, decoder, codecs, topics, args, resume)
+        return
 
     fd_map = {
         conn.fileno(): conn,
@@ -33,32 +388,216 @@ def main():
         for fd in l:
             if fd == stdin.fileno():
                 # If the descriptor is stdin, then we need to send a msg
-                handle_stdin(conn)
+                handle_stdin(conn, codecs, topics)
             elif fd == conn.fileno():
                 # If the descriptor is the server, then we received a msg
-                handle_server(conn)
+                handle_server(
+                    conn, decoder, codecs, topics, resume=resume
+                )
+
+
+def connect(args: Namespace) -> socket:
+    """
+    Connects to the server, through its unix socket if it runs on this host
+    and listens on one, through TCP otherwise
+    """
+    path = args.unix or localsock.default_path("relay", args.port)
+    if not args.tcp and os.path.exists(path) and (
+            args.unix or localsock.is_local(args.address)
+    ):
+        conn = socket(AF_UNIX, SOCK_STREAM)
+        try:
+            conn.connect(path)
+            return conn
+        except OSError as e:
+            # It may be left behind by a server that is not running anymore
+            print(f"Failed to connect to {path} {e}, using TCP", file=stderr)
+            conn.close()
+
+    try:
+        # Try to connect to the server
+        return create_connection((args.address, args.port))
+    except OSError as e:
+        print(f"Failed to connect to server {e}")
+        exit(1)
 
 
-def handle_stdin(server_conn: socket):
+def run_headless(
+        conn: socket,
+        decoder: FrameDecoder,
+        codecs: set[int],
+        topics: Channels,
+        args: Namespace,
+        resume: Optional[Resume]
+):
+    """
+    Sends the messages of the input without interaction, the messages that
+    are due together go in a single write, and prints what was sent and
+    received once the input ends
+    """
+    try:
+        fd = stdin.fileno() if args.input == "-" else os.open(
+            args.input, os.O_RDONLY
+        )
+    except OSError as e:
+        print(f"Failed to open the input {e}")
+        exit(1)
+
+    feeder = Feeder(fd, args.rate, args.replay, args.speed)
+    report = Report()
+    finished_at = None
+
+    while True:
+        if finished_at is None and feeder.done():
+            finished_at = time.monotonic()
+        if finished_at is not None:
+            timeout = finished_at + args.linger - time.monotonic()
+            if timeout <= 0:
+                break
+        else:
+            timeout = feeder.timeout()
+
+        watched = [conn]
+        if feeder.wants_input():
+            watched.append(fd)
+        l, m, n = select(watched, [], [], timeout)
+
+        if fd in l:
+            feeder.read()
+        if conn in l:
+            handle_server(
+                conn, decoder, codecs, topics, report, args.quiet, resume
+            )
+
+        batch = feeder.due()
+        if batch:
+            send_batch(conn, batch, codecs, topics, report, args.stamp)
+
+    conn.close()
+    print(report, file=stderr)
+
+
+def send_batch(
+        server_conn: socket,
+        batch: list[str],
+        codecs: set[int],
+        topics: Channels,
+        report: Report,
+        stamp: bool
+):
+    """
+    Frames every message of the batch and sends them with a single write
+    """
+    frames = []
+    sent = 0
+    for msg in batch:
+        if msg.split(" ", 1)[0] in COMMANDS:
+            frames.append(channel_frames(msg, topics))
+            continue
+        data = msg.encode()
+        if stamp:
+            data = b"@%d %s" % (time.time_ns(), data)
+        codec, payload = compression.compress_text(data, codecs)
+        frames.append(frame(payload, codec))
+        sent += 1
+
+    data = b''.join(frames)
+    server_conn.sendall(data)
+    report.record_sent(sent, len(data))
+
+
+def handle_stdin(server_conn: socket, codecs: set[int], topics: Channels):
     """
     Empties stdin buffer and sends it through the socket
     """
     msg = input()
-    server_conn.send(msg.encode())
+    if msg.split(" ", 1)[0] in COMMANDS:
+        server_conn.sendall(channel_frames(msg, topics))
+        return
+    codec, payload = compression.compress_text(msg.encode(), codecs)
+    server_conn.sendall(frame(payload, codec))
+
+
+def channel_frames(msg: str, topics: Channels) -> bytes:
+    """
+    Returns the frames of a channel command, joining a channel also
+    publishes the next messages on it
+    """
+    command, _, name = msg.partition(" ")
+    name = name.strip()
+    payload = name.encode()
+    try:
+        channels.parse_name(payload)
+    except ValueError as e:
+        print(f"Invalid channel: {e}")
+        return b''
+
+    frames = []
+    if command == "/join":
+        frames.append(frame(payload, channels.JOIN))
+        topics.joined.add(name)
+    elif command == "/leave":
+        frames.append(frame(payload, channels.LEAVE))
+        topics.joined.discard(name)
+        # Go back to the default channel if we were publishing on it
+        name = channels.DEFAULT if name == topics.publish else topics.publish
+    if name != topics.publish or command == "/join":
+        topics.publish = name
+        frames.append(frame(name.encode(), channels.TOPIC))
+    return b''.join(frames)
 
 
-def handle_server(server_conn: socket):
+def handle_server(
+        server_conn: socket,
+        decoder: FrameDecoder,
+        codecs: set[int],
+        topics: Channels,
+        report: Optional[Report] = None,
+        quiet: bool = False,
+        resume: Optional[Resume] = None
+):
     """
-    Reads the message from the socket and either prints it or exits if the
+    Reads the messages from the socket and either prints them or exits if the
     server closed the connection
     """
-    msg = server_conn.recv(4096)
-    if len(msg) == 0:
+    data = server_conn.recv(65536)
+    if len(data) == 0:
         print("The server disconnected")
         server_conn.close()
+        if report is not None:
+            print(report, file=stderr)
         exit(1)
 
-    print(msg.decode())
+    for codec, msg in decoder.feed_raw(data):
+        if codec == compression.HELLO:
+            # The server answered with the codecs we can use
+            codecs.update(msg)
+            continue
+        if codec == channels.TOPIC:
+            # The next messages belong to this channel
+            topics.receive = msg.decode(errors="replace")
+            continue
+        if codec == msglog.OFFSET:
+            # We got every message before this offset
+            if resume is not None:
+                resume.update(msglog.decode_offset(msg))
+            continue
+        if resume is not None and not resume.answered:
+            continue
+        if codec != compression.NONE:
+            try:
+                msg = compression.decompress(codec, msg)
+            except ValueError as e:
+                print(f"Dropped a corrupted message: {e}")
+                continue
+        if report is not None:
+            msg = report.record_received(msg)
+        if quiet:
+            continue
+        if topics.receive != channels.DEFAULT:
+            print(f"[{topics.receive}] {msg.decode()}")
+        else:
+            print(msg.decode())
 
 
 if __name__ == "__main__":
@@ -4,33 +4,103 @@
 #      
 #
 #
-from socket import socket
-def main():
-    s = socket()
-    s.connect(("localhost", 6040))
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+from os import fstat, pread
+from socket import create_connection
+
+# Cada rango va precedido de una cabecera con el tamaño total del archivo,
+# el desplazamiento del rango, su longitud y su suma de comprobación.
+TAMANO_CAMPO = 8
+TAMANO_SUMA = 16
+# Bytes leídos del disco en cada paso al calcular la suma.
+TAMANO_LECTURA = 1024 * 1024
+# Veces que se reintenta un rango que llegó mal antes de rendirse.
+REINTENTOS = 3
+# Respuesta del servidor cuando el rango llegó bien.
+RANGO_OK = b"\x01"
+# Segundos que se espera al servidor en cada operación de una conexión.
+TIEMPO_CONEXION = 10.0
+def dividir(tamano, flujos):
+    # Partir el archivo en rangos contiguos, uno por flujo.
+    paso = max(1, -(-tamano // flujos))
+    rangos = [(i, min(paso, tamano - i)) for i in range(0, tamano, paso)]
+    # Un archivo vacío se envía como un único rango vacío.
+    return rangos or [(0, 0)]
+def suma_rango(f, desplazamiento, longitud):
+    suma = blake2b(digest_size=TAMANO_SUMA)
+    fin = desplazamiento + longitud
+    while desplazamiento < fin:
+        datos = pread(
+            f.fileno(),
+            min(TAMANO_LECTURA, fin - desplazamiento),
+            desplazamiento
+        )
+        if not datos:
+            break
+        suma.update(datos)
+        desplazamiento += len(datos)
+    return suma.digest()
+def enviar_rango(ruta, destino, tamano, desplazamiento, longitud):
+    # Cada rango usa su propia conexión y su propio descriptor del archivo.
+    f = open(ruta, "rb")
+    cabecera = (
+        tamano.to_bytes(TAMANO_CAMPO, "big")
+        + desplazamiento.to_bytes(TAMANO_CAMPO, "big")
+        + longitud.to_bytes(TAMANO_CAMPO, "big")
+        + suma_rango(f, desplazamiento, longitud)
+    )
     
-    while True:
-        f = open("ficherolabredes.txt", "rb")
-        content = f.read(1024)
-        
-        while content:
-            # Enviar contenido.
-            s.sendall(content)
-            content = f.read(1024)
-        
-        break
+    for intento in range(REINTENTOS):
+        try:
+            s = create_connection(destino, TIEMPO_CONEXION)
+            s.sendall(cabecera)
+            if longitud:
+                # El kernel copia el rango directamente al socket.
+                s.sendfile(f, desplazamiento, longitud)
+            respuesta = s.recv(1)
+            s.close()
+        except OSError as e:
+            print(f"Error al enviar el rango {desplazamiento}: {e}")
+            continue
+        if respuesta == RANGO_OK:
+            f.close()
+            return True
+        print(f"El rango {desplazamiento} llegó dañado, reintentando.")
     
-    # Se utiliza el caracter de código 1 para indicar
-    # al cliente que ya se ha enviado todo el contenido.
-    try:
-        s.sendall(chr(1))
-    except TypeError:
-        # Compatibilidad con Python 3.
-        s.send(bytes(chr(1), "utf-8"))
+    f.close()
+    return False
+def main():
+    parser = ArgumentParser(description="Envía un archivo al servidor")
+    parser.add_argument("archivo", nargs="?", default="ficherolabredes.txt")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--puerto", type=int, default=6040)
+    parser.add_argument(
+        "--flujos",
+        type=int,
+        default=1,
+        help="número de conexiones simultáneas"
+    )
+    args = parser.parse_args()
     
-    # Cerrar conexión y archivo.
-    s.close()
+    f = open(args.archivo, "rb")
+    tamano = fstat(f.fileno()).st_size
     f.close()
-    print("El archivo ha sido enviado correctamente.")
+    
+    rangos = dividir(tamano, max(1, args.flujos))
+    destino = (args.host, args.puerto)
+    
+    # Enviar todos los rangos a la vez, cada uno en su hilo.
+    with ThreadPoolExecutor(max_workers=len(rangos)) as pool:
+        resultados = list(pool.map(
+            lambda r: enviar_rango(args.archivo, destino, tamano, *r),
+            rangos
+        ))
+    
+    if all(resultados):
+        print("El archivo ha sido enviado correctamente.")
+    else:
+        print("No se ha podido enviar el archivo completo.")
 if __name__ == "__main__":
     main()
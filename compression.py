@@ -0,0 +1,137 @@
+"""
+This module contains the codecs used to compress the payloads of the frames
+
+Both ends of a connection tell each other the codecs they support and every
+frame carries the codec it was compressed with, so a connection where one
+end doesn't compress still works
+"""
+
+import lzma
+import zlib
+from typing import Callable, Iterable, NamedTuple
+
+from framing import FIRST_FLAG
+
+# Codec ids, they go in the top byte of the frame header
+NONE = 0
+ZLIB = 1
+LZMA = 2
+ZLIB_TEXT = 3
+
+# Frame flag of the relay handshake, its payload is the list of codec ids
+HELLO = 0xff
+
+# Payloads smaller than this are not worth compressing
+THRESHOLD = 128
+
+# Words that usually appear in the chat, compressing the short lines against
+# them gives matches a single line wouldn't have, the most common go last
+# because they are cheaper to reference
+TEXT_DICT = (
+    b"https://www. .com .org .es gracias please thanks porque because "
+    b"entonces despues tomorrow today hoy ahora now alguien someone file "
+    b"archivo fichero mensaje message servidor server cliente client "
+    b"puedes could would should have that this with what when where "
+    b"there from they about como pero para una los las por con que the "
+    b"and you are for not but "
+)
+
+
+class Codec(NamedTuple):
+    name: str
+    compress: Callable[[bytes], bytes]
+    decompress: Callable[[bytes], bytes]
+
+
+def _text_compress(data: bytes) -> bytes:
+    # Raw deflate, the zlib header and checksum are a big part of a short
+    # compressed line
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=TEXT_DICT)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _text_decompress(data: bytes) -> bytes:
+    decompressor = zlib.decompressobj(-15, zdict=TEXT_DICT)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+# The available codecs by id, in their default order of preference
+CODECS: dict[int, Codec] = {
+    ZLIB: Codec("zlib", lambda d: zlib.compress(d, 6), zlib.decompress),
+    LZMA: Codec("lzma", lzma.compress, lzma.decompress),
+    ZLIB_TEXT: Codec("zlib-text", _text_compress, _text_decompress),
+}
+
+
+def register(codec_id: int, codec: Codec):
+    """
+    Adds a codec, the id must be below the frame flags and not be used by
+    another one
+    """
+    if not 0 < codec_id < FIRST_FLAG or codec_id in CODECS:
+        raise ValueError(f"invalid codec id {codec_id}")
+    CODECS[codec_id] = codec
+
+
+def by_names(names: Iterable[str]) -> list[int]:
+    """
+    Returns the ids of the codecs with the given names
+    """
+    ids = {codec.name: codec_id for codec_id, codec in CODECS.items()}
+    try:
+        return [ids[name] for name in names]
+    except KeyError as e:
+        raise ValueError(f"unknown codec {e}")
+
+
+def choose(ours: Iterable[int], theirs: Iterable[int]) -> int:
+    """
+    Returns our first codec for bulk data that the other end supports too
+    """
+    theirs = set(theirs)
+    for codec_id in ours:
+        if codec_id in theirs and codec_id != ZLIB_TEXT:
+            return codec_id
+    return NONE
+
+
+def compress(data: bytes, codec_id: int) -> tuple[int, bytes]:
+    """
+    Compresses the data if it is worth it, returns the codec actually used
+    and the payload
+    """
+    if codec_id == NONE or len(data) < THRESHOLD:
+        return NONE, data
+
+    compressed = CODECS[codec_id].compress(data)
+    if len(compressed) >= len(data):
+        return NONE, data
+    return codec_id, compressed
+
+
+def compress_text(data: bytes, codecs: Iterable[int]) -> tuple[int, bytes]:
+    """
+    Compresses a chat line with the preset dictionary if the other end
+    supports it, it pays off for much shorter payloads
+    """
+    if ZLIB_TEXT not in codecs or len(data) < THRESHOLD // 4:
+        return NONE, data
+
+    compressed = _text_compress(data)
+    if len(compressed) >= len(data):
+        return NONE, data
+    return ZLIB_TEXT, compressed
+
+
+def decompress(codec_id: int, data: bytes) -> bytes:
+    """
+    Undoes the compression of a payload, raises ValueError if it is corrupted
+    or the codec is unknown
+    """
+    codec = CODECS.get(codec_id)
+    if codec is None:
+        raise ValueError(f"unknown codec {codec_id}")
+    try:
+        return codec.decompress(data)
+    except (zlib.error, lzma.LZMAError) as e:
+        raise ValueError(f"corrupted {codec.name} payload: {e}")
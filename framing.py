@@ -0,0 +1,172 @@
+"""
+This module contains the framing used by every connection of the project,
+each message is sent prefixed by its size as a big endian 4 bytes integer
+
+Sizes never use the top byte of the header, it carries the codec the payload
+is compressed with, which is 0 for plain payloads, or the flag of a control
+frame
+"""
+
+from collections import deque
+from itertools import islice
+from socket import socket
+from typing import Callable, Optional
+
+HEADER_SIZE = 4
+
+# Bits of the header used by the size, the rest are for the codec
+SIZE_BITS = 24
+SIZE_MASK = (1 << SIZE_BITS) - 1
+
+# Biggest payload accepted, anything bigger is considered a corrupted stream
+MAX_FRAME_SIZE = SIZE_MASK
+
+# Top byte values from here up are not codecs but flags of control frames,
+# the handshake, the channel operations and the offsets of the message log
+FIRST_FLAG = 0xfa
+
+# Maximum amount of buffers handed to a single sendmsg call
+MAX_IOV = 512
+
+
+def encode_header(size: int, codec: int = 0) -> bytes:
+    """
+    Encodes the size header of a message
+    """
+    header = codec << SIZE_BITS | size
+    return header.to_bytes(HEADER_SIZE, byteorder='big', signed=False)
+
+
+def frame(payload: bytes, codec: int = 0) -> bytes:
+    """
+    Returns the payload prefixed with its size header
+    """
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ValueError(f"frame of {len(payload)} bytes is too big")
+    return encode_header(len(payload), codec) + payload
+
+
+def encode_msg(msg) -> bytes:
+    """
+    Serializes a capnp message using the packed encoding, which removes the
+    zeroed padding that makes most of a small message
+    """
+    return msg.to_bytes_packed()
+
+
+def decode_msg(struct, payload: bytes):
+    """
+    Deserializes a capnp message of the given struct encoded by encode_msg
+    """
+    return struct.from_bytes_packed(payload)
+
+
+def flush_queue(sock: socket, queue: deque) -> int:
+    """
+    Sends the queued buffers until the socket would block and returns the
+    bytes sent, the part of a buffer that didn't fit stays at the front of
+    the queue, raises OSError if the connection failed
+    """
+    total = 0
+    while queue:
+        # Hand all the pending buffers to the kernel in a single call
+        try:
+            sent = sock.sendmsg(islice(queue, MAX_IOV))
+        except (BlockingIOError, InterruptedError):
+            break
+
+        total += sent
+        while sent:
+            data = queue[0]
+            if sent < len(data):
+                # Keep the part that didn't fit for the next writable event,
+                # slicing the memoryview doesn't copy the data
+                queue[0] = data[sent:]
+                return total
+            sent -= len(data)
+            queue.popleft()
+
+    return total
+
+
+class FrameDecoder:
+    """
+    Incremental decoder, it accepts the data as it is read from the socket and
+    returns the complete messages once they are fully received
+    """
+    buff: bytearray
+    max_size: int
+    decompress: Optional[Callable[[int, bytes], bytes]]
+
+    def __init__(
+            self,
+            max_size: int = MAX_FRAME_SIZE,
+            decompress: Optional[Callable[[int, bytes], bytes]] = None
+    ):
+        self.buff = bytearray()
+        self.max_size = max_size
+        # Used to undo the compression of the payloads with a codec
+        self.decompress = decompress
+
+    def feed_raw(self, data: bytes) -> list[tuple[int, bytes]]:
+        """
+        Adds the data to the buffer and returns the codec and payload of the
+        messages completed by it, raises ValueError if a header is too big
+        """
+        self.buff += data
+        buff = self.buff
+        length = len(buff)
+
+        frames = []
+        start = 0
+        while length - start >= HEADER_SIZE:
+            body = start + HEADER_SIZE
+            header = int.from_bytes(buff[start:body], byteorder='big')
+            size = header & SIZE_MASK
+            if size > self.max_size:
+                raise ValueError(f"frame of {size} bytes is too big")
+
+            end = body + size
+            if end > length:
+                break
+            frames.append((header >> SIZE_BITS, bytes(buff[body:end])))
+            start = end
+
+        # Drop the consumed messages at once
+        del buff[:start]
+        return frames
+
+    def feed(self, data: bytes) -> list[bytes]:
+        """
+        Adds the data to the buffer and returns the plain payloads of the
+        messages completed by it, raises ValueError if a header is too big
+        or a payload can't be decompressed
+        """
+        payloads = []
+        for codec, payload in self.feed_raw(data):
+            if codec:
+                if self.decompress is None:
+                    raise ValueError(f"unexpected codec {codec}")
+                payload = self.decompress(codec, payload)
+            payloads.append(payload)
+        return payloads
+
+    def pending(self) -> int:
+        """
+        Returns the amount of buffered bytes that are not a complete message
+        """
+        return len(self.buff)
+
+
+def recv_frames(sock: socket, decoder: FrameDecoder) -> list[bytes]:
+    """
+    Blocks until at least a whole message is received through the socket,
+    returns an empty list if the connection was closed
+    """
+    while True:
+        data = sock.recv(4096)
+        if len(data) == 0:
+            return []
+        frames = decoder.feed(data)
+        if frames:
+            return frames
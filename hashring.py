@@ -0,0 +1,59 @@
+"""
+This module contains the consistent hashing ring that spreads the peers
+between the instances of the bootstrap server, every instance is placed in
+many points of the ring so adding or removing one only moves the peers of its
+neighbouring points
+"""
+
+import hashlib
+from bisect import bisect
+from typing import Iterable
+
+# Points of the ring every instance is placed in, more points spread the
+# peers more evenly
+VNODES = 64
+
+
+def ring_hash(data: bytes) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(data, digest_size=8).digest(), byteorder='big'
+    )
+
+
+class HashRing:
+    """
+    The ring of the instances, the owners of a key are the first instances
+    found walking the ring from its hash, skipping the ones that are down
+    """
+    points: list[int]
+    nodes: list[int]
+    size: int
+
+    def __init__(self, names: list[str], vnodes: int = VNODES):
+        # Every instance is identified by its position in the list, which
+        # must be the same in every instance
+        placed = sorted(
+            (ring_hash(f"{name}#{v}".encode()), node)
+            for node, name in enumerate(names)
+            for v in range(vnodes)
+        )
+        self.points = [point for point, _ in placed]
+        self.nodes = [node for _, node in placed]
+        self.size = len(names)
+
+    def owners(self, key: int, alive: Iterable[int], count: int) -> list[int]:
+        """
+        Returns the instances that own the key, the first one is the primary
+        and the rest keep replicas
+        """
+        alive = set(alive)
+        count = min(count, len(alive))
+        found: list[int] = []
+        start = bisect(self.points, ring_hash(key.to_bytes(8, 'big')))
+        for i in range(len(self.nodes)):
+            if len(found) == count:
+                break
+            node = self.nodes[(start + i) % len(self.nodes)]
+            if node in alive and node not in found:
+                found.append(node)
+        return found
@@ -0,0 +1,105 @@
+"""
+This module contains the unix socket fast path, servers and peers can listen
+on a unix socket besides their TCP port so the endpoints running on the same
+host reach them without going through the TCP stack
+
+A unix socket path only means something on the host it was created on, so it
+is advertised along with the id of the host and only used by endpoints that
+have the same id
+"""
+
+import atexit
+import errno
+import hashlib
+import ipaddress
+import os
+import socket
+import stat
+import tempfile
+
+
+def read_host_id() -> int:
+    """
+    Returns an id of this host that changes on every boot, like the unix
+    sockets in the temporary directory may do
+    """
+    try:
+        with open("/proc/sys/kernel/random/boot_id", "rb") as f:
+            seed = f.read().strip()
+    except OSError:
+        seed = b''
+    seed += socket.gethostname().encode()
+    return int.from_bytes(
+        hashlib.blake2b(seed, digest_size=8).digest(), byteorder='big'
+    )
+
+
+# The id of this host, 0 is never advertised
+HOST_ID = read_host_id() or 1
+
+
+def default_path(kind: str, port: int) -> str:
+    """
+    Returns where an endpoint of the given kind listening on a TCP port puts
+    its unix socket, clients find it there without being told
+    """
+    return os.path.join(tempfile.gettempdir(), f"chat-{kind}-{port}.sock")
+
+
+def remove_stale(path: str):
+    """
+    Removes the socket a previous run that didn't exit cleanly left behind,
+    raises OSError if something is still listening on it
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            # Not ours to remove, binding to it fails
+            return
+    except FileNotFoundError:
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    probe.setblocking(False)
+    try:
+        err = probe.connect_ex(path)
+    finally:
+        probe.close()
+    if err == errno.ECONNREFUSED:
+        os.unlink(path)
+    elif err != errno.ENOENT:
+        raise OSError(errno.EADDRINUSE, os.strerror(errno.EADDRINUSE), path)
+
+
+def listen(path: str, backlog: int) -> socket.socket:
+    """
+    Listens on a non blocking unix socket, the path is removed on exit, raises
+    OSError if it can't be bound or another process listens on it
+    """
+    remove_stale(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(backlog)
+    sock.setblocking(False)
+
+    owner = os.getpid()
+
+    def remove():
+        # Forked processes share the socket but only its creator removes it
+        if os.getpid() == owner and os.path.exists(path):
+            os.unlink(path)
+
+    atexit.register(remove)
+    return sock
+
+
+def is_local(host: str) -> bool:
+    """
+    Returns whether a host name or address refers to this host
+    """
+    try:
+        addr = socket.gethostbyname(host)
+        if ipaddress.IPv4Address(addr).is_loopback:
+            return True
+        return addr in socket.gethostbyname_ex(socket.gethostname())[2]
+    except (OSError, ValueError):
+        return False
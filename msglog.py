@@ -0,0 +1,534 @@
+"""
+This module contains the durable log of the relay, every relayed message is
+appended to it with a sequential offset so the clients that reconnect get the
+messages they missed
+
+The log is split in segments named by the offset of their first message,
+each one with a sparse index of the positions of some of its messages, and
+the oldest segments are removed once they are too old or the log too big
+
+Appends are written as they happen and made durable by a single fsync for
+all the ones written while the previous fsync ran, outside the event loop,
+and the reads go through memory maps of the segments so they are served
+straight from the page cache
+"""
+
+import mmap
+import os
+import struct
+import time
+import zlib
+from array import array
+from bisect import bisect_right
+from functools import partial
+from typing import Any, Callable, Iterable, Optional
+
+# Frame flags, a client sends RESUME with the offset it wants the messages
+# from and the relay sends OFFSET after the messages it delivered with the
+# offset the client would resume from
+RESUME = 0xfb
+OFFSET = 0xfa
+# Offset a client without one resumes from, it only gets the new messages
+LATEST = (1 << 64) - 1
+OFFSET_FORMAT = struct.Struct(">Q")
+# A RESUME frame may carry the id the client keeps between connections after
+# the offset, its own messages are skipped when it reads the log
+RESUME_FORMAT = struct.Struct(">QQ")
+# Sender of the messages of the clients without an id
+ANONYMOUS = 0
+
+# Header of a record: offset, checksum of the topic and the payload, id of
+# the sender, payload length, codec and topic length, the topic and the
+# payload follow it
+HEADER = struct.Struct(">QIQIBB")
+# Entry of an index: offset relative to the base of the segment and position
+# of the record in it
+INDEX_ENTRY = struct.Struct(">II")
+# Bytes of records between two entries of the index
+INDEX_INTERVAL = 4096
+
+# Default bytes of a segment before a new one is started
+DEFAULT_SEGMENT_BYTES = 64 << 20
+# Seconds between checks of the age of the segments
+RETENTION_CHECK = 60.0
+
+LOG_SUFFIX = ".log"
+INDEX_SUFFIX = ".index"
+
+# A record read from the log: offset, sender, topic, codec and payload
+Record = tuple[int, int, str, int, bytes]
+# Runs a task outside of the event loop after the previous ones and calls
+# back on the loop with its result and error, like workers.Serial.run
+Runner = Callable[..., None]
+
+
+def encode_offset(offset: int) -> bytes:
+    return OFFSET_FORMAT.pack(offset)
+
+
+def decode_offset(payload: bytes) -> int:
+    """
+    Returns the offset of a RESUME or OFFSET frame, raises ValueError if the
+    payload is not one
+    """
+    if len(payload) != OFFSET_FORMAT.size:
+        raise ValueError(f"offset of {len(payload)} bytes")
+    return OFFSET_FORMAT.unpack(payload)[0]
+
+
+def encode_resume(offset: int, client_id: int) -> bytes:
+    return RESUME_FORMAT.pack(offset, client_id)
+
+
+def decode_resume(payload: bytes) -> tuple[int, int]:
+    """
+    Returns the offset and the client id of a RESUME frame, the id is
+    ANONYMOUS if it only has the offset, raises ValueError if the payload is
+    not one
+    """
+    if len(payload) == OFFSET_FORMAT.size:
+        return decode_offset(payload), ANONYMOUS
+    if len(payload) != RESUME_FORMAT.size:
+        raise ValueError(f"resume of {len(payload)} bytes")
+    return RESUME_FORMAT.unpack(payload)
+
+
+def parse_record(data, pos: int) -> Optional[tuple[Record, int]]:
+    """
+    Returns the record at a position and the position of the next one, None
+    if it is incomplete or corrupted
+    """
+    if pos + HEADER.size > len(data):
+        return None
+    offset, crc, sender, length, codec, topic_len = HEADER.unpack_from(
+        data, pos
+    )
+    start = pos + HEADER.size
+    end = start + topic_len + length
+    if end > len(data):
+        return None
+    body = data[start:end]
+    if zlib.crc32(body) != crc:
+        return None
+    topic = body[:topic_len].decode(errors="replace")
+    return (offset, sender, topic, codec, body[topic_len:]), end
+
+
+def write_all(fd: int, data: bytes):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def remove_files(paths: tuple[str, ...]):
+    for path in paths:
+        os.unlink(path)
+
+
+class Segment:
+    """
+    A file of the log with the records from its base offset on, and its
+    sparse index kept in memory and in a file next to it
+    """
+    base: int
+    path: str
+    index_path: str
+    size: int
+    end: int
+    offsets: array
+    positions: array
+    last_indexed: int
+    modified: float
+    fd: Optional[int]
+    index_fd: Optional[int]
+
+    def __init__(self, directory: str, base: int):
+        self.base = base
+        name = os.path.join(directory, f"{base:020d}")
+        self.path = name + LOG_SUFFIX
+        self.index_path = name + INDEX_SUFFIX
+        self.size = 0
+        # The offset after its last record
+        self.end = base
+        # The index entries, offsets relative to the base
+        self.offsets = array('L')
+        self.positions = array('L')
+        self.last_indexed = -INDEX_INTERVAL
+        self.modified = time.time()
+        # Only the segment being appended to is open
+        self.fd = None
+        self.index_fd = None
+
+    def load(self):
+        """
+        Reads the index and checks the records after its last entry, the
+        ones a crash left half written are removed
+        """
+        self.size = os.path.getsize(self.path)
+        self.modified = os.path.getmtime(self.path)
+        try:
+            with open(self.index_path, 'rb') as f:
+                index = f.read()
+        except FileNotFoundError:
+            index = b''
+        for rel, pos in INDEX_ENTRY.iter_unpack(
+                index[:len(index) - len(index) % INDEX_ENTRY.size]
+        ):
+            if pos >= self.size:
+                break
+            self.offsets.append(rel)
+            self.positions.append(pos)
+
+        pos = self.positions[-1] if self.positions else 0
+        self.end = self.base + (self.offsets[-1] if self.offsets else 0)
+        self.last_indexed = pos if self.positions else -INDEX_INTERVAL
+        with open(self.path, 'rb') as f:
+            f.seek(pos)
+            tail = f.read()
+        checked = 0
+        while True:
+            parsed = parse_record(tail, checked)
+            if parsed is None:
+                break
+            (offset, *_), checked = parsed
+            self.end = offset + 1
+
+        if pos + checked < self.size or \
+                len(self.offsets) * INDEX_ENTRY.size < len(index):
+            self.size = pos + checked
+            os.truncate(self.path, self.size)
+            with open(self.index_path, 'wb') as f:
+                f.write(b''.join(
+                    INDEX_ENTRY.pack(rel, p)
+                    for rel, p in zip(self.offsets, self.positions)
+                ))
+
+    def open(self):
+        """
+        Opens the segment to append to it
+        """
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        self.fd = os.open(self.path, flags, 0o644)
+        self.index_fd = os.open(self.index_path, flags, 0o644)
+
+    def locate(self, offset: int) -> tuple[int, int]:
+        """
+        Returns the position of the last indexed record at or before the
+        offset along with its offset
+        """
+        i = bisect_right(self.offsets, offset - self.base) - 1
+        if i < 0:
+            return 0, self.base
+        return self.positions[i], self.base + self.offsets[i]
+
+
+class MessageLog:
+    """
+    The segments of the log, the last one is the one being appended to
+    """
+    directory: str
+    segment_bytes: int
+    retention_seconds: float
+    retention_bytes: int
+    fsync_interval: float
+    segments: list[Segment]
+    bases: list[int]
+    next: int
+    durable: int
+    syncing: bool
+    last_sync: float
+    last_retention: float
+    disk: Runner
+
+    def __init__(
+            self,
+            directory: str,
+            disk: Runner,
+            segment_bytes: int = DEFAULT_SEGMENT_BYTES,
+            retention_seconds: float = 0,
+            retention_bytes: int = 0,
+            fsync_interval: float = 0
+    ):
+        """
+        Opens the log in a directory, raises OSError if it can't be read
+        """
+        self.directory = directory
+        # Runs the fsyncs and the removals of the segments
+        self.disk = disk
+        self.segment_bytes = segment_bytes
+        # Limits of the log, 0 means unlimited
+        self.retention_seconds = retention_seconds
+        self.retention_bytes = retention_bytes
+        self.fsync_interval = fsync_interval
+
+        os.makedirs(directory, exist_ok=True)
+        self.segments = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(LOG_SUFFIX):
+                segment = Segment(directory, int(name[:-len(LOG_SUFFIX)]))
+                segment.load()
+                self.segments.append(segment)
+        if not self.segments:
+            self.segments.append(Segment(directory, 0))
+        self.bases = [s.base for s in self.segments]
+        self.segments[-1].open()
+
+        self.next = self.segments[-1].end
+        # The offset up to which the log was fsynced
+        self.durable = self.next
+        self.syncing = False
+        self.last_sync = 0.0
+        self.last_retention = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.segments)
+
+    def first(self) -> int:
+        return self.segments[0].base
+
+    def append(self, records: Iterable[tuple[int, str, int, bytes]]) -> int:
+        """
+        Appends messages to the log with a single write, each one with its
+        sender, topic, codec and payload, returns the offset of the first
+        one, raises OSError if it can't be written
+        """
+        active = self.segments[-1]
+        if active.size >= self.segment_bytes and active.end > active.base:
+            active = self.roll()
+
+        first = self.next
+        chunks = []
+        index = []
+        pos = active.size
+        for sender, topic, codec, payload in records:
+            name = topic.encode()
+            if pos - active.last_indexed >= INDEX_INTERVAL:
+                index.append(INDEX_ENTRY.pack(self.next - active.base, pos))
+                active.offsets.append(self.next - active.base)
+                active.positions.append(pos)
+                active.last_indexed = pos
+            chunks.append(HEADER.pack(
+                self.next, zlib.crc32(payload, zlib.crc32(name)), sender,
+                len(payload), codec, len(name)
+            ))
+            chunks.append(name)
+            chunks.append(payload)
+            pos += HEADER.size + len(name) + len(payload)
+            self.next += 1
+
+        write_all(active.fd, b''.join(chunks))
+        if index:
+            write_all(active.index_fd, b''.join(index))
+        active.size = pos
+        active.end = self.next
+        active.modified = time.time()
+        return first
+
+    def roll(self) -> Segment:
+        """
+        Starts a new segment, the previous one is fsynced and closed
+        """
+        previous = self.segments[-1]
+        fds = (previous.fd, previous.index_fd)
+        previous.fd = previous.index_fd = None
+
+        def close():
+            for fd in fds:
+                os.fsync(fd)
+                os.close(fd)
+
+        self.disk(close, self.closed)
+        segment = Segment(self.directory, self.next)
+        segment.open()
+        self.segments.append(segment)
+        self.bases.append(segment.base)
+        self.retain()
+        return segment
+
+    @staticmethod
+    def closed(_, error: Optional[BaseException]):
+        if error is not None:
+            print(f"Error while closing a log segment: {error}")
+
+    def commit(self, now: float):
+        """
+        Fsyncs at once everything appended since the previous fsync, unless
+        one is running or it is too soon for the next one
+        """
+        if now - self.last_retention >= RETENTION_CHECK:
+            self.last_retention = now
+            self.retain()
+        if self.syncing or self.durable == self.next or \
+                now - self.last_sync < self.fsync_interval:
+            return
+
+        self.syncing = True
+        self.last_sync = now
+        target = self.next
+        fd = self.segments[-1].fd
+
+        def synced(_, error: Optional[BaseException]):
+            self.syncing = False
+            if error is not None:
+                print(f"Error while syncing the log: {error}")
+                return
+            self.durable = max(self.durable, target)
+
+        self.disk(lambda: os.fsync(fd), synced)
+
+    def timeout(self, now: float) -> Optional[float]:
+        """
+        Returns the seconds until the next fsync can start, None if there is
+        nothing to fsync or one is running, which wakes the loop when done
+        """
+        if self.syncing or self.durable == self.next:
+            return None
+        return max(0.0, self.last_sync + self.fsync_interval - now)
+
+    def retain(self):
+        """
+        Removes the oldest segments while they are older than the retention
+        time or the log is bigger than the retention size, the one being
+        appended to is always kept
+        """
+        now = time.time()
+        total = sum(s.size for s in self.segments)
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            too_old = self.retention_seconds and \
+                now - oldest.modified > self.retention_seconds
+            too_big = self.retention_bytes and total > self.retention_bytes
+            if not too_old and not too_big:
+                break
+            total -= oldest.size
+            self.segments.pop(0)
+            self.bases.pop(0)
+            # The readers on it keep their maps of the removed file
+            self.disk(
+                partial(remove_files, (oldest.path, oldest.index_path)),
+                self.closed
+            )
+
+    def reader(self, offset: int) -> "LogReader":
+        """
+        Returns a reader from an offset, the offsets past the end read only
+        the new messages and the ones already removed read from the oldest
+        one kept
+        """
+        offset = min(offset, self.next)
+        return LogReader(self, max(offset, self.first()))
+
+
+class LogReader:
+    """
+    Reads the records of the log in order from an offset through a memory
+    map of the segment it is on
+    """
+    log: MessageLog
+    offset: int
+    segment: Segment
+    map: Any
+    pos: int
+
+    def __init__(self, log: MessageLog, offset: int):
+        self.log = log
+        self.map = b''
+        self.seek(offset)
+
+    def seek(self, offset: int):
+        """
+        Moves to an offset through the index of its segment
+        """
+        log = self.log
+        self.segment = log.segments[max(0, bisect_right(log.bases, offset) - 1)]
+        self.pos, self.offset = self.segment.locate(offset)
+        self.remap()
+        # Skip the records between the indexed one and the offset
+        while self.offset < offset and self.pos < len(self.map):
+            parsed = parse_record(self.map, self.pos)
+            if parsed is None:
+                self.skip()
+                break
+            (rec_offset, *_), self.pos = parsed
+            self.offset = rec_offset + 1
+
+    def remap(self):
+        """
+        Maps what the segment has now, it grows while it is appended to
+        """
+        self.close()
+        with open(self.segment.path, 'rb') as f:
+            if self.segment.size:
+                self.map = mmap.mmap(
+                    f.fileno(), self.segment.size, access=mmap.ACCESS_READ
+                )
+
+    def done(self) -> bool:
+        return self.offset >= self.log.next
+
+    def read(self, budget: int) -> list[Record]:
+        """
+        Returns the next records, up to the given bytes of payload, the
+        corrupted ones are skipped
+        """
+        records = []
+        used = 0
+        while used < budget and not self.done():
+            if self.pos >= len(self.map):
+                try:
+                    if not self.advance():
+                        # The log has more records than its last segment,
+                        # the position went past them
+                        self.skip()
+                        break
+                except OSError:
+                    # The segment was removed, go on from the oldest one
+                    self.seek(self.log.first())
+                continue
+            parsed = parse_record(self.map, self.pos)
+            if parsed is None:
+                # Everything mapped was written already, so it is corrupted
+                self.skip()
+                continue
+            record, self.pos = parsed
+            self.offset = record[0] + 1
+            records.append(record)
+            used += len(record[4])
+        return records
+
+    def skip(self):
+        """
+        Moves past a corrupted record to the next indexed one, or to the end
+        of the segment if there is none, the records in between are lost
+        """
+        segment = self.segment
+        i = bisect_right(segment.positions, self.pos)
+        if i < len(segment.positions):
+            pos = segment.positions[i]
+            offset = segment.base + segment.offsets[i]
+        else:
+            pos, offset = segment.size, segment.end
+        print(f"Corrupted record at {self.pos} of {segment.path}, skipping "
+              f"to offset {offset}")
+        self.pos, self.offset = pos, offset
+
+    def advance(self) -> bool:
+        """
+        Maps the rest of the segment or moves to the next one once it is
+        read to its end, returns False if there is nothing more to map
+        """
+        if self.pos < self.segment.size:
+            self.remap()
+            return True
+        i = bisect_right(self.log.bases, self.segment.base)
+        if i >= len(self.log.segments):
+            return False
+        self.segment = self.log.segments[i]
+        self.pos = 0
+        self.remap()
+        return True
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.map = b''
@@ -3,240 +3,1503 @@
 This module contains the executable for the p2p part of the chat
 """
 
+import errno
 import io
 import ipaddress
+import os
+import random
+import selectors
+import shutil
 import sys
-from select import select
-from socket import AF_INET, SOCK_STREAM, create_connection, socket
+import tempfile
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict, deque
+from socket import (AF_INET, AF_UNIX, IPPROTO_TCP, SO_ERROR, SOCK_STREAM,
+                    SOL_SOCKET, TCP_NODELAY, create_connection, socket)
 from sys import stdin
+from typing import BinaryIO, Callable, Optional
 
 import capnp
+import compression
+import localsock
 import msgs_capnp
+import workers
+from chunkstore import HASH_SIZE, ChunkStore, chunk_hash
+from framing import (FrameDecoder, decode_msg, encode_msg, flush_queue, frame,
+                     recv_frames)
 
 EXIT_OK = 0
 EXIT_ERR = 1
 
+# Size of the pieces in which files are sent
+CHUNK_SIZE = 64 * 1024
+# Bytes that can be queued on a connection before we stop sending it the
+# chunks it asked for, this bounds the memory used by a transfer
+UPLOAD_WINDOW = 4 * CHUNK_SIZE
+# Bytes of relayed messages that can be queued on a connection before
+# applying the slow consumer policy to it
+DEFAULT_HIGH_WATER = 1 << 20
+# What to do with the neighbors over the high water mark
+POLICY_DROP = "drop"
+POLICY_DISCONNECT = "disconnect"
+# Bytes read from a socket in a single call
+RECV_SIZE = 65536
+# Amount of message ids remembered to drop the relayed duplicates
+SEEN_CACHE_SIZE = 65536
+# Seconds between attempts to find new neighbors when some are missing
+FILL_INTERVAL = 5.0
+# Seconds between the heartbeats sent to the server, it forgets the peers
+# that stay silent for a few of them
+HEARTBEAT_INTERVAL = 5.0
+# Seconds to wait for a neighbor to accept the connection
+CONNECT_TIMEOUT = 2.0
+# Seconds before trying again to connect to a peer that failed, doubled on
+# every failure up to the maximum
+RETRY_INTERVAL = 1.0
+MAX_RETRY_INTERVAL = 60.0
+# Hashes of the chunks of a file sent in every page of its manifest, the
+# chunks of a file are asked for a page at a time
+MANIFEST_PAGE = 4096
+# Manifests of the received files kept to give them to the neighbors
+MANIFEST_CACHE = 32
+# Seconds a sent file stays open after the last time a peer asked for it
+UPLOAD_TIMEOUT = 300.0
+# Chunks read ahead for every peer that asked for some
+READ_AHEAD = 2
+# Chunks of a file asked for and not received yet
+REQUEST_WINDOW = 16
+# Chunks asked for and not received yet to a single neighbor, this spreads
+# the requests over every neighbor that has the chunks
+PEER_REQUESTS = 4
+# Seconds without receiving any chunk of a file before asking again
+STALL_TIMEOUT = 5.0
+# Default size limit of the chunk store in MiB
+DEFAULT_STORE_SIZE = 1024
+# Bytes received that can be waiting to be written to disk before we stop
+# reading from the peers
+DISK_WINDOW = 8 * 1024 * 1024
+
 incoming_port: int = 0
 counter: int = 0
+# The address the server sees us at, the peers on this host that connect
+# through the unix socket have the same one
+local_host: str = "127.0.0.1"
+# The unix socket we listen on too, if any
+unix_path: Optional[str] = None
+
+# The id that tags the messages created by this peer and the sequence
+# number of the last one
+node_id: int = random.getrandbits(63)
+seq: int = 0
+# The ids of the messages already handled, in least recently seen order
+seen: OrderedDict = OrderedDict()
+# Amount of neighbors kept in the overlay, 0 means connecting to every peer
+neighbors: int = 0
+# Whether the chunks are asked for to every neighbor that has them, instead
+# of only to the one the file was announced by
+swarm: bool = True
+# The slow consumer policy applied to the relayed messages
+high_water: int = DEFAULT_HIGH_WATER
+policy: str = POLICY_DROP
+# Bytes received waiting to be written to disk and whether we stopped
+# reading from the peers because of them
+disk_backlog: int = 0
+reading_paused: bool = False
+# The codecs we can decompress and the one used to compress the file chunks
+local_codecs: list[int] = list(compression.CODECS)
+bulk_codec: int = compression.choose(local_codecs, local_codecs)
+# The chunks received, kept to avoid receiving them again
+store: ChunkStore
+
+# The selector that drives the event loop
+sel = selectors.DefaultSelector()
+# The connections to other peers in progress
+dialer: "Dialer"
+
+
+def peer_key(host: str, port: int) -> int:
+    """
+    Returns the id of a peer, its IPv4 address and listening port packed in
+    48 bits, the same one the server uses
+    """
+    return int.from_bytes(
+        ipaddress.IPv4Address(host).packed, byteorder='big'
+    ) << 16 | port
+
+
+class Connection:
+    """
+    A non blocking connection to another peer with the decoder of the
+    incoming messages and the queue of the outgoing ones, there is a single
+    one for every pair of peers and messages go both ways through it
+    """
+    __slots__ = (
+        "sock", "addr", "decoder", "queue", "queued", "events", "reading",
+        "port", "outbound", "codecs", "requests", "loading", "loaded",
+        "asked"
+    )
+    sock: socket
+    addr: tuple[str, int]
+    decoder: FrameDecoder
+    queue: deque
+    queued: int
+    events: int
+    reading: bool
+    port: Optional[int]
+    outbound: bool
+    codecs: Optional[set[int]]
+    requests: dict[bytes, None]
+    loading: set[bytes]
+    loaded: dict[bytes, tuple[bytes, tuple[int, bytes]]]
+    asked: int
+
+    def __init__(
+            self,
+            sock: socket,
+            port: Optional[int] = None,
+            host: Optional[str] = None
+    ):
+        self.sock = sock
+        if sock.family == AF_UNIX:
+            # The other end has no address, it runs on this host
+            self.addr = (host or local_host, 0)
+        else:
+            self.addr = sock.getpeername()
+        # The port where the other peer listens, for incoming connections it
+        # is unknown until its first message arrives
+        self.port = port
+        self.outbound = port is not None
+        # The codecs the other peer can decompress, unknown until its hello
+        # arrives, which is always its first message
+        self.codecs = None
+        self.decoder = FrameDecoder()
+        self.queue = deque()
+        self.queued = 0
+        # The chunks the other peer asked for in order, the ones being read
+        # by the workers and the ones ready to be sent
+        self.requests = {}
+        self.loading = set()
+        self.loaded = {}
+        # The chunks we asked it for that didn't arrive yet
+        self.asked = 0
+
+        sock.setblocking(False)
+        # The chunk requests are small and must not wait for the
+        # acknowledgement of the previous data, writes are batched already
+        if sock.family == AF_INET:
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.events = 0
+        self.reading = not reading_paused
+        self.update_events()
+
+    def __repr__(self):
+        if self.sock.family == AF_UNIX:
+            if self.port is None:
+                return f"{self.addr[0]} (unix)"
+            return f"{self.addr[0]}:{self.port} (unix)"
+        return f"{self.addr[0]}:{self.addr[1]}"
+
+    @property
+    def peer_id(self) -> Optional[int]:
+        """
+        The id of the other peer, unknown for incoming connections until its
+        hello arrives
+        """
+        if self.port is None:
+            return None
+        return peer_key(self.addr[0], self.port)
+
+    def preferred(self) -> bool:
+        """
+        Whether this connection is kept when there is another one with the
+        same peer, both peers agree on keeping the one opened by the peer
+        with the lowest id
+        """
+        host = local_host
+        if self.sock.family == AF_INET:
+            host = self.sock.getsockname()[0]
+        local_id = peer_key(host, incoming_port)
+        return self.outbound == (local_id < self.peer_id)
+
+    def update_events(self):
+        """
+        Watches the socket for reading unless it is paused and for writing
+        while there is data pending
+        """
+        events = selectors.EVENT_READ if self.reading else 0
+        if self.queue:
+            events |= selectors.EVENT_WRITE
+        if events == self.events:
+            return
+
+        if self.events == 0:
+            sel.register(self.sock, events, self)
+        elif events == 0:
+            sel.unregister(self.sock)
+        else:
+            sel.modify(self.sock, events, self)
+        self.events = events
+
+    def pause(self, paused: bool):
+        """
+        Stops or resumes reading from the connection
+        """
+        self.reading = not paused
+        self.update_events()
+
+    def send_msg(
+            self,
+            msg: bytes,
+            compressed: tuple[int, bytes] = (compression.NONE, b'')
+    ):
+        """
+        Queues a message and sends as much as possible without blocking, the
+        compressed version is sent instead if the other peer supports it
+        """
+        codec, payload = compressed
+        if codec == compression.NONE or codec not in (self.codecs or ()):
+            codec, payload = compression.NONE, msg
+
+        was_empty = not self.queue
+        data = memoryview(frame(payload, codec))
+        self.queue.append(data)
+        self.queued += len(data)
+
+        if was_empty:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends the queued data until the socket would block, the connection
+        is only watched for writability while there is data pending
+        """
+        try:
+            self.queued -= flush_queue(self.sock, self.queue)
+        except OSError:
+            # The error will surface again as a closed connection when
+            # reading from it
+            self.queue.clear()
+            self.queued = 0
+
+        self.update_events()
+
+    def close(self):
+        if self.events:
+            sel.unregister(self.sock)
+        self.sock.close()
 
 
-class PeerId():
+class PeerTable(dict):
     """
-    A socket ID object that is hashable
+    The connections to the other peers by their socket identifier, indexed
+    by the id of the peer too once it is known
     """
-    inner: bytearray
+    by_id: dict[int, Connection]
 
-    def __init__(self, host: bytes, port: bytes):
-        self.inner = bytearray()
-        self.inner += host
-        self.inner += port
+    def __init__(self):
+        super().__init__()
+        self.by_id = {}
 
-    def __hash__(self):
-        num = int.from_bytes(self.inner, byteorder='big', signed=False)
-        return num
+    def add(self, conn: Connection) -> Optional[Connection]:
+        """
+        Adds a connection, returns the one to close if there was another
+        one with the same peer
+        """
+        self[conn.sock.fileno()] = conn
+        return self.identify(conn)
+
+    def identify(self, conn: Connection) -> Optional[Connection]:
+        """
+        Indexes a connection by the id of its peer once it is known, if
+        both peers connected to each other at once the duplicate is
+        returned to be closed
+        """
+        peer_id = conn.peer_id
+        if peer_id is None:
+            return None
+        other = self.by_id.get(peer_id)
+        if other is None or other is conn:
+            self.by_id[peer_id] = conn
+            return None
+
+        keep, drop = (conn, other) if conn.preferred() else (other, conn)
+        self.by_id[peer_id] = keep
+        return drop
+
+    def remove(self, conn: Connection):
+        del self[conn.sock.fileno()]
+        peer_id = conn.peer_id
+        if peer_id is not None and self.by_id.get(peer_id) is conn:
+            del self.by_id[peer_id]
+
+
+class Dial:
+    """
+    A connection being opened to a peer without blocking, or waiting to be
+    tried again after failing
+    """
+    __slots__ = ("host", "port", "path", "sock", "failures", "due")
+    host: str
+    port: int
+    path: Optional[str]
+    sock: Optional[socket]
+    failures: int
+    due: float
+
+    def __init__(self, host: str, port: int, path: Optional[str] = None):
+        self.host = host
+        self.port = port
+        # The unix socket of the peer when it runs on this host
+        self.path = path
+        self.sock = None
+        self.failures = 0
+        # When the connection times out, or when it is tried again if there
+        # is no socket
+        self.due = 0.0
 
     def __repr__(self):
-        return f"{self.__hash__()}"
+        if self.path:
+            return f"{self.host}:{self.port} (unix)"
+        return f"{self.host}:{self.port}"
 
 
-class Peer:
+class Dialer:
     """
-    A peer object with its corresponding socket connection
+    The connections being opened to other peers by the id of the peer, they
+    are all opened at once and registered in the event loop as they are
+    accepted, the ones that fail are tried again later when connecting to
+    every peer
     """
-    in_sock: socket
-    out_sock: socket
-    peer_id: PeerId
+    dials: dict[int, Dial]
 
-    def __init__(
+    def __init__(self):
+        self.dials = {}
+
+    def __contains__(self, peer_id: int) -> bool:
+        return peer_id in self.dials
+
+    def connecting(self) -> int:
+        """
+        Returns the amount of connections in progress
+        """
+        return sum(1 for dial in self.dials.values() if dial.sock is not None)
+
+    def dial(self, host: str, port: int, path: Optional[str] = None) -> bool:
+        """
+        Starts connecting to a peer, returns False if it failed right away
+        """
+        dial = Dial(host, port, path)
+        self.dials[peer_key(host, port)] = dial
+        return self.start(dial)
+
+    def start(self, dial: Dial) -> bool:
+        sock = socket(AF_UNIX if dial.path else AF_INET, SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            err = sock.connect_ex(dial.path or (dial.host, dial.port))
+        except OSError as e:
+            err = e.errno
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self.failed(dial, os.strerror(err))
+            return False
+
+        dial.sock = sock
+        dial.due = time.monotonic() + CONNECT_TIMEOUT
+        sel.register(sock, selectors.EVENT_WRITE, dial)
+        return True
+
+    def done(self, dial: Dial) -> Optional[socket]:
+        """
+        Returns the socket of a connection once it is accepted, None if it
+        was refused
+        """
+        sock = dial.sock
+        sel.unregister(sock)
+        dial.sock = None
+        err = sock.getsockopt(SOL_SOCKET, SO_ERROR)
+        if err:
+            sock.close()
+            self.failed(dial, os.strerror(err))
+            return None
+
+        del self.dials[peer_key(dial.host, dial.port)]
+        return sock
+
+    def failed(self, dial: Dial, reason: str):
+        """
+        Schedules the next attempt to connect to a peer, in the overlay the
+        missing neighbors are replaced by other peers instead
+        """
+        print(f"[-] Error: Cannot connect to {dial}, {reason}")
+        if dial.path:
+            # Try again right away through TCP
+            dial.path = None
+            dial.due = time.monotonic()
+            return
+        if neighbors:
+            del self.dials[peer_key(dial.host, dial.port)]
+            return
+
+        delay = min(MAX_RETRY_INTERVAL, RETRY_INTERVAL * 2 ** dial.failures)
+        dial.failures += 1
+        dial.due = time.monotonic() + delay
+
+    def timeout(self) -> Optional[float]:
+        """
+        Returns the seconds until a connection times out or is tried again
+        """
+        if not self.dials:
+            return None
+        due = min(dial.due for dial in self.dials.values())
+        return max(0.0, due - time.monotonic())
+
+    def expire(self, known: dict[int, tuple[str, int]], connected: dict):
+        """
+        Gives up on the connections that were not accepted in time and tries
+        again the ones due, unless the peer left or connected to us
+        """
+        now = time.monotonic()
+        for peer_id, dial in list(self.dials.items()):
+            if dial.due > now:
+                continue
+            if dial.sock is not None:
+                sel.unregister(dial.sock)
+                dial.sock.close()
+                dial.sock = None
+                self.failed(dial, "timed out")
+            elif peer_id not in known or peer_id in connected:
+                del self.dials[peer_id]
+            else:
+                print(f"[i] Connecting again to {dial}")
+                self.start(dial)
+
+
+class Upload:
+    """
+    A file sent by this peer, its chunks are read by the workers when some
+    peer asks for them, it is kept open until nobody asks for it in a while
+    """
+    transfer_id: int
+    filename: str
+    f: BinaryIO
+    size: int
+    codec: int
+    hashes: bytes
+    used: float
+    readers: int
+    expired: bool
+
+    def __init__(self, transfer_id: int, filename: str, f: BinaryIO):
+        self.transfer_id = transfer_id
+        self.filename = filename
+        self.f = f
+        self.size = os.fstat(f.fileno()).st_size
+        # Codec of the chunks, it is dropped as soon as one of them doesn't
+        # shrink since the file is probably compressed already
+        self.codec = bulk_codec
+        # The hashes of the chunks one after the other, when a peer last
+        # asked for the file and the reads queued on the workers, the file
+        # is closed once they are over if it expired
+        self.hashes = b''
+        self.used = time.monotonic()
+        self.readers = 0
+        self.expired = False
+
+    def hash_chunks(self) -> list[bytes]:
+        """
+        Returns the hashes of the chunks of the file, it runs on a worker
+        """
+        return [
+            chunk_hash(os.pread(self.f.fileno(), CHUNK_SIZE, offset))
+            for offset in range(0, self.size, CHUNK_SIZE)
+        ]
+
+    def reader(self, offset: int) -> Callable[[], bytes]:
+        """
+        Returns the function that reads the chunk at the given offset, to be
+        run on a worker, release must be called once it is over
+        """
+        self.used = time.monotonic()
+        self.readers += 1
+        size = min(CHUNK_SIZE, self.size - offset)
+        fd = self.f.fileno()
+        return lambda: os.pread(fd, size, offset)
+
+    def release(self):
+        """
+        Tells that a read returned by reader is over
+        """
+        self.readers -= 1
+        if self.expired and not self.readers:
+            self.f.close()
+
+    def expire(self):
+        """
+        Stops sending the file, it is closed once the queued reads are over
+        """
+        self.expired = True
+        if not self.readers:
+            self.f.close()
+
+    def loader(self, offset: int) -> Callable[[], tuple]:
+        """
+        Returns the function that reads and encodes the chunk at the given
+        offset, to be run on a worker
+        """
+        read = self.reader(offset)
+
+        def load() -> tuple[bytes, tuple[int, bytes]]:
+            plain, compressed = encode_chunk(read(), self.codec)
+            if compressed[0] == compression.NONE:
+                self.codec = compression.NONE
+            return plain, compressed
+
+        return load
+
+
+class Download:
+    """
+    A file being received, the workers write its chunks to a temporary file
+    until the user decides whether and where to keep it
+
+    The chunks already in the store are copied from it and the rest are
+    asked for, the rarest first, to the neighbors that announced they have
+    them, the peer the file was announced by is only asked for the chunks
+    nobody else has
+
+    The manifest is asked for a page at a time to the peer the file was
+    announced by and the chunks are asked for a page at a time too, so only
+    their hashes are kept for the whole file
+    """
+    local_id: int
+    filename: str
+    fd: int
+    disk: workers.Serial
+    tmp_fd: int
+    tmp_path: Optional[str]
+    dest: Optional[str]
+    rejected: bool
+    complete: bool
+    key: Optional[tuple[int, int]]
+    hashes: bytearray
+    count: int
+    next: int
+    paging: Optional[float]
+    waiting: list[tuple[Connection, int]]
+    chunk_size: int
+    missing: dict[bytes, list[int]]
+    queued: dict[bytes, None]
+    requested: dict[bytes, Connection]
+    holders: dict[bytes, set[int]]
+    progress: float
+
+    def __init__(self, local_id: int, filename: str, fd: int):
+        self.local_id = local_id
+        self.filename = filename
+        # The connection the file was announced by
+        self.fd = fd
+        # The disk work of a download runs in order
+        self.disk = workers.Serial()
+        self.tmp_fd = -1
+        self.tmp_path = None
+        self.dest = None
+        self.rejected = False
+        self.complete = False
+        self.key = None
+        # The hashes of the chunks one after the other as the pages of the
+        # manifest arrive, the amount of chunks of the file, the first one
+        # not added to the missing ones yet, when the next page was asked
+        # for and the neighbors that asked us for a page we don't have yet
+        self.hashes = bytearray()
+        self.count = 0
+        self.next = 0
+        self.paging = None
+        self.waiting = []
+        self.chunk_size = CHUNK_SIZE
+        # The offsets of the chunks not written yet by their hash, the ones
+        # not asked for yet and the ones on their way with who was asked
+        self.missing = {}
+        self.queued = {}
+        self.requested = {}
+        # The neighbors that have every missing chunk
+        self.holders = {}
+        self.progress = time.monotonic()
+
+        self.disk.run(self.open_tmp, self.disk_done)
+
+    def open_tmp(self):
+        self.tmp_fd, self.tmp_path = tempfile.mkstemp(
+            prefix="peer-",
+            suffix=".part"
+        )
+
+    def start(
+            self,
+            key: tuple[int, int],
+            size: int,
+            hashes: list[bytes],
+            chunk_size: int,
+            conns: PeerTable
+    ) -> int:
+        """
+        Starts receiving the chunks of a manifest with its first page of
+        hashes, returns how many of them were here already
+        """
+        self.key = key
+        self.count = -(-size // chunk_size)
+        self.chunk_size = chunk_size
+        downloads[key] = self
+        manifests[key] = self.hashes
+        if len(manifests) > MANIFEST_CACHE:
+            manifests.popitem(last=False)
+
+        for digest in hashes:
+            self.hashes += digest
+        found = self.fill()
+        self.ask_page(conns)
+
+        if self.finished():
+            self.forget()
+            self.end()
+        return found
+
+    def digest(self, index: int) -> bytes:
+        return bytes(self.hashes[index * HASH_SIZE:(index + 1) * HASH_SIZE])
+
+    def known(self) -> int:
+        """
+        Returns the amount of hashes of the manifest received
+        """
+        return len(self.hashes) // HASH_SIZE
+
+    def finished(self) -> bool:
+        return not self.missing and self.next == self.count
+
+    def fill(self) -> int:
+        """
+        Adds the chunks of the next page to the missing ones once less than
+        half a page of them are, the ones we have are copied from the store
+        or the files we sent, returns how many of them were there
+        """
+        if len(self.missing) > MANIFEST_PAGE // 2:
+            return 0
+
+        found = 0
+        known = self.known()
+        while self.next < known and len(self.missing) < MANIFEST_PAGE:
+            digest = self.digest(self.next)
+            offset = self.next * self.chunk_size
+            self.next += 1
+            if digest in self.missing:
+                self.missing[digest].append(offset)
+                continue
+
+            self.missing[digest] = [offset]
+            wanted.setdefault(digest, set()).add(self)
+            source = chunk_reader(digest)
+            if source is None:
+                self.queued[digest] = None
+                continue
+            found += 1
+            read, release = source
+            self.disk.run(
+                read,
+                lambda data, error, digest=digest, release=release:
+                    self.copied(digest, data, error, release)
+            )
+        return found
+
+    def copied(
             self,
-            peer_id: PeerId,
-            in_sock: socket = None,
-            out_sock: socket = None
+            digest: bytes,
+            data: Optional[bytes],
+            error: Optional[BaseException],
+            release: Callable[[], None]
     ):
         """
-        Create a peer given the peer_id
+        Handles a chunk we had as received, it is asked for to the other
+        peers if it couldn't be read
         """
-        self.peer_id = peer_id
+        release()
+        if error is not None:
+            store.forget(digest)
+            if digest in self.missing:
+                self.queued[digest] = None
+            return
+        self.receive(digest, data)
 
-        if in_sock is not None:
-            self.in_sock = in_sock
-        if out_sock is not None:
-            self.out_sock = out_sock
+    def ask_page(self, conns: PeerTable):
+        """
+        Asks for the next page of the manifest to the peer the file was
+        announced by, they are asked for one after the other until the
+        whole manifest is here
+        """
+        first = self.known()
+        conn = conns.get(self.fd)
+        if first == self.count or conn is None:
+            self.paging = None
+            return
 
-    def __hash__(self):
-        return self.peer_id.__hash__()
+        wire_msg = msgs_capnp.PeerMsg.new_message()
+        wire_msg.type = "hashRequest"
+        request = wire_msg.content.init('hashRequest')
+        request.fileOrigin, request.transferId = self.key
+        request.first = first
+        conn.send_msg(encode_msg(wire_msg))
+        self.paging = time.monotonic()
+
+    def add_page(self, first: int, hashes: list[bytes], conns: PeerTable):
+        """
+        Adds a page of the manifest, the neighbors that were waiting for it
+        get it too
+        """
+        if first != self.known() or not hashes or \
+                len(hashes) > self.count - first or \
+                any(len(digest) != HASH_SIZE for digest in hashes):
+            return
+        for digest in hashes:
+            self.hashes += digest
+        self.progress = time.monotonic()
+        self.fill()
+        self.ask_page(conns)
+
+        waiting = self.waiting
+        self.waiting = []
+        for conn, start in waiting:
+            if conns.get(conn.sock.fileno()) is conn:
+                send_page(conn, self.key, start)
+
+    def request_more(self, conns: PeerTable):
+        """
+        Asks for the missing chunks while there is room in the window, the
+        ones fewer neighbors have go first
+        """
+        # Without the overlay nobody depends on the chunks we receive
+        if self.rejected and not neighbors:
+            self.forget()
+            return
 
-    def __repr__(self):
-        return f"Peer(id: {self.peer_id.__hash__()})"
+        room = REQUEST_WINDOW - len(self.requested)
+        if room <= 0 or not self.queued:
+            return
+
+        # Ties are broken at random so every peer starts by a different
+        # chunk and they can trade them afterwards
+        order = sorted(
+            self.queued,
+            key=lambda d: (len(self.holders.get(d, ())), random.random())
+        )
+        batches: dict[Connection, list[bytes]] = {}
+        for digest in order:
+            if room == 0:
+                break
+            conn = self.source(digest, conns)
+            if conn is None:
+                continue
+            conn.asked += 1
+            room -= 1
+            del self.queued[digest]
+            self.requested[digest] = conn
+            batches.setdefault(conn, []).append(digest)
+
+        for conn, digests in batches.items():
+            wire_msg = msgs_capnp.PeerMsg.new_message()
+            wire_msg.type = "chunkRequest"
+            wire_msg.content.init('chunkRequest').hashes = digests
+            conn.send_msg(encode_msg(wire_msg))
+
+    def source(
+            self,
+            digest: bytes,
+            conns: PeerTable
+    ) -> Optional[Connection]:
+        """
+        Returns the least busy neighbor that has a chunk and can be asked for
+        more, the peer the file was announced by has it or will have it
+        """
+        best = None
+        for fd in self.holders.get(digest, ()):
+            conn = conns.get(fd)
+            if conn is not None and conn.asked < PEER_REQUESTS and \
+                    (best is None or conn.asked < best.asked):
+                best = conn
+        if best is None:
+            conn = conns.get(self.fd)
+            if conn is not None and conn.asked < PEER_REQUESTS:
+                best = conn
+        return best
+
+    def has(self, conn: Connection, indexes: list[int]):
+        """
+        Remembers that a neighbor has some chunks of the file
+        """
+        known = self.known()
+        for index in indexes:
+            if index >= known:
+                continue
+            digest = self.digest(index)
+            if digest in self.missing:
+                self.holders.setdefault(digest, set()).add(conn.sock.fileno())
+
+    def receive(self, digest: bytes, data: bytes):
+        """
+        Handles a chunk of the file
+        """
+        offsets = self.missing.pop(digest, None)
+        if offsets is None:
+            return
+        self.unwant(digest)
+        self.queued.pop(digest, None)
+        self.holders.pop(digest, None)
+        conn = self.requested.pop(digest, None)
+        if conn is not None:
+            conn.asked -= 1
+        self.progress = time.monotonic()
+
+        # Tell the neighbors we can give it to them
+        if swarm:
+            haves.setdefault(self.key, []).extend(
+                offset // self.chunk_size for offset in offsets
+            )
+
+        for offset in offsets:
+            self.write(data, offset)
+        self.fill()
+        if self.finished():
+            self.forget()
+            if not self.rejected:
+                self.end()
+
+    def stalled(self, conns: PeerTable):
+        """
+        Asks again for the chunks and the page of the manifest that didn't
+        arrive, the peer the file was announced by is replaced by another
+        neighbor if it is gone or didn't send the page
+        """
+        for digest, conn in self.requested.items():
+            conn.asked -= 1
+            self.queued[digest] = None
+            # It may have evicted the chunk from its store, the peer the
+            # file was announced by is asked instead
+            holders = self.holders.get(digest)
+            if holders is not None and conn.sock.fileno() != self.fd:
+                holders.discard(conn.sock.fileno())
+        self.requested.clear()
+        self.progress = time.monotonic()
+
+        if self.fd not in conns or self.paging is not None:
+            # Without the overlay only the peer that sent the file is sure to
+            # have all of it
+            if self.fd not in conns and not neighbors and (
+                    self.next < self.count or
+                    any(not self.holders.get(d) for d in self.missing)
+            ):
+                self.interrupt()
+                return
+            others = [fd for fd, c in conns.items() if c.port is not None]
+            if not others:
+                return
+            self.fd = random.choice(others)
+            if self.paging is not None:
+                self.ask_page(conns)
+
+        self.request_more(conns)
+
+    def lost(self, conn: Connection, fd: int, conns: PeerTable):
+        """
+        Forgets a neighbor that left, the chunks asked to it are asked for
+        to the others
+        """
+        for holders in self.holders.values():
+            holders.discard(fd)
+        for digest in [d for d, c in self.requested.items() if c is conn]:
+            del self.requested[digest]
+            self.queued[digest] = None
+
+        if fd == self.fd:
+            self.stalled(conns)
+        else:
+            self.request_more(conns)
+
+    def unwant(self, digest: bytes):
+        waiting = wanted.get(digest)
+        if waiting is not None:
+            waiting.discard(self)
+            if not waiting:
+                del wanted[digest]
+
+    def forget(self):
+        """
+        Stops waiting for the chunks of the file
+        """
+        downloads.pop(self.key, None)
+        for digest in self.missing:
+            self.unwant(digest)
+
+    def interrupt(self):
+        """
+        Drops the file when the peer it came from is gone
+        """
+        self.forget()
+        if not self.rejected:
+            print(f"[x] Transfer of \"{self.filename}\" interrupted")
+            self.discard()
+
+    def write(self, data: bytes, offset: int):
+        """
+        Queues a chunk to be written at its offset
+        """
+        global disk_backlog
 
-    def send_msg(self):
-        pass
+        if self.rejected:
+            return
+        disk_backlog += len(data)
+
+        def written(_, error: Optional[BaseException]):
+            global disk_backlog
+            disk_backlog -= len(data)
+            self.disk_done(_, error)
+
+        self.disk.run(lambda: os.pwrite(self.tmp_fd, data, offset), written)
+
+    def end(self):
+        """
+        Closes the temporary file once every chunk is written
+        """
+        def finished(_, error: Optional[BaseException]):
+            if self.disk_done(_, error):
+                self.complete = True
+                store_file(self)
+
+        self.disk.run(lambda: os.close(self.tmp_fd), finished)
+
+    def discard(self):
+        """
+        Drops the file and everything received of it
+        """
+        self.rejected = True
+        pending_files.pop(self.local_id, None)
+
+        def remove():
+            try:
+                os.close(self.tmp_fd)
+            except OSError:
+                pass
+            if self.tmp_path is not None:
+                os.unlink(self.tmp_path)
+
+        self.disk.run(remove)
+
+    def disk_done(self, _, error: Optional[BaseException]) -> bool:
+        """
+        Reports the errors of the disk work, returns True if it succeeded
+        """
+        if error is None:
+            return True
+        if not self.rejected:
+            print(f"[x] Error while writing \"{self.filename}\": {error}")
+            self.discard()
+        return False
+
+
+# Files sent by transfer id, every chunk of them by its hash is read from
+# the file and offset it was last found at
+uploads: dict[int, Upload] = {}
+sent_chunks: dict[bytes, tuple[Upload, int]] = {}
+# The hashes of the chunks of the files received, by origin and transfer
+# id, in least recently used order
+manifests: OrderedDict = OrderedDict()
+# Files being received, by origin and transfer id, and the ones waiting for
+# every missing chunk by its hash
+downloads: dict[tuple[int, int], Download] = {}
+wanted: dict[bytes, set[Download]] = {}
+# Indexes of the chunks received since the neighbors were last told, by
+# origin and transfer id of their file
+haves: dict[tuple[int, int], list[int]] = {}
+# Files waiting for the user to accept or reject them, by their local id
+pending_files: dict[int, Download] = {}
 
 
 class Server:
     """
-    A server object connection
+    A server object connection, when there are several instances of the
+    server it moves to the next one if the current one goes down
     """
     sock: socket
-    buff: bytearray
-
-    def __init__(self, addr: str, port: str):
-        self.buff = bytearray(0)
-        try:
-            self.sock = create_connection((addr, int(port)))
-        except ValueError as e:
-            print(f"[x] Error while trying to parse arguments: {e}")
-            sys.exit(EXIT_ERR)
-        except OSError as e:
-            print(f"[x] Error while trying to connect to server: {e.strerror}")
+    decoder: FrameDecoder
+    known: dict[int, tuple[str, int]]
+    paths: dict[int, str]
+    addrs: list[tuple[str, int]]
+    connected: bool
+    resync: bool
+    next_heartbeat: float
+    unsent: bytes
+
+    def __init__(self, addrs: list[tuple[str, int]]):
+        self.decoder = FrameDecoder()
+        self.connected = True
+        # Whether the next peer list replaces the known peers, after moving
+        # to another instance
+        self.resync = False
+        self.next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+        # The part of the last heartbeat that didn't fit in the socket
+        self.unsent = b''
+        # Every peer in the network by its id, kept up to date with the
+        # changes the server announces
+        self.known = {}
+        # The unix sockets of the known peers that run on this host
+        self.paths = {}
+        # Start by a random instance so the peers spread between them, the
+        # first one is always the current one
+        start = random.randrange(len(addrs))
+        self.addrs = addrs[start:] + addrs[:start]
+        if not self.connect():
+            print("[x] Error while trying to connect to server")
             sys.exit(EXIT_ERR)
 
+    def connect(self) -> bool:
+        """
+        Connects to the first instance that accepts the connection
+        """
+        global local_host
+
+        for _ in range(len(self.addrs)):
+            addr = self.addrs[0]
+            try:
+                self.sock = create_connection(addr, CONNECT_TIMEOUT)
+                self.sock.settimeout(None)
+                local_host = self.sock.getsockname()[0]
+                return True
+            except OSError as e:
+                print(f"[-] Cannot connect to server {addr[0]}:{addr[1]}, "
+                      f"{e.strerror}")
+                self.addrs.append(self.addrs.pop(0))
+        return False
+
+    def failover(self):
+        """
+        Moves to the next instance of the server and registers again there
+        """
+        self.addrs.append(self.addrs.pop(0))
+        if not self.connect():
+            print("[x] No server is reachable")
+            self.connected = False
+            return
+        addr = self.addrs[0]
+        print(f"[i] Moved to the server at {addr[0]}:{addr[1]}")
+        self.decoder = FrameDecoder()
+        self.unsent = b''
+        self.resync = True
+        self.send_port()
+        self.watch()
+
     def send_port(self):
         """
         Once connected to the server, advertise which port this peer is
         listening on
         """
-        global incoming_port
-
         port_msg = msgs_capnp.PeerListeningPort.new_message()
         port_msg.port = incoming_port
-        self.sock.send(port_msg.to_bytes())
+        if unix_path is not None:
+            port_msg.hostId = localsock.HOST_ID
+            port_msg.unixPath = unix_path
+        self.sock.sendall(frame(encode_msg(port_msg)))
 
-    def get_peers(self) -> dict[int, Peer]:
+    def get_peers(self, limit: int = 0) -> list[tuple[str, int]]:
         """
         Once connected to the server, get the connected peers and connect to
-        them
+        them, or to a random sample of them if there is a limit
         """
-        # The first message received is a 4 bytes tag containing the size of
-        # the message
-        msg = self.sock.recv(4)
-        if len(msg) == 0:
-            print("[x] Connection unexpectedly died")
+        # The first message received is the list of peers
+        try:
+            msgs = recv_frames(self.sock, self.decoder)
+        except (OSError, ValueError) as e:
+            print(f"[x] Error while reading the peer list: {e}")
             exit(EXIT_ERR)
 
-        # Count and size are declared here for clarity
-        #
-        # The size is the size received
-        # The count is the bytes received afterwards, used to check if the
-        # received message is complete
-        count = 0
-        size = 0
+        if not msgs:
+            print("[x] Connection unexpectedly died")
+            exit(EXIT_ERR)
 
+        # Deserialize the message and pick the peers to connect to
         try:
-            size = int.from_bytes(msg, byteorder='big', signed=False)
-        except ValueError as e:
-            print(f"[x] Error while reading size, corrupted message {e}")
+            addrs = decode_msg(msgs_capnp.ServerRpcMsg, msgs[0])
+            self.update(addrs)
+            for msg in msgs[1:]:
+                self.update(decode_msg(msgs_capnp.ServerRpcMsg, msg))
+            chosen = [addr_tuple(addr) for addr in addrs.addrs]
+        except Exception:
+            print("[x] The server sent an invalid peer list")
+            exit(EXIT_ERR)
 
-        while count != size:
-            msg = self.sock.recv(4096)
-            count += len(msg)
-            if len(msg) == 0:
-                break
-            else:
-                self.buff += msg
+        if limit:
+            chosen = random.sample(chosen, min(limit, len(chosen)))
+        return chosen
 
-        # If we received less bytes than the server said it was going to send,
-        # we assume that the connection was aborted and terminate
-        if count != size:
-            print("[x] Connection unexpectedly died")
-            exit(EXIT_ERR)
+    def watch(self):
+        """
+        Registers the server connection in the event loop to receive the
+        changes in the peer list
+        """
+        self.sock.setblocking(False)
+        sel.register(self.sock, selectors.EVENT_READ, self)
 
-        sockets: dict[int, Peer] = {}
+    def handle_msg(self):
+        """
+        Reads the changes in the peer list sent by the server
+        """
+        try:
+            data = self.sock.recv(RECV_SIZE)
+            msgs = self.decoder.feed(data)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, ValueError):
+            data = b''
 
-        # Deserialize the message and connect to the peers sent by the server
-        addrs = msgs_capnp.ServerRpcMsg.from_bytes(self.buff)
+        if len(data) == 0:
+            print("[x] Lost connection to the server")
+            self.reconnect()
+            return
 
-        # Craft port message to advertise to peers
-        port_msg = msgs_capnp.PeerListeningPort.new_message()
-        port_msg.port = incoming_port
-        wire_msg = port_msg.to_bytes()
-        for addr in addrs.addrs:
-            host = ipaddress.IPv4Address(addr.ip).exploded
-            port = addr.port
+        for msg in msgs:
+            if self.resync:
+                # The first message is the whole peer list
+                self.known = {}
+                self.paths = {}
+                self.resync = False
+            try:
+                self.update(decode_msg(msgs_capnp.ServerRpcMsg, msg))
+            except Exception:
+                print("[x] The server sent an invalid peer list")
+                self.reconnect()
+                return
 
-            peer_id_host = addr.ip.to_bytes(4, byteorder='big', signed=False)
-            peer_id_port = addr.port.to_bytes(2, byteorder='big', signed=False)
-            peer_id = PeerId(peer_id_host, peer_id_port)
+    def reconnect(self):
+        """
+        Drops the connection to the server and moves to the next instance
+        """
+        sel.unregister(self.sock)
+        self.sock.close()
+        self.failover()
 
-            print(f"[i] Connecting to {host}:{port}")
+    def heartbeat(self) -> Optional[float]:
+        """
+        Sends an empty frame to the server if it is time to tell it we are
+        alive, returns the seconds until the next one
+        """
+        if not self.connected:
+            return None
+        now = time.monotonic()
+        if now >= self.next_heartbeat:
+            # Finish the previous one first if it was cut
+            data = self.unsent or frame(b'')
             try:
-                conn = create_connection((host, port))
-                conn.send(wire_msg)
-                sockets[conn.fileno()] = Peer(peer_id, out_sock=conn)
-            except OSError as e:
-                print(
-                    f"[-] Error: Cannot connect to {host}:{port}, {e.strerror}"
-                )
+                self.unsent = data[self.sock.send(data):]
+            except (BlockingIOError, InterruptedError):
+                self.unsent = data
+            except OSError:
+                # The disconnection is handled when reading from it
+                pass
+            self.next_heartbeat = now + HEARTBEAT_INTERVAL
+        return self.next_heartbeat - now
+
+    def update(self, msg):
+        """
+        Applies a peer list or a change in it to the known peers, the server
+        announces the peers that joined to all of them so we skip ourselves
+        """
+        local_id = peer_key(local_host, incoming_port)
+        for addr in list(msg.addrs) + list(msg.joined):
+            key = addr.ip << 16 | addr.port
+            if key == local_id:
+                continue
+            self.known[key] = addr_tuple(addr)
+            if addr.unixPath and addr.hostId == localsock.HOST_ID:
+                self.paths[key] = addr.unixPath
+        for addr in msg.left:
+            key = addr.ip << 16 | addr.port
+            self.known.pop(key, None)
+            self.paths.pop(key, None)
+
+
+def hello_msg() -> bytes:
+    """
+    Returns the first message sent through every peer connection, it tells
+    the port this peer is listening on and the codecs it supports
+    """
+    port_msg = msgs_capnp.PeerListeningPort.new_message()
+    port_msg.port = incoming_port
+    port_msg.codecs = local_codecs
+    return encode_msg(port_msg)
+
+
+def addr_tuple(addr) -> tuple[str, int]:
+    """
+    Converts a PeerAddr struct into a host and port tuple
+    """
+    return (ipaddress.IPv4Address(addr.ip).exploded, addr.port)
+
+
+def next_seq(amount: int = 1) -> int:
+    """
+    Reserves a range of sequence numbers and returns the first one
+    """
+    global seq
 
-        return sockets
+    first = seq + 1
+    seq += amount
+    return first
+
+
+def stamp(wire_msg, msg_seq: Optional[int] = None):
+    """
+    Tags a message created by this peer with its id
+    """
+    if msg_seq is None:
+        msg_seq = next_seq()
+    wire_msg.origin = node_id
+    wire_msg.seq = msg_seq
+    # Our own messages may come back through other neighbors
+    mark_seen(node_id, msg_seq)
+
+
+def mark_seen(origin: int, msg_seq: int) -> bool:
+    """
+    Remembers a message id, returns False if it was already seen
+    """
+    key = (origin, msg_seq)
+    if key in seen:
+        seen.move_to_end(key)
+        return False
+
+    seen[key] = None
+    if len(seen) > SEEN_CACHE_SIZE:
+        seen.popitem(last=False)
+    return True
 
 
 def handle_conn(
         sock: socket,
-        select_map: dict[int, socket]
+        conns: PeerTable
 ):
     """
-    Handles a new connection, registering its socket and creating its
-    corresponding outbound connection if it doesn't exist
+    Handles a new connection, registering its socket, the port it listens on
+    is read as its first message by the event loop
     """
-    global incoming_port
-    global counter
+    # In the overlay the amount of neighbors that connect to us is bounded
+    inbound = sum(1 for c in conns.values() if not c.outbound)
+    if neighbors and inbound >= 2 * neighbors:
+        print("[-] Too many neighbors, rejecting the connection")
+        sock.close()
+        return
 
-    msg = sock.recv(4096)
+    conn = Connection(sock)
+    print(f"[i] + {conn} Connected")
+    conns.add(conn)
+    # Greet it before anything else is queued on the connection
+    conn.send_msg(hello_msg())
 
-    if msg == "":
-        print("[x] Error while reading from new connection")
+
+def connect_peer(
+        host: str,
+        port: int,
+        conns: PeerTable,
+        path: Optional[str] = None
+) -> bool:
+    """
+    Starts opening a connection to a peer without blocking, through its unix
+    socket if it runs on this host, unless we are connected or connecting to
+    it already, returns whether it is in progress
+    """
+    peer_id = peer_key(host, port)
+    if peer_id in conns.by_id or peer_id in dialer:
+        return False
+    print(f"[i] Connecting to {host}:{port}" + (" (unix)" if path else ""))
+    return dialer.dial(host, port, path)
+
+
+def handle_dial(dial: Dial, conns: PeerTable):
+    """
+    Registers a connection to a peer once it is accepted and advertises our
+    port to it
+    """
+    sock = dialer.done(dial)
+    if sock is None:
+        return
+    try:
+        conn = Connection(sock, dial.port, dial.host)
+    except OSError as e:
+        # It may have been reset already
+        print(f"[-] Error: Cannot connect to {dial}, {e.strerror}")
+        sock.close()
         return
 
-    select_map[sock.fileno()] = sock
+    print(f"[i] + {conn} Connected")
+    conn.send_msg(hello_msg())
+    duplicate = conns.add(conn)
+    if duplicate is not None:
+        close_conn(duplicate, conns)
+
+
+def fill_neighbors(server: Server, conns: PeerTable) -> bool:
+    """
+    Connects to random known peers until the overlay has enough neighbors,
+    returns False if it is still missing some
+    """
+    # The connections in progress are counted as neighbors already
+    outbound = sum(1 for c in conns.values() if c.outbound)
+    outbound += dialer.connecting()
+    if outbound >= neighbors:
+        return True
+
+    local_id = peer_key(local_host, incoming_port)
+    candidates = [
+        (key, a) for key, a in server.known.items()
+        if key not in conns.by_id and key != local_id
+    ]
+    random.shuffle(candidates)
+
+    for key, (host, port) in candidates:
+        if outbound >= neighbors:
+            break
+        if connect_peer(host, port, conns, server.paths.get(key)):
+            outbound += 1
+
+    return outbound >= neighbors
+
+
+def close_conn(
+        conn: Connection,
+        conns: PeerTable
+):
+    """
+    Unregisters a peer connection and drops the transfers going through it
+    """
+    fd = conn.sock.fileno()
+    conns.remove(conn)
+    conn.close()
+    print(f"[i] - {conn} Disconnected")
+
+    # The rest of the files may come through the other neighbors
+    for download in list(downloads.values()):
+        download.lost(conn, fd, conns)
 
 
 def handle_msg(
-        sock: socket,
-        select_map: dict[int, socket]
+        conn: Connection,
+        conns: PeerTable
 ):
     """
-    Handles peer messages, either unregistering peers or printing its content
+    Handles peer messages, either unregistering peers or dispatching its
+    content
     """
-    # Read the first 4096 bytes that tell us the size of the message
-    msg_size = sock.recv(4096)
-    if len(msg_size) == 0:
-        host, port = sock.getpeername()
-        del select_map[sock.fileno()]
-        print(f"[i] - {host}:{port} Disconnected")
+    try:
+        data = conn.sock.recv(RECV_SIZE)
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError:
+        data = b''
+
+    if len(data) == 0:
+        close_conn(conn, conns)
         return
+
     try:
-        length = int.from_bytes(msg_size, byteorder='big', signed=False)
+        frames = conn.decoder.feed_raw(data)
     except ValueError as e:
-        print(f"[x] Error {e} while reading msg size")
+        print(f"[x] Error {e} while reading msg from {conn}")
+        close_conn(conn, conns)
         return
 
-    # Initialize received to 0 to keep count of the bytes received
-    received = 0
-    # Initialize the buffer where we are going to save the message
-    msg = bytearray()
-
-    # Set timeout on socket just in case
-    sock.settimeout(0.75)
-
-    # Get the message or abort if nothing is received
-    while received < length:
-        new = sock.recv(4096)
-        if len(new) == 0:
-            host, port = sock.getpeername()
-            del select_map[sock.fileno()]
-            print(f"[i] - {host}:{port} Disconnected")
+    for codec, payload in frames:
+        try:
+            msg = payload
+            if codec != compression.NONE:
+                msg = compression.decompress(codec, payload)
+        except ValueError as e:
+            print(f"[x] Error {e} while reading msg from {conn}")
+            close_conn(conn, conns)
+            return
+
+        # Deserialize msg
+        if conn.codecs is None:
+            # The first message of a connection is the hello of the other
+            # peer, for incoming connections it has the port it listens on
+            try:
+                port_msg = decode_msg(msgs_capnp.PeerListeningPort, msg)
+                codecs = set(port_msg.codecs)
+            except Exception:
+                print(f"[x] {conn} sent an invalid hello")
+                close_conn(conn, conns)
+                return
+            conn.codecs = codecs
+            if conn.port is None:
+                conn.port = port_msg.port
+                # Both peers may have connected to each other at once
+                duplicate = conns.identify(conn)
+                if duplicate is not None:
+                    print(f"[i] Dropping a duplicate connection to {conn}")
+                    close_conn(duplicate, conns)
+                    if duplicate is conn:
+                        return
+            continue
+        try:
+            struct_msg = decode_msg(msgs_capnp.PeerMsg, msg)
+            msg_type = struct_msg.type
+        except Exception:
+            print(f"[x] {conn} sent an invalid message")
+            close_conn(conn, conns)
             return
-        else:
-            msg += new
-            received += len(new)
 
-    # Clear the timeout
-    sock.settimeout(0)
+        # Chunks and the requests for them only go between neighbors
+        if msg_type in ("chunkRequest", "chunkData", "chunkHave",
+                        "hashRequest", "hashPage"):
+            handle_peer_msg(conn, conns, struct_msg)
+            continue
 
-    # Deserialize msg
-    struct_msg = msgs_capnp.PeerMsg.from_bytes(msg)
+        # Drop the messages that already arrived through another neighbor
+        # and relay the new ones to the rest
+        if not mark_seen(struct_msg.origin, struct_msg.seq):
+            continue
+        if neighbors:
+            relay(conn, conns, msg, (codec, payload))
 
+        handle_peer_msg(conn, conns, struct_msg)
+
+
+def relay(
+        conn: Connection,
+        conns: PeerTable,
+        msg: bytes,
+        compressed: tuple[int, bytes]
+):
+    """
+    Forwards a message as it arrived to the rest of the neighbors, the ones
+    over the high water mark don't get it or are disconnected, depending on
+    the slow consumer policy
+    """
+    for other in list(conns.values()):
+        if other is conn or other.port is None:
+            continue
+        if other.queued + len(msg) > high_water:
+            if policy == POLICY_DISCONNECT:
+                print(f"[x] {other} is too slow, disconnecting")
+                close_conn(other, conns)
+            # It may still get the message through another neighbor
+            continue
+        other.send_msg(msg, compressed)
+
+
+def handle_peer_msg(
+        conn: Connection,
+        conns: PeerTable,
+        struct_msg
+):
+    """
+    Acts on a single message received from a peer
+    """
     # Handle text message
     if struct_msg.type == "text":
         print(struct_msg.content.text)
@@ -246,40 +1509,147 @@ def handle_msg(
         filename = struct_msg.content.file.filename
         file_content = struct_msg.content.file.content
 
-        # Ask for permission to store file
-        print(
-            f"[?] File \"{filename}\" received," +
-            " do you want to save it? (y/n): ",
-            end=''
+        download = offer_file(conn, filename, len(file_content))
+        download.write(file_content, 0)
+        download.end()
+    # Handle the announce of a file, only the chunks we don't have are asked
+    # for
+    elif struct_msg.type == "fileManifest":
+        manifest = struct_msg.content.fileManifest
+        hashes = [bytes(h) for h in manifest.hashes]
+        chunk_size = manifest.chunkSize
+        if chunk_size == 0 or \
+                len(hashes) > -(-manifest.size // chunk_size) or \
+                any(len(digest) != HASH_SIZE for digest in hashes):
+            print(f"[x] Invalid manifest of \"{manifest.filename}\"")
+            return
+
+        download = offer_file(conn, manifest.filename, manifest.size)
+        key = (struct_msg.origin, manifest.transferId)
+        found = download.start(
+            key, manifest.size, hashes, chunk_size, conns
         )
-        answer = input()
-        if answer == "y":
-            # Ask where to store the file
-            print("[?] What name do you want to give it?: ", end='')
-            filepath = input()
+        if found:
+            print(f"[i] {found} chunks of \"{manifest.filename}\" were " +
+                  "already here")
+        download.request_more(conns)
+    # Handle a neighbor asking for chunks, they are sent by pump_requests
+    elif struct_msg.type == "chunkRequest":
+        for digest in struct_msg.content.chunkRequest.hashes:
+            conn.requests[bytes(digest)] = None
+    # Handle a chunk, its hash tells which files it belongs to, anything we
+    # didn't ask for or corrupted doesn't match any
+    elif struct_msg.type == "chunkData":
+        data = struct_msg.content.chunkData.data
+        digest = chunk_hash(data)
+        receivers = wanted.get(digest)
+        if not receivers:
+            return
 
-            # Open and store file
-            try:
-                f = open(filepath, 'wb')
-                f.write(file_content)
-            except OSError as e:
-                print(f"[x] Error while writing to {e.strerror}")
-                return
+        store.put(digest, data)
+        for download in list(receivers):
+            download.receive(digest, data)
+            download.request_more(conns)
+    # Handle a neighbor telling which chunks of a file it can give us
+    elif struct_msg.type == "chunkHave":
+        have = struct_msg.content.chunkHave
+        download = downloads.get((have.fileOrigin, have.transferId))
+        if download is not None and swarm:
+            download.has(conn, list(have.indexes))
+            download.request_more(conns)
+    # Handle a neighbor asking for a page of a manifest
+    elif struct_msg.type == "hashRequest":
+        request = struct_msg.content.hashRequest
+        send_page(conn, (request.fileOrigin, request.transferId),
+                  request.first)
+    # Handle a page of a manifest we asked for, its chunks are asked for
+    # once the previous ones arrive
+    elif struct_msg.type == "hashPage":
+        page = struct_msg.content.hashPage
+        download = downloads.get((page.fileOrigin, page.transferId))
+        if download is not None:
+            download.add_page(
+                page.first, [bytes(h) for h in page.hashes], conns
+            )
+            download.request_more(conns)
+
+
+def offer_file(conn: Connection, filename: str, size: int) -> Download:
+    """
+    Starts receiving a file and tells the user how to accept or reject it
+    """
+    global counter
 
-            print("[i] File written correctly")
+    counter += 1
+    download = Download(counter, filename, conn.sock.fileno())
+    pending_files[download.local_id] = download
+    print(
+        f"[?] File \"{filename}\" ({size} bytes) received from {conn}," +
+        f" save it with /accept {download.local_id} <path>" +
+        f" or drop it with /reject {download.local_id}"
+    )
+    return download
+
+
+def store_file(download: Download):
+    """
+    Moves a received file to where the user wants it once it is complete and
+    accepted
+    """
+    if not download.complete or download.dest is None or download.rejected:
+        return
+
+    pending_files.pop(download.local_id, None)
+    src, dest = download.tmp_path, download.dest
+
+    def stored(_, error: Optional[BaseException]):
+        if error is not None:
+            print(f"[x] Error while writing to {dest}: {error}")
+            download.discard()
+        else:
+            print(f"[i] File \"{dest}\" written correctly")
+
+    # The temporary file may be in another file system
+    download.disk.run(lambda: shutil.move(src, dest), stored)
+
+
+def handle_transfer_command(command: str, args: str):
+    """
+    Handles the commands that accept or reject the received files
+    """
+    local_id, _, path = args.partition(' ')
+    try:
+        download = pending_files[int(local_id)]
+    except (ValueError, KeyError):
+        print(f"[x] There is no pending file \"{local_id}\"")
+        return
+
+    if command == "accept":
+        if not path:
+            print("[x] Usage: /accept <id> <path>")
+            return
+        download.dest = path
+        print(f"[i] \"{download.filename}\" will be saved to {path}")
+        store_file(download)
+    else:
+        download.discard()
+        print(f"[i] \"{download.filename}\" rejected")
 
 
 def handle_stdin(
         s: io.TextIOWrapper,
-        select_map: dict[int, socket],
-        listening: int
+        conns: PeerTable
 ):
     """
     Handles stdin input and dispatches it to its corresponding function
     depending on the command
     """
+    global counter
+
     msg = s.readline()
     trimmed = msg.strip()
+    if not trimmed:
+        return
     command, args = input_parse(trimmed)
 
     # Text command is a simple message
@@ -288,17 +1658,25 @@ def handle_stdin(
         wire_msg = msgs_capnp.PeerMsg.new_message()
         wire_msg.type = "text"
         wire_msg.content.text = args
+        stamp(wire_msg)
 
-        # Serialize message
-        bytes_msg = wire_msg.to_bytes()
-        size = len(bytes_msg)
+        # Serialize message, it is compressed once for every peer
+        bytes_msg = encode_msg(wire_msg)
+        compressed = compression.compress_text(bytes_msg, local_codecs)
 
         # Broadcast the message
-        for p in select_map:
-            if p != 0 and p != listening:
-                sock = select_map[p]
-                sock.send(size.to_bytes(4096, byteorder='big', signed=False))
-                sock.send(bytes_msg)
+        for conn in conns.values():
+            conn.send_msg(bytes_msg, compressed)
+
+    # Accept or reject a received file
+    elif command in ("accept", "reject"):
+        handle_transfer_command(command, args)
+
+    # List the received files waiting for a decision
+    elif command == "pending":
+        for local_id, download in pending_files.items():
+            state = "complete" if download.complete else "receiving"
+            print(f"[i] {local_id}: \"{download.filename}\" ({state})")
 
     # File command is to send files
     elif command == "file":
@@ -309,28 +1687,323 @@ def handle_stdin(
             print(f"[x] Error while opening file \"{e.strerror}\"")
             return
 
-        # Read file content into variable
-        file_content = f.read()
+        counter += 1
+        upload = Upload(counter, args, f)
+
+        # The file is announced once the workers hash it
+        workers.run(
+            upload.hash_chunks,
+            lambda hashes, error: announce_file(upload, hashes, error, conns)
+        )
+
+
+def announce_file(
+        upload: Upload,
+        hashes: Optional[list[bytes]],
+        error: Optional[BaseException],
+        conns: PeerTable
+):
+    """
+    Sends the manifest of a file once its chunks are hashed, the peers ask
+    for the chunks they are missing afterwards
+    """
+    if error is not None:
+        print(f"[x] Error while reading \"{upload.filename}\": {error}")
+        upload.f.close()
+        return
+
+    upload.hashes = b''.join(hashes)
+    upload.used = time.monotonic()
+    uploads[upload.transfer_id] = upload
+    for i, digest in enumerate(hashes):
+        sent_chunks[digest] = (upload, i * CHUNK_SIZE)
+
+    # Craft the manifest
+    wire_msg = msgs_capnp.PeerMsg.new_message()
+    wire_msg.type = "fileManifest"
+    manifest = wire_msg.content.init('fileManifest')
+    manifest.transferId = upload.transfer_id
+    manifest.filename = upload.filename
+    manifest.size = upload.size
+    manifest.chunkSize = CHUNK_SIZE
+    # The rest of the pages are asked for by the peers
+    manifest.hashes = hashes[:MANIFEST_PAGE]
+    stamp(wire_msg)
+    bytes_msg = encode_msg(wire_msg)
+
+    # Broadcast the manifest
+    for conn in conns.values():
+        if conn.port is not None:
+            conn.send_msg(bytes_msg)
+
+    print(f"[i] Sending file \"{upload.filename}\"")
+
+
+def split_hashes(hashes: bytes) -> list[bytes]:
+    """
+    Splits the hashes of a manifest kept one after the other
+    """
+    return [
+        bytes(hashes[i:i + HASH_SIZE])
+        for i in range(0, len(hashes), HASH_SIZE)
+    ]
+
+
+def manifest_hashes(key: tuple[int, int]) -> Optional[bytes]:
+    """
+    Returns the hashes we have of the manifest of a file, None if we don't
+    know the file
+    """
+    origin, transfer_id = key
+    if origin == node_id:
+        upload = uploads.get(transfer_id)
+        if upload is None:
+            return None
+        upload.used = time.monotonic()
+        return upload.hashes
+
+    download = downloads.get(key)
+    if download is not None:
+        return download.hashes
+    hashes = manifests.get(key)
+    if hashes is not None:
+        manifests.move_to_end(key)
+    return hashes
+
+
+def send_page(conn: Connection, key: tuple[int, int], first: int):
+    """
+    Sends a neighbor the page of a manifest starting at the given chunk, if
+    the file is being received and the page didn't arrive yet it is sent
+    once it does
+    """
+    hashes = manifest_hashes(key)
+    if hashes is None or len(hashes) <= first * HASH_SIZE:
+        download = downloads.get(key)
+        if download is not None and first < download.count and \
+                (conn, first) not in download.waiting:
+            download.waiting.append((conn, first))
+        return
+
+    wire_msg = msgs_capnp.PeerMsg.new_message()
+    wire_msg.type = "hashPage"
+    page = wire_msg.content.init('hashPage')
+    page.fileOrigin, page.transferId = key
+    page.first = first
+    page.hashes = split_hashes(
+        hashes[first * HASH_SIZE:(first + MANIFEST_PAGE) * HASH_SIZE]
+    )
+    conn.send_msg(encode_msg(wire_msg))
+
+
+def expire_uploads() -> Optional[float]:
+    """
+    Stops sending the files nobody asked for in a while, returns the seconds
+    until the next one expires
+    """
+    if not uploads:
+        return None
+
+    now = time.monotonic()
+    for upload in list(uploads.values()):
+        if now - upload.used < UPLOAD_TIMEOUT:
+            continue
+        del uploads[upload.transfer_id]
+        upload.expire()
+        print(f"[i] Stopped sending file \"{upload.filename}\"")
+
+        gone = set()
+        for digest in split_hashes(upload.hashes):
+            sent = sent_chunks.get(digest)
+            if sent is not None and sent[0] is upload:
+                del sent_chunks[digest]
+                gone.add(digest)
+        # The chunks may be in other files we still send
+        if gone:
+            for other in uploads.values():
+                for i, digest in enumerate(split_hashes(other.hashes)):
+                    if digest in gone:
+                        sent_chunks.setdefault(digest, (other, i * CHUNK_SIZE))
+
+    if not uploads:
+        return None
+    return min(u.used for u in uploads.values()) + UPLOAD_TIMEOUT - now
+
+
+def encode_chunk(data: bytes, codec: int) -> tuple[bytes, tuple[int, bytes]]:
+    """
+    Encodes and compresses a chunk to be sent, it runs on a worker
+    """
+    wire_msg = msgs_capnp.PeerMsg.new_message()
+    wire_msg.type = "chunkData"
+    wire_msg.content.init('chunkData').data = data
+    plain = encode_msg(wire_msg)
+    return plain, compression.compress(plain, codec)
+
+
+def chunk_reader(
+        digest: bytes
+) -> Optional[tuple[Callable[[], bytes], Callable[[], None]]]:
+    """
+    Returns the function that reads a chunk we have and the one to call once
+    it was read, None if we don't have it
+    """
+    sent = sent_chunks.get(digest)
+    if sent is not None:
+        upload, offset = sent
+        return upload.reader(offset), upload.release
+    if digest in store:
+        return store.reader(digest), lambda: store.release(digest)
+    return None
+
+
+def chunk_source(
+        digest: bytes
+) -> Optional[tuple[Callable[[], tuple], Callable[[], None]]]:
+    """
+    Returns the function that reads and encodes a chunk and the one to call
+    once it was read, None if we don't have it
+    """
+    sent = sent_chunks.get(digest)
+    if sent is not None:
+        upload, offset = sent
+        return upload.loader(offset), upload.release
+    if digest in store:
+        read = store.reader(digest)
+        return (
+            lambda: encode_chunk(read(), bulk_codec),
+            lambda: store.release(digest)
+        )
+    return None
+
+
+def serve_requests(conn: Connection):
+    """
+    Sends the chunks a peer asked for while it has room in its queue, the
+    workers read a few of them ahead
+    """
+    requests = conn.requests
+    # They are sent as they are read, the other peer accepts them in any
+    # order
+    for digest in list(conn.loaded):
+        if conn.queued >= UPLOAD_WINDOW:
+            break
+        del requests[digest]
+        conn.send_msg(*conn.loaded.pop(digest))
+
+    # Read the next ones in the room left
+    room = READ_AHEAD + 1 - len(conn.loading) - len(conn.loaded)
+    for digest in list(requests):
+        if room <= 0:
+            break
+        if digest in conn.loading or digest in conn.loaded:
+            continue
+
+        source = chunk_source(digest)
+        if source is None:
+            # The chunks we are receiving are sent once they are stored
+            if digest not in wanted and digest not in store.writing:
+                del requests[digest]
+            continue
+
+        room -= 1
+        conn.loading.add(digest)
+        load, release = source
+        workers.run(
+            load,
+            lambda chunk, error, digest=digest, release=release:
+                chunk_loaded(conn, digest, chunk, error, release)
+        )
+
+
+def chunk_loaded(
+        conn: Connection,
+        digest: bytes,
+        chunk: Optional[tuple],
+        error: Optional[BaseException],
+        release: Callable[[], None]
+):
+    release()
+    conn.loading.discard(digest)
+    if error is not None:
+        # The other peer asks for it again when it notices
+        print(f"[x] Error while reading a chunk: {error}")
+        if digest not in sent_chunks:
+            store.forget(digest)
+        conn.requests.pop(digest, None)
+        return
+    if digest in conn.requests:
+        conn.loaded[digest] = chunk
+
 
-        # Craft message to be sent
+def announce_haves(conns: PeerTable):
+    """
+    Tells every neighbor the chunks received since the last time, it runs
+    once per iteration of the loop so they go together
+    """
+    if not haves:
+        return
+
+    msgs = []
+    for (origin, transfer_id), indexes in haves.items():
         wire_msg = msgs_capnp.PeerMsg.new_message()
-        wire_msg.type = "file"
-        wire_msg.content.init('file')
-        wire_msg.content.file.filename = args
-        wire_msg.content.file.content = file_content
+        wire_msg.type = "chunkHave"
+        have = wire_msg.content.init('chunkHave')
+        have.fileOrigin = origin
+        have.transferId = transfer_id
+        have.indexes = indexes
+        msgs.append(encode_msg(wire_msg))
+    haves.clear()
 
-        # Serialize message
-        bytes_msg = wire_msg.to_bytes()
-        size = len(bytes_msg)
+    for conn in conns.values():
+        if conn.port is not None:
+            for msg in msgs:
+                conn.send_msg(msg)
 
-        # Broadcast the message
-        for p in select_map:
-            if p != 0 and p != listening:
-                sock = select_map[p]
-                sock.send(size.to_bytes(4096, byteorder='big', signed=False))
-                sock.send(bytes_msg)
 
-        print("[i] File sent correctly")
+def pump_requests(conns: PeerTable):
+    """
+    Sends the chunks the peers asked for to every peer that has room in its
+    queue
+    """
+    for conn in conns.values():
+        if conn.requests:
+            serve_requests(conn)
+
+
+def check_stalled(conns: PeerTable):
+    """
+    Asks again for the chunks that didn't arrive in a while
+    """
+    now = time.monotonic()
+    for download in list(downloads.values()):
+        waiting = download.requested or download.queued or \
+            download.paging is not None
+        if waiting and now - download.progress > STALL_TIMEOUT:
+            download.stalled(conns)
+        elif download.queued and not download.requested:
+            # The chunks that couldn't be copied from the store
+            download.request_more(conns)
+
+
+def pause_reading(conns: PeerTable):
+    """
+    Stops reading from the peers while too much received data is waiting
+    for the disk and resumes once the workers catch up
+    """
+    global reading_paused
+
+    backlog = disk_backlog + store.pending
+    if reading_paused:
+        paused = backlog > DISK_WINDOW // 2
+    else:
+        paused = backlog > DISK_WINDOW
+    if paused == reading_paused:
+        return
+
+    reading_paused = paused
+    for conn in conns.values():
+        conn.pause(paused)
 
 
 def input_parse(text: str) -> tuple[str, str]:
@@ -357,10 +2030,97 @@ def input_parse(text: str) -> tuple[str, str]:
 
 def main():
     global incoming_port
+    global neighbors
+    global high_water
+    global policy
+    global local_codecs
+    global bulk_codec
+    global store
+    global swarm
+    global dialer
+    global unix_path
+
+    parser = ArgumentParser(description="Peer of the p2p chat")
+    parser.add_argument("host", help="address of the bootstrap server")
+    parser.add_argument("port", help="port of the bootstrap server")
+    parser.add_argument(
+        "--server",
+        action="append",
+        default=[],
+        metavar="HOST:PORT",
+        help="another instance of the bootstrap server, the peer spreads "
+             "between them and moves to another one if its own goes down"
+    )
+    parser.add_argument(
+        "--neighbors",
+        type=int,
+        default=0,
+        help="keep this many neighbors and gossip the messages through them "
+             "instead of connecting to every peer"
+    )
+    parser.add_argument(
+        "--high-water",
+        type=int,
+        default=DEFAULT_HIGH_WATER,
+        help="bytes of relayed messages that can be queued for a neighbor "
+             "before applying the slow consumer policy"
+    )
+    parser.add_argument(
+        "--policy",
+        choices=[POLICY_DROP, POLICY_DISCONNECT],
+        default=POLICY_DROP,
+        help="what to do with the neighbors over the high water mark"
+    )
+    parser.add_argument(
+        "--compression",
+        default=",".join(c.name for c in compression.CODECS.values()),
+        help="comma separated codecs offered to the other peers, the first "
+             "one is used for the files, \"none\" disables the compression"
+    )
+    parser.add_argument(
+        "--chunk-store",
+        default=os.path.join(tempfile.gettempdir(), "peer-chunks"),
+        help="directory where the received chunks are kept"
+    )
+    parser.add_argument(
+        "--chunk-store-size",
+        type=int,
+        default=DEFAULT_STORE_SIZE,
+        help="MiB kept in the chunk store"
+    )
+    parser.add_argument(
+        "--no-swarm",
+        action="store_true",
+        help="ask for the chunks of a file only to the neighbor that "
+             "announced it instead of to every neighbor that has them"
+    )
+    parser.add_argument(
+        "--unix",
+        action="store_true",
+        help="listen on a unix socket too, the peers on this host connect "
+             "through it instead of TCP"
+    )
+    args = parser.parse_args()
+    neighbors = max(0, args.neighbors)
+    swarm = not args.no_swarm
+    high_water = args.high_water
+    policy = args.policy
 
-    if len(sys.argv) != 3:
-        print(f"Usage:\n\t{sys.argv[0]} <host> <port>")
-        exit(1)
+    try:
+        store = ChunkStore(args.chunk_store, args.chunk_store_size << 20)
+    except OSError as e:
+        print(f"[x] Error while opening the chunk store: {e}")
+        sys.exit(EXIT_ERR)
+
+    if args.compression != "none":
+        try:
+            local_codecs = compression.by_names(args.compression.split(","))
+        except ValueError as e:
+            print(f"[x] Error while parsing the codecs: {e}")
+            sys.exit(EXIT_ERR)
+    else:
+        local_codecs = []
+    bulk_codec = compression.choose(local_codecs, local_codecs)
 
     # Bind to random socket and listen to incoming messages
     sock = socket(AF_INET, SOCK_STREAM)
@@ -369,36 +2129,122 @@ def main():
     sock.setblocking(False)
     incoming_port = sock.getsockname()[1]
 
+    # The unix socket is advertised to the server along with the port
+    unix_sock = None
+    if args.unix:
+        try:
+            unix_sock = localsock.listen(
+                localsock.default_path("peer", incoming_port), 8
+            )
+            unix_path = unix_sock.getsockname()
+        except OSError as e:
+            print(f"[-] Error: Cannot listen on a unix socket, {e.strerror}")
+
     # Connect to server
-    server = Server(sys.argv[1], sys.argv[2])
+    try:
+        server_addrs = [(args.host, int(args.port))]
+        for addr in args.server:
+            host, port = addr.rsplit(":", 1)
+            server_addrs.append((host, int(port)))
+    except ValueError as e:
+        print(f"[x] Error while trying to parse arguments: {e}")
+        sys.exit(EXIT_ERR)
+    server = Server(server_addrs)
     # Advertise port
     server.send_port()
     # Get peers
-    out_peers = server.get_peers()
+    out_peers = server.get_peers(neighbors)
+
+    # The connections to the other peers by socket identifier and peer id,
+    # they are all opened at once
+    conns = PeerTable()
+    dialer = Dialer()
+    for host, port in out_peers:
+        connect_peer(
+            host, port, conns, server.paths.get(peer_key(host, port))
+        )
 
-    # A hashmap from socketid to socket
-    select_map = {}
-    select_map[sock.fileno()] = sock
-    select_map |= map(lambda k: (k[0], k[1].out_sock), out_peers.items())
+    # Register the listening socket, the server connection and the workers,
+    # stdin waits for the connections to the peers
+    sel.register(sock, selectors.EVENT_READ, None)
+    if unix_sock is not None:
+        sel.register(unix_sock, selectors.EVENT_READ, None)
+    server.watch()
+    sel.register(workers.wakeup, selectors.EVENT_READ, workers)
+    reading_stdin = False
 
-    # Register stdin
-    select_map[stdin.fileno()] = stdin
+    # When the overlay is missing neighbors we wake up to look for more
+    fill_timeout = None
+    next_fill = 0.0
 
     while True:
-        selected, x, y = select(select_map, [], [])
-        for s in selected:
+        # Files being received also need to wake us up to notice when they
+        # stop arriving, and so do the heartbeats
+        timeout = fill_timeout
+        if downloads:
+            timeout = min(timeout or STALL_TIMEOUT, STALL_TIMEOUT)
+        until_expiry = expire_uploads()
+        if until_expiry is not None:
+            timeout = min(timeout or until_expiry, until_expiry)
+        until_heartbeat = server.heartbeat()
+        if until_heartbeat is not None:
+            timeout = min(timeout or until_heartbeat, until_heartbeat)
+        until_dial = dialer.timeout()
+        if until_dial is not None:
+            timeout = min(timeout or until_dial, until_dial)
+
+        # The messages typed are read once every first connection was
+        # accepted or failed, which takes one connect timeout at most
+        if not reading_stdin and not dialer.connecting():
+            sel.register(stdin, selectors.EVENT_READ, stdin)
+            reading_stdin = True
+
+        for key, mask in sel.select(timeout):
             # This means that a new client connected
-            if s == sock.fileno():
-                conn, (host, port) = sock.accept()
-                print(f"[i] + {host}:{port} Connected")
-                handle_conn(conn, select_map)
+            if key.data is None:
+                try:
+                    conn, _ = key.fileobj.accept()
+                except (BlockingIOError, InterruptedError):
+                    continue
+                handle_conn(conn, conns)
             # This means that the user input a message
-            elif s == stdin.fileno():
-                handle_stdin(stdin, select_map, sock.fileno())
-            # This means that a peer message was received
+            elif key.data is stdin:
+                handle_stdin(stdin, conns)
+            # This means that the server announced changes in the peer list
+            elif key.data is server:
+                server.handle_msg()
+            # This means that the workers finished some tasks
+            elif key.data is workers:
+                workers.process()
+            # This means that a connection to a peer was accepted or refused
+            elif isinstance(key.data, Dial):
+                handle_dial(key.data, conns)
+            # This means that a peer is ready
             else:
-                f = select_map[s]
-                handle_msg(f, select_map)
+                conn = key.data
+                # It may have been closed by a previous event
+                if conns.get(conn.sock.fileno()) is not conn:
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    conn.flush()
+                if mask & selectors.EVENT_READ:
+                    handle_msg(conn, conns)
+
+        # Give up on the connections not accepted in time and retry the
+        # failed ones
+        dialer.expire(server.known, conns.by_id)
+
+        # Keep the files flowing to the peers that have room for them
+        pump_requests(conns)
+        announce_haves(conns)
+        check_stalled(conns)
+        pause_reading(conns)
+
+        # Replace the neighbors that left
+        if neighbors and time.monotonic() >= next_fill:
+            filled = fill_neighbors(server, conns)
+            fill_timeout = None if filled else FILL_INTERVAL
+            next_fill = time.monotonic() + (0 if filled else FILL_INTERVAL)
 
 
 if __name__ == "__main__":
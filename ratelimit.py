@@ -0,0 +1,45 @@
+"""
+This module contains the token buckets that limit how fast the relay reads
+from every client, so a client flooding the relay can't take the time and the
+downstream bandwidth of the rest
+"""
+
+
+class TokenBucket:
+    """
+    Tokens refill at a constant rate up to the size of the burst and every
+    unit read takes one, the bucket may go into debt when more was read than
+    it had, which delays the next reads until the debt is paid
+    """
+    rate: float
+    burst: float
+    tokens: float
+    stamp: float
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def available(self, now: float) -> float:
+        """
+        Refills the bucket for the time elapsed and returns its tokens
+        """
+        if now > self.stamp:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.stamp) * self.rate
+            )
+            self.stamp = now
+        return self.tokens
+
+    def take(self, amount: float):
+        self.tokens -= amount
+
+    def ready_at(self, amount: float) -> float:
+        """
+        Returns when the bucket will have the given tokens, as of the last
+        refill
+        """
+        amount = min(amount, self.burst)
+        return self.stamp + max(0.0, amount - self.tokens) / self.rate
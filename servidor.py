@@ -1,9 +1,977 @@
-from select import select
-from socket import AF_INET, SOCK_STREAM, socket
-from sys import argv, exit, stderr
+import os
+import selectors
+import signal
+import time
+from argparse import ArgumentParser, Namespace
+from collections import deque
+from socket import (AF_INET, AF_UNIX, SO_REUSEPORT, SOCK_STREAM, SOL_SOCKET,
+                    socket, socketpair)
+from sys import exit, stderr
+from typing import Optional
 
+import channels
+import compression
+import localsock
+import msglog
+import workers
+from framing import FrameDecoder, flush_queue, frame
+from msglog import LogReader, MessageLog
+from ratelimit import TokenBucket
+from stats import Stats
+from timerwheel import TimerWheel
 
-def setup() -> socket:
+# Default amount of bytes that can be pending for a single client before the
+# slow consumer policy is applied
+DEFAULT_HIGH_WATER = 1 << 20
+
+# Slow consumer policies
+POLICY_DROP = "drop"
+POLICY_DISCONNECT = "disconnect"
+
+# Bytes read from a socket in a single call
+RECV_SIZE = 65536
+
+# Default amount of reads from a single client in an iteration, the clients
+# are read in turns so each one gets the same share of the iteration
+DEFAULT_READS_PER_TICK = 4
+# Default seconds of its rate a client can send at once
+DEFAULT_BURST = 1.0
+# Resolution of the timers that resume reading from the throttled clients
+THROTTLE_TICK = 0.01
+# Default hours the segments of the message log are kept
+DEFAULT_RETENTION_HOURS = 168
+
+# Selector data of the stats listener and of the wake ups of the threads
+STATS = "stats"
+WORKERS = "workers"
+
+# Payload bytes read from the log for a client catching up in an iteration
+CATCHUP_BYTES = 256 * 1024
+
+
+class Client:
+    """
+    A connected client with its queue of pending outbound data
+    """
+    sock: socket
+    addr: tuple[str, int]
+    queue: deque
+    queued: int
+    dropped: int
+    bus: bool
+    decoder: FrameDecoder
+    codecs: set[int]
+    channels: set[str]
+    topical: bool
+    topic_in: str
+    topic_out: Optional[str]
+    byte_bucket: Optional[TokenBucket]
+    msg_bucket: Optional[TokenBucket]
+    reading: bool
+    events: int
+    tracking: bool
+    log_id: int
+    reader: Optional[LogReader]
+
+    def __init__(
+            self,
+            sock: socket,
+            addr: tuple[str, int],
+            bus=False,
+            byte_bucket: Optional[TokenBucket] = None,
+            msg_bucket: Optional[TokenBucket] = None
+    ):
+        self.sock = sock
+        self.addr = addr
+        self.queue = deque()
+        self.queued = 0
+        self.dropped = 0
+        # Bus links connect this worker with the other workers, the data
+        # received through them is only delivered locally
+        self.bus = bus
+        self.decoder = FrameDecoder()
+        # The codecs the client can decompress, it tells them in its hello,
+        # the other workers forward the messages as they arrived
+        self.codecs = {compression.NONE}
+        if bus:
+            self.codecs.update(compression.CODECS)
+        # The channels the client is subscribed to, whether it understands
+        # the topic frames, which only the clients that used a channel do,
+        # the one its messages are published on and the one of the last
+        # message queued for it, None if it is unknown because a message was
+        # dropped
+        self.channels = set()
+        self.topical = bus
+        self.topic_in = channels.DEFAULT
+        self.topic_out = channels.DEFAULT
+        # The limits of the bytes and messages the client can send, the
+        # relay stops reading from it while it is over them
+        self.byte_bucket = byte_bucket
+        self.msg_bucket = msg_bucket
+        self.reading = True
+        # The events the selector watches the socket for
+        self.events = 0
+        # Whether the client is told the offsets of the log it got up to,
+        # the id its messages are logged with so it doesn't read them back
+        # and where it reads the log from while it catches up, it gets no
+        # live messages meanwhile
+        self.tracking = False
+        self.log_id = msglog.ANONYMOUS
+        self.reader = None
+
+    def __repr__(self):
+        return f"{self.addr[0]}:{self.addr[1]}"
+
+    def enqueue(self, data: memoryview):
+        """
+        Appends data to the outbound queue
+        """
+        self.queue.append(data)
+        self.queued += len(data)
+
+    def flush(self) -> bool:
+        """
+        Sends as much of the outbound queue as the socket accepts without
+        blocking, returns True once the queue is empty
+        """
+        self.queued -= flush_queue(self.sock, self.queue)
+        return not self.queue
+
+    def allowance(self, now: float) -> int:
+        """
+        Returns how many bytes can be read from the client now, 0 while it is
+        over its limits
+        """
+        if self.msg_bucket is not None and self.msg_bucket.available(now) < 1:
+            return 0
+        if self.byte_bucket is None:
+            return RECV_SIZE
+        return max(0, min(RECV_SIZE, int(self.byte_bucket.available(now))))
+
+    def resume_at(self) -> float:
+        """
+        Returns when the client is under its limits again with room for a
+        whole read
+        """
+        at = 0.0
+        if self.msg_bucket is not None:
+            at = max(at, self.msg_bucket.ready_at(1))
+        if self.byte_bucket is not None:
+            at = max(at, self.byte_bucket.ready_at(RECV_SIZE))
+        return at
+
+
+class Message:
+    """
+    A message received during an iteration, it is framed once as it arrived
+    and once more decompressed only if some recipient doesn't support its
+    codec
+    """
+    sender: Client
+    topic: str
+    codec: int
+    payload: bytes
+    data: memoryview
+    plain: Optional[memoryview]
+
+    def __init__(self, sender: Client, codec: int, payload: bytes):
+        self.sender = sender
+        self.topic = sender.topic_in
+        self.codec = codec
+        self.payload = payload
+        self.data = memoryview(frame(payload, codec))
+        self.plain = None
+
+    def frame_for(self, client: Client) -> Optional[memoryview]:
+        """
+        Returns the frame the client can read, None if the payload can't be
+        decompressed
+        """
+        if self.codec in client.codecs:
+            return self.data
+        if self.plain is None:
+            try:
+                payload = compression.decompress(self.codec, self.payload)
+            except ValueError as e:
+                print(f'  corrupted message from {self.sender}: {e}',
+                      file=stderr)
+                return None
+            self.plain = memoryview(frame(payload))
+        return self.plain
+
+
+class Relay:
+    """
+    The event engine of the server, it keeps track of the clients and relays
+    the messages between them
+    """
+    server: socket
+    unix: Optional[socket]
+    sel: selectors.BaseSelector
+    clients: dict[int, Client]
+    bus: list[Client]
+    topics: channels.Topics[Client]
+    batch: list[Message]
+    high_water: int
+    policy: str
+    debug: bool
+    stats: Stats
+    stats_sock: Optional[socket]
+    byte_rate: float
+    msg_rate: float
+    burst: float
+    reads_per_tick: int
+    throttled: TimerWheel[Client]
+    log: Optional[MessageLog]
+    catching_up: set[Client]
+
+    def __init__(
+            self,
+            server: socket,
+            args: Namespace,
+            bus: list[socket] = (),
+            worker: int = 0,
+            unix: Optional[socket] = None,
+            log: Optional[MessageLog] = None
+    ):
+        self.server = server
+        self.unix = unix
+        self.sel = selectors.DefaultSelector()
+        self.clients = {}
+        self.bus = []
+        self.topics = channels.Topics()
+        self.batch = []
+        self.high_water = args.high_water
+        self.policy = args.policy
+        self.debug = args.debug
+        # The limits of every client, 0 means unlimited
+        self.byte_rate = args.client_rate
+        self.msg_rate = args.client_msg_rate
+        self.burst = args.burst
+        self.reads_per_tick = args.reads_per_tick
+        # The clients over their limits by when they can be read again
+        self.throttled = TimerWheel(THROTTLE_TICK, 256, time.monotonic())
+        # The log of the relayed messages, if any, and the clients reading
+        # what they missed from it
+        self.log = log
+        self.catching_up = set()
+
+        # The listening sockets carry no client data
+        self.sel.register(server, selectors.EVENT_READ, None)
+        if unix is not None:
+            self.sel.register(unix, selectors.EVENT_READ, None)
+        # The log is synced to disk by a thread
+        if log is not None:
+            self.sel.register(workers.wakeup, selectors.EVENT_READ, WORKERS)
+
+        self.setup_stats(args, worker)
+
+        # Links to the other workers are handled like clients but they are
+        # not part of the local broadcast
+        for link in bus:
+            link.setblocking(False)
+            client = Client(link, ('bus', link.fileno()), bus=True)
+            self.clients[link.fileno()] = client
+            self.bus.append(client)
+            self.watch(client)
+
+    def setup_stats(self, args: Namespace, worker: int):
+        """
+        Creates the counters and, if asked, the socket where they are served
+        """
+        self.stats = Stats()
+        for name in [
+            "connections_total", "msgs_in", "bytes_in", "msgs_out",
+            "bytes_out", "msgs_dropped", "slow_disconnects", "throttles",
+            "msgs_replayed"
+        ]:
+            self.stats.counter(name)
+        self.stats.gauge("clients", lambda: len(self.clients) - len(self.bus))
+        self.stats.gauge("channels", lambda: len(self.topics))
+        self.stats.gauge(
+            "throttled_clients",
+            lambda: sum(1 for c in self.clients.values() if not c.reading)
+        )
+        if self.log is not None:
+            # The log is dropped if writing to it fails
+            self.stats.gauge(
+                "log_next_offset", lambda: self.log.next if self.log else 0
+            )
+            self.stats.gauge(
+                "log_durable_offset",
+                lambda: self.log.durable if self.log else 0
+            )
+            self.stats.gauge("log_segments", lambda: len(self.log or ()))
+            self.stats.gauge("catching_up", lambda: len(self.catching_up))
+        self.stats.gauge(
+            "queued_bytes",
+            lambda: sum(c.queued for c in self.clients.values())
+        )
+        self.stats.gauge(
+            "max_queued_bytes",
+            lambda: max((c.queued for c in self.clients.values()), default=0)
+        )
+        self.loop_time = self.stats.histogram("loop_time")
+        self.fanout_time = self.stats.histogram("fanout_time")
+
+        # Every worker serves its own stats on the next port or path
+        self.stats_sock = None
+        try:
+            if args.stats_port is not None:
+                self.stats_sock = socket(AF_INET, SOCK_STREAM)
+                self.stats_sock.bind(('127.0.0.1', args.stats_port + worker))
+            elif args.stats_unix is not None:
+                path = args.stats_unix
+                if args.workers > 1:
+                    path = f"{path}.{worker}"
+                if os.path.exists(path):
+                    os.unlink(path)
+                self.stats_sock = socket(AF_UNIX, SOCK_STREAM)
+                self.stats_sock.bind(path)
+        except OSError as e:
+            print(f"Error while trying to bind the stats socket: {e}")
+            exit(1)
+
+        if self.stats_sock is not None:
+            self.stats_sock.listen(8)
+            self.stats_sock.setblocking(False)
+            self.sel.register(self.stats_sock, selectors.EVENT_READ, STATS)
+
+    def run(self):
+        # This loop blocks until there is a socket ready or some timer is due
+        while True:
+            events = self.sel.select(self.timeout())
+            start = time.perf_counter()
+
+            readable = []
+            for key, mask in events:
+                # A "readable" listening socket is ready to accept a connection
+                if key.data is None:
+                    self.handle_new(key.fileobj)
+                    continue
+                # Someone asked for the stats
+                if key.data is STATS:
+                    self.handle_stats()
+                    continue
+                # The log was synced to disk
+                if key.data is WORKERS:
+                    workers.process()
+                    continue
+
+                client = key.data
+                # The client may have been closed by a previous event
+                if client.sock.fileno() not in self.clients:
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self.handle_writable(client)
+                if mask & selectors.EVENT_READ:
+                    readable.append(client)
+
+            self.read_turns(readable)
+            self.resume(time.monotonic())
+
+            # Send everything received during this iteration at once
+            self.deliver()
+            if self.log is not None:
+                self.catch_up()
+                self.log.commit(time.monotonic())
+            self.loop_time.observe(time.perf_counter() - start)
+
+    def timeout(self) -> Optional[float]:
+        """
+        Returns the seconds until a throttled client can be read again, the
+        log can be synced or, if a client catching up has room for more,
+        zero
+        """
+        now = time.monotonic()
+        timeouts = [self.throttled.timeout(now)]
+        if self.log is not None:
+            timeouts.append(self.log.timeout(now))
+            if any(self.has_room(c) for c in self.catching_up):
+                timeouts.append(0.0)
+        return min((t for t in timeouts if t is not None), default=None)
+
+    def handle_new(self, listener: socket):
+        """
+        Handles an incoming connection from a client
+        """
+        try:
+            connection, client_address = listener.accept()
+        except BlockingIOError:
+            return
+        if listener is self.unix:
+            # Unix socket clients have no address
+            client_address = ('unix', connection.fileno())
+        print('  connection from', client_address, file=stderr)
+        self.stats.counters["connections_total"] += 1
+        connection.setblocking(False)
+
+        now = time.monotonic()
+        client = Client(
+            connection,
+            client_address,
+            byte_bucket=TokenBucket(
+                self.byte_rate, self.byte_rate * self.burst, now
+            ) if self.byte_rate else None,
+            msg_bucket=TokenBucket(
+                self.msg_rate, self.msg_rate * self.burst, now
+            ) if self.msg_rate else None
+        )
+        self.clients[connection.fileno()] = client
+        self.subscribe(client, channels.DEFAULT)
+        self.watch(client)
+
+    def watch(self, client: Client, writing: Optional[bool] = None):
+        """
+        Watches a client for reading unless it is throttled and for writing
+        while it has data pending, or if told so
+        """
+        if writing is None:
+            writing = bool(client.events & selectors.EVENT_WRITE)
+        events = selectors.EVENT_READ if client.reading else 0
+        if writing:
+            events |= selectors.EVENT_WRITE
+        if events == client.events:
+            return
+
+        if client.events == 0:
+            self.sel.register(client.sock, events, client)
+        elif events == 0:
+            self.sel.unregister(client.sock)
+        else:
+            self.sel.modify(client.sock, events, client)
+        client.events = events
+
+    def read_turns(self, readable: list[Client]):
+        """
+        Reads from the clients with data in turns, every client reads once
+        before any of them reads again, up to the reads allowed per iteration
+        """
+        for _ in range(self.reads_per_tick):
+            readable = [c for c in readable if self.handle_msg(c)]
+            if not readable:
+                break
+
+    def throttle(self, client: Client):
+        """
+        Stops reading from a client over its limits until it is under them
+        """
+        client.reading = False
+        self.watch(client)
+        self.throttled.schedule(client, client.resume_at())
+        self.stats.counters["throttles"] += 1
+
+    def resume(self, now: float):
+        """
+        Reads again from the throttled clients that are under their limits
+        """
+        for client in self.throttled.expired(now):
+            # It may have been closed and its descriptor reused
+            if self.clients.get(client.sock.fileno()) is not client:
+                continue
+            if client.allowance(now) == 0:
+                self.throttled.schedule(client, client.resume_at())
+                continue
+            client.reading = True
+            self.watch(client)
+
+    def handle_msg(self, client: Client) -> bool:
+        """
+        Reads the messages of a client and queues them to be re transmitted,
+        returns True if there may be more to read from it
+        """
+        # The client may have been closed by a previous event
+        if self.clients.get(client.sock.fileno()) is not client:
+            return False
+        now = time.monotonic()
+        size = client.allowance(now)
+        if size == 0:
+            self.throttle(client)
+            return False
+
+        try:
+            data = client.sock.recv(size)
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            data = b''
+
+        if not data:
+            # Interpret empty result as closed connection
+            self.close(client)
+            return False
+
+        try:
+            frames = client.decoder.feed_raw(data)
+        except ValueError as e:
+            print(f'  corrupted stream from {client}: {e}', file=stderr)
+            self.close(client)
+            return False
+
+        counters = self.stats.counters
+        counters["bytes_in"] += len(data)
+        received = 0
+        for codec, payload in frames:
+            if codec == compression.HELLO:
+                self.handle_hello(client, payload)
+                continue
+            if codec in (channels.JOIN, channels.LEAVE, channels.TOPIC):
+                self.handle_channel(client, codec, payload)
+                continue
+            if codec == msglog.RESUME:
+                self.handle_resume(client, payload)
+                continue
+            counters["msgs_in"] += 1
+            if self.debug and not client.bus:
+                text = payload.decode(errors="replace") \
+                    if codec == compression.NONE \
+                    else f'<{len(payload)} compressed bytes>'
+                print(f'  received {text} from {client} on '
+                      f'{client.topic_in!r}', file=stderr)
+            # The message is framed once and shared by every recipient
+            self.batch.append(Message(client, codec, payload))
+            received += 1
+
+        if client.byte_bucket is not None:
+            client.byte_bucket.take(len(data))
+        if client.msg_bucket is not None:
+            client.msg_bucket.take(received)
+        if client.allowance(now) == 0:
+            self.throttle(client)
+            return False
+        return len(data) == size
+
+    def handle_hello(self, client: Client, payload: bytes):
+        """
+        Stores the codecs a client supports and answers with the ones both
+        ends share, the client only compresses with those
+        """
+        common = bytes(c for c in payload if c in compression.CODECS)
+        client.codecs = {compression.NONE, *common}
+        self.send(client, [memoryview(frame(common, compression.HELLO))])
+
+    def handle_channel(self, client: Client, flag: int, payload: bytes):
+        """
+        Subscribes or unsubscribes a client from a channel or changes the
+        channel its next messages are published on
+        """
+        try:
+            name = channels.parse_name(payload)
+        except ValueError as e:
+            print(f'  invalid channel from {client}: {e}', file=stderr)
+            return
+
+        client.topical = True
+
+        if flag == channels.TOPIC:
+            client.topic_in = name
+        elif client.bus:
+            # The other workers only tell where their messages belong
+            return
+        elif flag == channels.JOIN:
+            self.subscribe(client, name)
+        else:
+            self.unsubscribe(client, name)
+
+    def handle_resume(self, client: Client, payload: bytes):
+        """
+        Sends a client the messages of the log from the offset it asks for,
+        on the channels it is subscribed to, before the live ones
+
+        The request is answered with the offset the log is read from, the
+        client drops the live messages it got before the answer since they
+        are read from the log too
+        """
+        if client.bus:
+            return
+        try:
+            offset, client.log_id = msglog.decode_resume(payload)
+        except ValueError as e:
+            print(f'  invalid offset from {client}: {e}', file=stderr)
+            return
+
+        if self.log is None:
+            # There is nothing to resume from, the client keeps its offset
+            self.send(client, [memoryview(
+                frame(msglog.encode_offset(offset), msglog.OFFSET)
+            )])
+            return
+
+        client.tracking = True
+        if client.reader is not None:
+            client.reader.close()
+        client.reader = self.log.reader(offset)
+        self.catching_up.add(client)
+        self.send(client, [memoryview(
+            frame(msglog.encode_offset(client.reader.offset), msglog.OFFSET)
+        )])
+
+    def subscribe(self, client: Client, name: str):
+        client.channels.add(name)
+        self.topics.subscribe(name, client)
+
+    def unsubscribe(self, client: Client, name: str):
+        client.channels.discard(name)
+        self.topics.unsubscribe(name, client)
+
+    def handle_writable(self, client: Client):
+        """
+        Flushes the pending data of a client once its socket accepts it
+        """
+        try:
+            done = client.flush()
+        except OSError:
+            self.close(client)
+            return
+
+        if done:
+            # Nothing left to write, stop asking for writable events
+            self.watch(client, writing=False)
+
+    def handle_stats(self):
+        """
+        Writes the stats to whoever connected to the stats socket
+        """
+        try:
+            conn, _ = self.stats_sock.accept()
+        except BlockingIOError:
+            return
+        try:
+            conn.sendall(self.stats.render())
+        except OSError:
+            pass
+        conn.close()
+
+    def deliver(self):
+        """
+        Queues the messages of this iteration on the subscribers of their
+        topics but their senders, messages from local clients are also
+        published to the other workers
+
+        Everything a client gets is queued at once, so a client on several
+        channels gets a single write per iteration
+        """
+        if not self.batch:
+            return
+        batch = self.batch
+        self.batch = []
+        start = time.perf_counter()
+
+        # The messages are logged before anyone gets them, the clients
+        # catching up read them from the log
+        if self.log is not None:
+            try:
+                self.log.append(
+                    (m.sender.log_id, m.topic, m.codec, m.payload)
+                    for m in batch
+                )
+            except OSError as e:
+                print(f'  error while writing the log, disabling it: {e}',
+                      file=stderr)
+                self.stop_log()
+
+        # Keep the order of the messages inside every topic
+        by_topic: dict[str, list[Message]] = {}
+        for m in batch:
+            by_topic.setdefault(m.topic, []).append(m)
+
+        out: dict[Client, list[memoryview]] = {}
+        for topic, messages in by_topic.items():
+            header = memoryview(frame(topic.encode(), channels.TOPIC))
+            frames = [m.data for m in messages]
+            senders = {m.sender for m in messages}
+            local = [m.data for m in messages if not m.sender.bus]
+            codecs = {m.codec for m in messages}
+
+            if local:
+                for link in self.bus:
+                    self.collect(out, link, topic, header, local)
+
+            for client in self.topics.get(topic):
+                if client.reader is not None:
+                    continue
+                if client in senders or not codecs <= client.codecs:
+                    # Pick the frames one by one, without its own messages
+                    # and decompressing the ones it can't read
+                    self.collect(out, client, topic, header, [
+                        f for f in (
+                            m.frame_for(client) for m in messages
+                            if m.sender is not client
+                        ) if f is not None
+                    ])
+                else:
+                    self.collect(out, client, topic, header, frames)
+
+        if self.log is not None:
+            # Tell the clients where they would resume from, the ones that
+            # only sent messages too so they don't read them back later
+            offset = memoryview(
+                frame(msglog.encode_offset(self.log.next), msglog.OFFSET)
+            )
+            for m in batch:
+                if m.sender.tracking and m.sender.reader is None:
+                    out.setdefault(m.sender, [])
+            for client, frames in out.items():
+                if client.tracking:
+                    frames.append(offset)
+
+        for client, frames in out.items():
+            if not self.send(client, frames):
+                # The next messages must tell their topic again
+                client.topic_out = None
+
+        self.fanout_time.observe(time.perf_counter() - start)
+
+    def has_room(self, client: Client) -> bool:
+        """
+        Whether a client catching up can be sent more of the log, half of
+        the high water mark is left for the messages of other iterations
+        """
+        return client.queued < self.high_water // 2
+
+    def catch_up(self):
+        """
+        Queues the next messages of the log for the clients catching up that
+        have room for them, the ones reaching its end get the live messages
+        from then on
+        """
+        counters = self.stats.counters
+        for client in list(self.catching_up):
+            if not self.has_room(client):
+                continue
+            reader = client.reader
+            out: dict[Client, list[memoryview]] = {}
+            headers: dict[str, memoryview] = {}
+            for _, sender, topic, codec, payload in reader.read(CATCHUP_BYTES):
+                # Live messages never go back to their sender either
+                if topic not in client.channels or \
+                        sender == client.log_id != msglog.ANONYMOUS:
+                    continue
+                if codec not in client.codecs:
+                    try:
+                        payload = compression.decompress(codec, payload)
+                    except ValueError:
+                        continue
+                    codec = compression.NONE
+                if topic not in headers:
+                    headers[topic] = memoryview(
+                        frame(topic.encode(), channels.TOPIC)
+                    )
+                self.collect(out, client, topic, headers[topic], [
+                    memoryview(frame(payload, codec))
+                ])
+                counters["msgs_replayed"] += 1
+
+            frames = out.get(client, [])
+            frames.append(memoryview(
+                frame(msglog.encode_offset(reader.offset), msglog.OFFSET)
+            ))
+            if not self.send(client, frames):
+                client.topic_out = None
+            if reader.done() and client.reader is reader:
+                self.stop_catch_up(client)
+
+    def stop_catch_up(self, client: Client):
+        client.reader.close()
+        client.reader = None
+        self.catching_up.discard(client)
+
+    def stop_log(self):
+        """
+        Stops logging after an error, the clients catching up go live
+        """
+        for client in list(self.catching_up):
+            self.stop_catch_up(client)
+        self.log = None
+
+    @staticmethod
+    def collect(
+            out: dict[Client, list[memoryview]],
+            client: Client,
+            topic: str,
+            header: memoryview,
+            frames: list[memoryview]
+    ):
+        """
+        Adds the frames of a topic to the ones a client gets this iteration,
+        preceded by the topic if the previous frames were of another one and
+        the client understands it
+        """
+        if not frames:
+            return
+        queued = out.setdefault(client, [])
+        if client.topical and client.topic_out != topic:
+            queued.append(header)
+            client.topic_out = topic
+        queued.extend(frames)
+
+    def send(self, client: Client, frames: list[memoryview]) -> bool:
+        """
+        Queues the messages for a client applying the slow consumer policy if
+        its queue goes over the high water mark, returns False if some of
+        them were not queued
+        """
+        if not frames or client.sock.fileno() not in self.clients:
+            return not frames
+
+        counters = self.stats.counters
+        was_empty = not client.queue
+        complete = True
+        for i, data in enumerate(frames):
+            # Workers must never lose messages from each other
+            if not client.bus and \
+                    client.queued + len(data) > self.high_water:
+                if self.policy == POLICY_DISCONNECT:
+                    print(f'  {client} is too slow, disconnecting',
+                          file=stderr)
+                    counters["slow_disconnects"] += 1
+                    self.close(client)
+                    return False
+                # Drop the rest too, a topic frame may be among the dropped
+                # ones and the messages after it would look like from another
+                # topic
+                client.dropped += len(frames) - i
+                counters["msgs_dropped"] += len(frames) - i
+                complete = False
+                break
+            client.enqueue(data)
+            counters["msgs_out"] += 1
+            counters["bytes_out"] += len(data)
+
+        # If nothing was pending, try to write right away and only wait for
+        # the socket to be writable if the kernel buffer is full
+        if was_empty and client.queue:
+            try:
+                done = client.flush()
+            except OSError:
+                self.close(client)
+                return False
+            if not done:
+                self.watch(client, writing=True)
+
+        return complete
+
+    def close(self, client: Client):
+        """
+        Stops listening on the client connection and closes it
+        """
+        print(f'  closing {client}', file=stderr)
+        del self.clients[client.sock.fileno()]
+        for name in client.channels:
+            self.topics.unsubscribe(name, client)
+        if client.reader is not None:
+            self.stop_catch_up(client)
+        if client.bus:
+            self.bus.remove(client)
+        if client.events:
+            self.sel.unregister(client.sock)
+        client.sock.close()
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Chat relay server")
+    parser.add_argument("port", type=int, help="port to listen on")
+    parser.add_argument(
+        "--high-water",
+        type=int,
+        default=DEFAULT_HIGH_WATER,
+        help="bytes that can be queued for a client before applying the "
+             "slow consumer policy"
+    )
+    parser.add_argument(
+        "--policy",
+        choices=[POLICY_DROP, POLICY_DISCONNECT],
+        default=POLICY_DROP,
+        help="what to do with clients over the high water mark"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes sharing the port"
+    )
+    parser.add_argument(
+        "--stats-port",
+        type=int,
+        help="local port where the stats are served, workers use the "
+             "following ports"
+    )
+    parser.add_argument(
+        "--stats-unix",
+        help="unix socket where the stats are served, workers append their "
+             "number to it"
+    )
+    parser.add_argument(
+        "--client-rate",
+        type=float,
+        default=0,
+        help="bytes per second read from every client, 0 is unlimited"
+    )
+    parser.add_argument(
+        "--client-msg-rate",
+        type=float,
+        default=0,
+        help="messages per second read from every client, 0 is unlimited"
+    )
+    parser.add_argument(
+        "--burst",
+        type=float,
+        default=DEFAULT_BURST,
+        help="seconds of its rates a client can send at once"
+    )
+    parser.add_argument(
+        "--reads-per-tick",
+        type=int,
+        default=DEFAULT_READS_PER_TICK,
+        help="reads from every client in an iteration of the event loop"
+    )
+    parser.add_argument(
+        "--log-dir",
+        help="keep the relayed messages in a log in this directory so the "
+             "clients that reconnect get what they missed, only with one "
+             "worker"
+    )
+    parser.add_argument(
+        "--log-segment-bytes",
+        type=int,
+        default=msglog.DEFAULT_SEGMENT_BYTES,
+        help="bytes of a log segment before starting the next one"
+    )
+    parser.add_argument(
+        "--log-retention-hours",
+        type=float,
+        default=DEFAULT_RETENTION_HOURS,
+        help="hours the log segments are kept, 0 keeps them forever"
+    )
+    parser.add_argument(
+        "--log-retention-bytes",
+        type=int,
+        default=0,
+        help="bytes the log is trimmed to, 0 doesn't limit its size"
+    )
+    parser.add_argument(
+        "--log-fsync-interval",
+        type=float,
+        default=0,
+        help="minimum seconds between syncs of the log to disk, the messages "
+             "logged meanwhile are synced together"
+    )
+    parser.add_argument(
+        "--unix",
+        nargs="?",
+        const="",
+        help="listen on a unix socket too, the clients on this host use it "
+             "instead of TCP, by default it is placed where they look for it"
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="log every received message"
+    )
+    return parser.parse_args()
+
+
+def setup(args: Namespace) -> socket:
     """
     Create a socket for the server to listen
     """
@@ -11,78 +979,144 @@ def setup() -> socket:
     server = socket(AF_INET, SOCK_STREAM)
     server.setblocking(False)
 
-    # Parse arguments
-    if len(argv) != 2:
-        print(f"Usage\n\t{argv[0]} <port>")
-        exit(1)
+    # Every worker binds its own socket to the same port and the kernel
+    # balances the incoming connections between them
+    if args.workers > 1:
+        server.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
 
     try:
-        server_address = ('', int(argv[1]))
+        server_address = ('', args.port)
         print(f'starting up on port {server_address[1]}', file=stderr)
         server.bind(server_address)
-    except ValueError as e:
-        print(f"Error while trying to parse arguments {e}")
-        exit(1)
     except OSError as e:
-        print(f"Error while trying to bind to {argv[1]}: {e.strerror}")
+        print(f"Error while trying to bind to {args.port}: {e.strerror}")
         exit(1)
 
     # Listen for incoming connections
-    server.listen(5)
+    server.listen(128)
 
     return server
 
 
-def main():
-    server = setup()
-
-    # Sockets from which we expect to read
-    inputs = [server]
-
-    # This loop blocks until there is data ready
-    while inputs:
-        # Wait for at least one of the sockets to be ready for processing
-        readable, writable, exceptional = select(inputs, [], [])
-
-        # Handle inputs
-        for s in readable:
-            # A "readable" listening socket is ready to accept a connection
-            if s is server:
-                handle_new(s, inputs)
+def setup_unix(args: Namespace) -> Optional[socket]:
+    """
+    Create the unix socket for the server to listen, if asked, it is shared by
+    every worker
+    """
+    if args.unix is None:
+        return None
 
-            # A message incoming from a client
-            else:
-                handle_msg(s, inputs, server)
+    path = args.unix or localsock.default_path("relay", args.port)
+    try:
+        print(f'listening on {path} too', file=stderr)
+        return localsock.listen(path, 128)
+    except OSError as e:
+        print(f"Error while trying to bind to {path}: {e.strerror}")
+        exit(1)
 
 
-def handle_new(s: socket, inputs: list[socket]):
+def setup_log(args: Namespace) -> Optional[MessageLog]:
     """
-    Handles an incoming connection from a client
+    Opens the message log, if asked
     """
-    connection, client_address = s.accept()
-    print('  connection from', client_address, file=stderr)
-    connection.setblocking(False)
-    inputs.append(connection)
+    if args.log_dir is None:
+        return None
+    try:
+        log = MessageLog(
+            args.log_dir,
+            workers.Serial().run,
+            segment_bytes=args.log_segment_bytes,
+            retention_seconds=args.log_retention_hours * 3600,
+            retention_bytes=args.log_retention_bytes,
+            fsync_interval=args.log_fsync_interval
+        )
+    except OSError as e:
+        print(f"Error while opening the log in {args.log_dir}: {e}")
+        exit(1)
+    print(f'logging to {args.log_dir} from offset {log.next}', file=stderr)
+    return log
 
 
-def handle_msg(s: socket, inputs: list[socket], server: socket):
+def run_workers(
+        args: Namespace,
+        servers: list[socket],
+        unix: Optional[socket]
+):
     """
-    Handles a message and re transmits it
+    Forks the worker processes, each one with its own listening socket,
+    connecting each pair of them with a unix socket and waits until all of
+    them exit
     """
-    data = s.recv(1024)
-    addr, port = s.getpeername()
-    if data:
-        # A readable client socket has data
-        print(f'  received {data.decode()} from {addr}:{port}', file=stderr)
-        for p in inputs:
-            if p is not server and p is not s:
-                p.sendall(data)
-    else:
-        # Interpret empty result as closed connection
-        print(f'  closing {addr}:{port}', file=stderr)
-        # Stop listening for input on the connection
-        inputs.remove(s)
-        s.close()
+    # links[i][j] is the end of the link between i and j owned by i
+    links: list[dict[int, socket]] = [{} for _ in range(args.workers)]
+    for i in range(args.workers):
+        for j in range(i + 1, args.workers):
+            links[i][j], links[j][i] = socketpair()
+
+    pids = []
+    for i in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            # Keep only the links and the listening socket of this worker
+            for j, others in enumerate(links):
+                if j != i:
+                    servers[j].close()
+                    for link in others.values():
+                        link.close()
+
+            print(f'worker {i} started with pid {os.getpid()}', file=stderr)
+            relay = Relay(servers[i], args, list(links[i].values()), i, unix)
+            try:
+                relay.run()
+            finally:
+                os._exit(1)
+        pids.append(pid)
+
+    for server, others in zip(servers, links):
+        server.close()
+        for link in others.values():
+            link.close()
+
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+
+
+def main():
+    args = parse_args()
+
+    if args.workers < 1:
+        print(f"Invalid number of workers {args.workers}")
+        exit(1)
+    if args.reads_per_tick < 1:
+        print(f"Invalid number of reads per tick {args.reads_per_tick}")
+        exit(1)
+    if args.log_dir is not None and args.workers > 1:
+        # Every worker would need its own log and offsets
+        print("The message log needs a single worker")
+        exit(1)
+    for rate in (args.client_rate, args.client_msg_rate):
+        # The burst must fit at least a byte or a message
+        if rate < 0 or rate and rate * args.burst < 1:
+            print(f"Invalid rate {rate} with a burst of {args.burst}s")
+            exit(1)
+
+    # The port is bound first, a relay that is already running keeps it and
+    # its unix socket
+    if args.workers > 1:
+        servers = [setup(args) for _ in range(args.workers)]
+        run_workers(args, servers, setup_unix(args))
+        return
+
+    server = setup(args)
+    unix = setup_unix(args)
+    log = setup_log(args)
+
+    relay = Relay(server, args, unix=unix, log=log)
+    relay.run()
 
 
 if __name__ == "__main__":
@@ -1,35 +1,206 @@
-from socket import socket, error
+from argparse import ArgumentParser
+from hashlib import blake2b
+from mmap import mmap
+from os import ftruncate, posix_fallocate, remove
+from socket import socket, error, timeout
+from sys import exit
+from threading import Lock, Thread
+from time import monotonic
+
+# Cada rango va precedido de una cabecera con el tamaño total del archivo,
+# el desplazamiento del rango, su longitud y su suma de comprobación.
+TAMANO_CAMPO = 8
+TAMANO_SUMA = 16
+TAMANO_CABECERA = 3 * TAMANO_CAMPO + TAMANO_SUMA
+# Máximo de bytes recibidos en cada llamada.
+TAMANO_BUFFER = 4 * 1024 * 1024
+# Respuestas al cliente según si el rango llegó bien o no.
+RANGO_OK = b"\x01"
+RANGO_MAL = b"\x00"
+# Segundos que una conexión puede estar sin enviar nada antes de cerrarla.
+TIEMPO_CONEXION = 10.0
+# Segundos sin conexiones nuevas ni datos tras los que se da por perdido el
+# archivo, el cliente pudo abortar o quedarse sin reintentos.
+ESPERA_MAXIMA = 30.0
+def recibir_exacto(conn, n):
+    # Recibir exactamente n bytes o menos si se cierra la conexión.
+    datos = bytearray()
+    while len(datos) < n:
+        parte = conn.recv(n - len(datos))
+        if not parte:
+            break
+        datos += parte
+    return bytes(datos)
+class Recepcion:
+    # Archivo que se está recibiendo, compartido por todas las conexiones.
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.lock = Lock()
+        self.f = None
+        self.vista = None
+        self.tamano = None
+        self.pendiente = 0
+        self.completados = set()
+        # Cuándo llegó lo último, una conexión o datos de un rango.
+        self.actividad = monotonic()
+    
+    def tocar(self):
+        self.actividad = monotonic()
+    
+    def inactiva(self, espera):
+        return monotonic() - self.actividad > espera
+    
+    def preparar(self, tamano):
+        # La primera cabecera que llega crea el archivo.
+        with self.lock:
+            if self.tamano is not None:
+                return self.tamano == tamano
+            self.tamano = tamano
+            self.pendiente = tamano
+            # Reservar el espacio del archivo de antemano y mapearlo en
+            # memoria para que los datos se reciban directamente sobre él.
+            self.f = open(self.ruta, "w+b")
+            if tamano:
+                try:
+                    posix_fallocate(self.f.fileno(), 0, tamano)
+                except OSError:
+                    # Sistema de archivos sin soporte para fallocate.
+                    ftruncate(self.f.fileno(), tamano)
+                self.m = mmap(self.f.fileno(), tamano)
+                self.vista = memoryview(self.m)
+            return True
+    
+    def completar(self, desplazamiento, longitud):
+        with self.lock:
+            # Un rango reintentado solo cuenta la primera vez.
+            if (desplazamiento, longitud) not in self.completados:
+                self.completados.add((desplazamiento, longitud))
+                self.pendiente -= longitud
+    
+    def terminada(self):
+        with self.lock:
+            return self.tamano is not None and self.pendiente <= 0 \
+                and (self.tamano > 0 or self.completados)
+    
+    def cerrar(self):
+        if self.vista is not None:
+            try:
+                self.vista.release()
+                self.m.close()
+            except BufferError:
+                # Un hilo sigue recibiendo sobre el mapa, se libera al salir.
+                pass
+        if self.f is not None:
+            self.f.close()
+def recibir_rango(conn, recepcion, desplazamiento, longitud):
+    # Recibir el rango directamente en su posición del archivo.
+    recibido = 0
+    while recibido < longitud:
+        inicio = desplazamiento + recibido
+        n = conn.recv_into(
+            recepcion.vista[inicio:desplazamiento + longitud],
+            min(TAMANO_BUFFER, longitud - recibido)
+        )
+        if n == 0:
+            break
+        recibido += n
+        recepcion.tocar()
+    return recibido
+def atender(conn, recepcion):
+    try:
+        cabecera = recibir_exacto(conn, TAMANO_CABECERA)
+        if len(cabecera) != TAMANO_CABECERA:
+            print("Error de lectura.")
+            return
+        tamano = int.from_bytes(cabecera[0:8], "big")
+        desplazamiento = int.from_bytes(cabecera[8:16], "big")
+        longitud = int.from_bytes(cabecera[16:24], "big")
+        suma = cabecera[24:]
+        
+        if not recepcion.preparar(tamano) or \
+                desplazamiento + longitud > tamano:
+            print("Rango fuera del archivo.")
+            conn.sendall(RANGO_MAL)
+            return
+        
+        if recibir_rango(conn, recepcion, desplazamiento, longitud) \
+                != longitud:
+            print("La conexión se cerró antes de recibir el rango.")
+            return
+        
+        # Comprobar el rango antes de darlo por bueno.
+        if longitud:
+            fin = desplazamiento + longitud
+            calculada = blake2b(
+                recepcion.vista[desplazamiento:fin],
+                digest_size=TAMANO_SUMA
+            ).digest()
+        else:
+            calculada = blake2b(digest_size=TAMANO_SUMA).digest()
+        
+        if calculada == suma:
+            recepcion.completar(desplazamiento, longitud)
+            conn.sendall(RANGO_OK)
+        else:
+            print(f"El rango {desplazamiento} llegó dañado.")
+            conn.sendall(RANGO_MAL)
+    except timeout:
+        print("La conexión dejó de enviar datos.")
+    except error:
+        print("Error de lectura.")
+    finally:
+        conn.close()
 def main():
+    parser = ArgumentParser(description="Recibe un archivo de un cliente")
+    parser.add_argument("archivo", nargs="?", default="recibido.jpg")
+    parser.add_argument("--puerto", type=int, default=6040)
+    parser.add_argument(
+        "--espera",
+        type=float,
+        default=ESPERA_MAXIMA,
+        help="segundos sin recibir nada tras los que se abandona el archivo"
+    )
+    args = parser.parse_args()
+    
     s = socket()
     
-    # Escuchar peticiones en el puerto 6030.
-    s.bind(("localhost", 6040))
-    s.listen(0)
+    # Escuchar peticiones en el puerto indicado.
+    s.bind(("localhost", args.puerto))
+    s.listen(16)
+    # Despertar de vez en cuando para ver si ya se recibió todo.
+    s.settimeout(0.5)
     
-    conn, addr = s.accept()
-    f = open("recibido.jpg", "wb")
+    recepcion = Recepcion(args.archivo)
+    hilos = []
     
-    while True:
+    # Cada conexión trae un rango del archivo y se atiende en su hilo.
+    while not recepcion.terminada() and not recepcion.inactiva(args.espera):
         try:
-            # Recibir datos del cliente.
-            input_data = conn.recv(1024)
-        except error:
-            print("Error de lectura.")
-            break
-        else:
-            if input_data:
-                # Compatibilidad con Python 3.
-                if isinstance(input_data, bytes):
-                    end = input_data[0] == 1
-                else:
-                    end = input_data == chr(1)
-                if not end:
-                    # Almacenar datos.
-                    f.write(input_data)
-                else:
-                    break
-    
-    print("El archivo se ha recibido correctamente.")
-    f.close()
+            conn, addr = s.accept()
+        except timeout:
+            continue
+        recepcion.tocar()
+        conn.settimeout(TIEMPO_CONEXION)
+        hilo = Thread(target=atender, args=(conn, recepcion), daemon=True)
+        hilo.start()
+        hilos.append(hilo)
+    
+    # Las conexiones que quedan abiertas acaban como mucho al agotar su
+    # tiempo, aunque su rango ya llegara por otra.
+    limite = monotonic() + TIEMPO_CONEXION
+    for hilo in hilos:
+        hilo.join(max(0.0, limite - monotonic()))
+    completo = recepcion.terminada()
+    recepcion.cerrar()
+    s.close()
+    
+    if completo:
+        print("El archivo se ha recibido correctamente.")
+        return
+    # No dejar un archivo a medias con huecos sin recibir.
+    if recepcion.f is not None:
+        remove(args.archivo)
+    print("La conexión se cerró antes de recibir todo el archivo.")
+    exit(1)
 if __name__ == "__main__":
     main()
@@ -1,136 +1,971 @@
 #!/usr/bin/env python
 """
 This module contains the server to bootstrap the p2p connections
+
+Several instances can share the registry, the peers are spread between them
+by consistent hashing of their id and kept by a few of them, so any instance
+can register a peer and hand out the whole peer list
+
+The registry is replicated, not partitioned: every instance learns about
+every peer to hand out the whole list, so more instances spread the
+connections, the handshakes and the announcements to the peers, but not the
+memory of the registry
 """
 
+import errno
 import ipaddress
+import selectors
 import sys
-from select import select
-from socket import AF_INET, create_connection, socket
+import time
+from argparse import ArgumentParser, Namespace
+from collections import deque
+from socket import (AF_INET, SO_ERROR, SO_REUSEADDR, SOCK_STREAM, SOL_SOCKET,
+                    socket)
+from typing import Collection, Optional, Union
 
 import capnp
 import msgs_capnp
+from framing import FrameDecoder, decode_msg, encode_msg, flush_queue, frame
+from hashring import HashRing
+from timerwheel import TimerWheel
 
 EXIT_OK = 0
 EXIT_ERR = 1
 
+# Seconds a new connection has to send its listening port before it is
+# evicted
+HANDSHAKE_TIMEOUT = 5.0
+# Seconds a registered peer can stay silent before it is considered dead,
+# peers send an empty frame as heartbeat every few seconds
+HEARTBEAT_TIMEOUT = 15.0
+# Seconds per slot of the timer wheel and amount of slots, a turn of the
+# wheel covers the longest timeout so every timer fires in its first turn
+WHEEL_TICK = 1.0
+WHEEL_SIZE = 32
+# Bytes read from a socket in a single call
+RECV_SIZE = 2048
+# Seconds the membership changes are gathered before they are announced to
+# the peers and the other instances, each of them gets a single message for
+# all of them instead of one per iteration of the loop
+ANNOUNCE_INTERVAL = 0.05
+# Registrations between each print of the join latency percentiles
+STATS_EVERY = 1000
+
+# Frame flag of the first message of each end of a link between instances,
+# its payload is the index of the instance that sends it
+CLUSTER_HELLO = 0xfe
+# Instances that keep every peer, the first one announces it to the rest
+DEFAULT_REPLICAS = 2
+# Seconds between the heartbeats sent through the links between instances
+CLUSTER_HEARTBEAT = 5.0
+# Seconds between attempts to connect to the instances that are down
+RECONNECT_INTERVAL = 2.0
+# Seconds to wait for another instance to accept the connection, it has
+# the handshake timeout to answer the hello after that
+CONNECT_TIMEOUT = 1.0
+# Seconds the peers of an instance that went down are kept, giving them time
+# to register again in another one
+FAILOVER_GRACE = HEARTBEAT_TIMEOUT
+
+# States of a connection
+STATE_AWAITING_PORT = "awaiting port"
+STATE_REGISTERED = "registered"
+STATE_CLUSTER = "cluster"
+# States of a link this instance opens until the other one answers its hello
+STATE_CONNECTING = "connecting"
+STATE_LINKING = "linking"
+
+# The selector that drives the event loop
+sel = selectors.DefaultSelector()
+
 
 class Peer:
-    sock: socket
     host: int
     port: int
+    home: int
+    host_id: int
+    unix_path: str
 
-    def __init__(self, sock: socket, host: str, port: int):
-        self.sock = sock
+    def __init__(
+            self,
+            host: int,
+            port: int,
+            home: int,
+            host_id: int = 0,
+            unix_path: str = ""
+    ):
+        self.host = host
         self.port = port
-        self.host = int.from_bytes(
-            ipaddress.IPv4Address(host).packed,
-            byteorder='big',
-            signed=False
-        )
+        # The instance the peer is connected to
+        self.home = home
+        # The unix socket the peer listens on too and the id of its host,
+        # they are only advertised to the other peers
+        self.host_id = host_id
+        self.unix_path = unix_path
+
+    @property
+    def key(self) -> int:
+        """
+        The id of the peer, the same one the peers use for each other
+        """
+        return self.host << 16 | self.port
+
+
+def parse_host(host: str) -> int:
+    return int.from_bytes(
+        ipaddress.IPv4Address(host).packed,
+        byteorder='big',
+        signed=False
+    )
+
+
+class Registry:
+    """
+    The registered peers along with the cached encoding of the peer list and
+    the membership changes that haven't been announced yet
+    """
+    peers: dict[int, Peer]
+    snapshot: Optional[bytes]
+    joined: dict[int, Peer]
+    left: dict[int, Peer]
+
+    def __init__(self):
+        self.peers = {}
+        self.snapshot = None
+        # The changes by peer id, so they are found without a scan
+        self.joined = {}
+        self.left = {}
 
-    def send_msg(self):
-        pass
+    def add(self, peer: Peer) -> bool:
+        """
+        Registers a peer, returns False if it was already registered
+        """
+        old = self.peers.get(peer.key)
+        self.peers[peer.key] = peer
+        if old is not None:
+            # It only moved to another instance
+            return False
 
+        self.snapshot = None
+        # A peer that left and came back is only announced as joined
+        self.left.pop(peer.key, None)
+        self.joined[peer.key] = peer
+        return True
 
-def encode_peer(peer: Peer) -> bytearray:
+    def remove(self, key: int, home: int) -> Optional[Peer]:
+        """
+        Unregisters a peer if there is one with that id connected to that
+        instance, a peer that moved to another one is kept
+        """
+        peer = self.peers.get(key)
+        if peer is None or peer.home != home:
+            return None
+        del self.peers[key]
+
+        self.snapshot = None
+        # Nobody knows about it yet if it is still to be announced
+        if self.joined.pop(key, None) is None:
+            self.left[key] = peer
+        return peer
+
+    def encoded(self) -> bytes:
+        """
+        Returns the framed peer list, it is only rebuilt after the
+        membership changes
+        """
+        if self.snapshot is None:
+            addrs = msgs_capnp.ServerRpcMsg.new_message()
+            addrs_list = addrs.init('addrs', len(self.peers))
+            for i, peer in enumerate(self.peers.values()):
+                encode_peer(peer, addrs_list[i])
+            self.snapshot = frame(encode_msg(addrs))
+
+        return self.snapshot
+
+    def pending(self) -> bool:
+        """
+        Whether there are changes that weren't announced yet
+        """
+        return bool(self.joined or self.left)
+
+    def take_deltas(self) -> tuple[dict[int, Peer], dict[int, Peer]]:
+        """
+        Returns the peers that joined and left since the last call by their
+        ids
+        """
+        joined, left = self.joined, self.left
+        self.joined, self.left = {}, {}
+        return joined, left
+
+
+def encode_peer(peer: Peer, peer_msg):
     """
-    Allocates a peer struct and fills it with the peer info
+    Fills a peer struct with the peer info
     """
-    peer_msg = msgs_capnp.PeerAddr.new_message()
     peer_msg.ip = peer.host
     peer_msg.port = peer.port
+    if peer.unix_path:
+        peer_msg.hostId = peer.host_id
+        peer_msg.unixPath = peer.unix_path
+
+
+def encode_deltas(joined: Collection[Peer], left: Collection[Peer]) -> bytes:
+    """
+    Encodes the membership changes in a framed message
+    """
+    delta = msgs_capnp.ServerRpcMsg.new_message()
+    joined_list = delta.init('joined', len(joined))
+    for i, peer in enumerate(joined):
+        encode_peer(peer, joined_list[i])
+    left_list = delta.init('left', len(left))
+    for i, peer in enumerate(left):
+        encode_peer(peer, left_list[i])
+
+    return frame(encode_msg(delta))
+
+
+class Conn:
+    """
+    A connection to the server, it goes through the handshake states until
+    the peer is registered and queues what is sent to it so the event loop
+    never blocks, links with other instances are connections too
+    """
+    sock: socket
+    addr: tuple[str, int]
+    state: str
+    decoder: FrameDecoder
+    queue: deque
+    events: int
+    accepted_at: float
+    last_seen: float
+    peer: Optional[Peer]
+    node: int
+
+    def __init__(
+            self,
+            sock: socket,
+            addr: tuple[str, int],
+            state: str = STATE_AWAITING_PORT
+    ):
+        self.sock = sock
+        self.addr = addr
+        self.state = state
+        self.decoder = FrameDecoder()
+        self.queue = deque()
+        self.accepted_at = time.monotonic()
+        # When something was last received from it, any frame counts as a
+        # heartbeat
+        self.last_seen = self.accepted_at
+        # The registered peer, or the index of the instance for the links
+        self.peer = None
+        self.node = -1
+
+        sock.setblocking(False)
+        # A link being opened waits until the connection is accepted
+        self.events = selectors.EVENT_READ
+        if state == STATE_CONNECTING:
+            self.events = selectors.EVENT_WRITE
+        sel.register(sock, self.events, self)
+
+    def __repr__(self):
+        return f"{self.addr[0]}:{self.addr[1]}"
+
+    def send(self, data: bytes):
+        """
+        Queues data and sends as much as possible without blocking
+        """
+        was_empty = not self.queue
+        self.queue.append(memoryview(data))
+        if was_empty:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends the queued data until the socket would block, the connection
+        is only watched for writability while there is data pending
+        """
+        queue = self.queue
+        try:
+            flush_queue(self.sock, queue)
+        except OSError:
+            # The disconnection is handled when reading from it
+            queue.clear()
+
+        events = selectors.EVENT_READ
+        if queue:
+            events |= selectors.EVENT_WRITE
+        if events != self.events:
+            self.events = events
+            sel.modify(self.sock, events, self)
+
+
+def encode_members(batch: dict[str, list[Peer]]) -> bytes:
+    """
+    Encodes the changes sent to another instance in a framed message
+    """
+    msg = msgs_capnp.ClusterMsg.new_message()
+    for field, peers in batch.items():
+        members = msg.init(field, len(peers))
+        for i, peer in enumerate(peers):
+            encode_peer(peer, members[i].addr)
+            members[i].home = peer.home
+    return frame(encode_msg(msg))
+
+
+def decode_member(member) -> Peer:
+    return Peer(
+        member.addr.ip, member.addr.port, member.home,
+        member.addr.hostId, member.addr.unixPath
+    )
+
+
+class Cluster:
+    """
+    The instances sharing the registry, every one of them knows the whole
+    peer list but each peer is kept only by the instances the ring assigns
+    to it, the first of them tells the rest when it joins or leaves
+
+    The instance a peer is connected to, its home, registers it with its
+    owners and registers again all its peers when an instance comes or
+    goes, the peers of an instance that goes down are forgotten after a
+    grace period unless they register again in another one
+    """
+    index: int
+    addrs: list[tuple[str, int]]
+    ring: HashRing
+    replicas: int
+    links: dict[int, Conn]
+    opening: dict[int, Conn]
+    shard: dict[int, Peer]
+    down_since: dict[int, float]
+    outbox: dict[int, dict[str, list[Peer]]]
+    timers: TimerWheel
+    next_connect: float
+    next_heartbeat: float
+
+    def __init__(
+            self,
+            index: int,
+            addrs: list[tuple[str, int]],
+            replicas: int,
+            timers: TimerWheel
+    ):
+        self.index = index
+        self.addrs = addrs
+        self.ring = HashRing([f"{host}:{port}" for host, port in addrs])
+        self.replicas = replicas
+        # Where the grace periods of the instances that go down are kept
+        self.timers = timers
+        # The links with the other instances by their index, and the ones
+        # this instance is opening until the other one answers
+        self.links = {}
+        self.opening = {}
+        # The peers this instance is an owner of by their id
+        self.shard = {}
+        # When the instances that went down were lost
+        self.down_since = {}
+        # The changes to send to every instance at the end of the iteration
+        self.outbox = {}
+        self.next_connect = 0.0
+        self.next_heartbeat = time.monotonic() + CLUSTER_HEARTBEAT
+
+    def owners(self, peer: Peer) -> list[int]:
+        return self.ring.owners(
+            peer.key, [self.index, *self.links], self.replicas
+        )
+
+    def queue(self, node: int, field: str, peer: Peer):
+        self.outbox.setdefault(node, {}).setdefault(field, []).append(peer)
+
+    def register(self, peer: Peer, registry: Registry):
+        """
+        Registers a peer connected to this instance with its owners
+        """
+        registry.add(peer)
+        for node in self.owners(peer):
+            if node == self.index:
+                self.store(peer, registry)
+            else:
+                self.queue(node, 'register', peer)
+
+    def unregister(self, peer: Peer, registry: Registry):
+        """
+        Unregisters a peer connected to this instance from its owners
+        """
+        registry.remove(peer.key, peer.home)
+        for node in self.owners(peer):
+            if node == self.index:
+                self.drop(peer, registry)
+            else:
+                self.queue(node, 'unregister', peer)
+
+    def store(self, peer: Peer, registry: Registry):
+        """
+        Keeps a peer this instance is an owner of, the primary owner tells
+        the other instances about it
+        """
+        self.shard[peer.key] = peer
+        if self.owners(peer)[0] != self.index:
+            return
+        registry.add(peer)
+        for node in self.links:
+            if node != peer.home:
+                self.queue(node, 'joined', peer)
+
+    def drop(self, peer: Peer, registry: Registry):
+        """
+        Forgets a peer this instance is an owner of, the primary owner tells
+        the other instances about it
+        """
+        kept = self.shard.get(peer.key)
+        if kept is not None and kept.home == peer.home:
+            del self.shard[peer.key]
+        if self.owners(peer)[0] != self.index:
+            return
+        registry.remove(peer.key, peer.home)
+        for node in self.links:
+            if node != peer.home:
+                self.queue(node, 'left', peer)
+
+    def handle(self, conn: Conn, payload: bytes, registry: Registry):
+        """
+        Applies the changes sent by another instance
+        """
+        try:
+            msg = decode_msg(msgs_capnp.ClusterMsg, payload)
+        except Exception:
+            print(f"[x] Instance {conn.node} sent an invalid message")
+            return
+
+        for member in msg.register:
+            self.store(decode_member(member), registry)
+        for member in msg.unregister:
+            self.drop(decode_member(member), registry)
+        for member in msg.joined:
+            registry.add(decode_member(member))
+        for member in msg.left:
+            registry.remove(member.addr.ip << 16 | member.addr.port,
+                            member.home)
+
+    def link_up(
+            self,
+            conn: Conn,
+            node: int,
+            conns: dict[int, Conn],
+            registry: Registry
+    ):
+        """
+        Starts using a link with another instance, its peers move to it if
+        the ring says so
+        """
+        old = self.links.get(node)
+        if old is not None:
+            # It restarted before we noticed
+            close_conn(old, conns, registry, self)
+        print(f"[i] Instance {node} at {conn} is up")
+        conn.state = STATE_CLUSTER
+        conn.node = node
+        self.links[node] = conn
+        self.down_since.pop(node, None)
+        self.rebalance(conns, registry)
+
+        # It may not know about the peers we announce
+        for peer in self.shard.values():
+            if peer.home != node and self.owners(peer)[0] == self.index:
+                self.queue(node, 'joined', peer)
 
-    return peer_msg
+    def link_down(
+            self,
+            node: int,
+            conns: dict[int, Conn],
+            registry: Registry
+    ):
+        """
+        Stops using a link with another instance, its peers are forgotten
+        if they don't register again somewhere else in time
+        """
+        print(f"[-] Instance {node} is down")
+        del self.links[node]
+        now = time.monotonic()
+        self.down_since[node] = now
+        self.timers.schedule(node, now + FAILOVER_GRACE)
+        self.rebalance(conns, registry)
 
+    def rebalance(self, conns: dict[int, Conn], registry: Registry):
+        """
+        Registers every peer of this instance with its owners again after
+        the instances that are up changed, and forgets the peers it doesn't
+        own anymore
+        """
+        for peer in list(self.shard.values()):
+            if self.index not in self.owners(peer):
+                del self.shard[peer.key]
+        for conn in conns.values():
+            if conn.peer is not None:
+                self.register(conn.peer, registry)
 
-def send_peers(conn: socket, peers: dict[int, Peer]):
+    def expire_node(self, node: int, registry: Registry):
+        """
+        Forgets the peers of an instance that went down and didn't come back
+        before the grace period ended
+        """
+        since = self.down_since.get(node)
+        if since is None or since + FAILOVER_GRACE > time.monotonic():
+            return
+        del self.down_since[node]
+        for peer in list(registry.peers.values()):
+            if peer.home == node:
+                registry.remove(peer.key, node)
+                self.shard.pop(peer.key, None)
+
+    def connect(self, conns: dict[int, Conn]):
+        """
+        Starts connecting to the instances that are down without blocking,
+        every pair is linked by the one with the lower index
+        """
+        now = time.monotonic()
+        if now < self.next_connect:
+            return
+        self.next_connect = now + RECONNECT_INTERVAL
+
+        for node in range(self.index + 1, len(self.addrs)):
+            if node in self.links or node in self.opening:
+                continue
+            sock = socket(AF_INET, SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                err = sock.connect_ex(self.addrs[node])
+            except OSError as e:
+                err = e.errno
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                sock.close()
+                continue
+
+            conn = Conn(sock, self.addrs[node], STATE_CONNECTING)
+            conn.node = node
+            conns[sock.fileno()] = conn
+            self.opening[node] = conn
+            self.timers.schedule(conn, now + CONNECT_TIMEOUT)
+
+    def connected(
+            self,
+            conn: Conn,
+            conns: dict[int, Conn],
+            registry: Registry
+    ):
+        """
+        Sends the hello through a link once the other instance accepted the
+        connection, the link is used when its hello comes back
+        """
+        if conn.sock.getsockopt(SOL_SOCKET, SO_ERROR):
+            close_conn(conn, conns, registry, self)
+            return
+        conn.state = STATE_LINKING
+        conn.send(self.hello())
+        self.timers.schedule(conn, conn.accepted_at + HANDSHAKE_TIMEOUT)
+
+    def hello(self) -> bytes:
+        return frame(self.index.to_bytes(2, byteorder='big'), CLUSTER_HELLO)
+
+    def heartbeat(self):
+        """
+        Sends an empty frame through every link if it is time to
+        """
+        now = time.monotonic()
+        if now < self.next_heartbeat:
+            return
+        self.next_heartbeat = now + CLUSTER_HEARTBEAT
+        for conn in self.links.values():
+            conn.send(frame(b''))
+
+    def flush(self):
+        """
+        Sends the changes gathered to the other instances, a single message
+        for each one
+        """
+        for node, batch in self.outbox.items():
+            conn = self.links.get(node)
+            if conn is not None:
+                conn.send(encode_members(batch))
+        self.outbox = {}
+
+    def timeout(self) -> Optional[float]:
+        """
+        Returns the seconds until there is something to do
+        """
+        if len(self.addrs) == 1:
+            return None
+        deadline = self.next_heartbeat
+        if len(self.links) < len(self.addrs) - 1:
+            deadline = min(deadline, self.next_connect)
+        return max(0.0, deadline - time.monotonic())
+
+
+class JoinStats:
+    """
+    The latencies from accepting a connection to registering its peer
+    """
+    samples: deque
+    total: int
+
+    def __init__(self, size: int = 10000):
+        self.samples = deque(maxlen=size)
+        self.total = 0
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+        self.total += 1
+        if self.total % STATS_EVERY == 0:
+            print(f"[i] {self}")
+
+    def __repr__(self):
+        if not self.samples:
+            return "No joins yet"
+        ordered = sorted(self.samples)
+        last = len(ordered) - 1
+
+        def percentile(p: float) -> str:
+            return f"{ordered[round(last * p)] * 1000:.2f}ms"
+
+        return (
+            f"Joins: {self.total}, accept to registered latency"
+            f" p50 {percentile(0.5)}"
+            f" p90 {percentile(0.9)}"
+            f" p99 {percentile(0.99)}"
+            f" max {percentile(1)}"
+        )
+
+
+def send_peers(conn: Conn, registry: Registry):
     """
-    Given a new peer connection and a list of peers it sends it in the correct
-    format to the peer
+    Given a new peer connection it sends it the list of peers in the correct
+    format
     """
-    peers_list = list(peers.values())
-    addrs = msgs_capnp.ServerRpcMsg.new_message()
-    addrs_list = addrs.init('addrs', len(peers_list))
-    for i in range(len(peers_list)):
-        addrs_list[i] = encode_peer(peers_list[i])
+    conn.send(registry.encoded())
 
-    encoded_msg = addrs.to_bytes()
 
-    conn.send(len(encoded_msg).to_bytes(4, byteorder='big', signed=False))
-    conn.send(encoded_msg)
+def announce(registry: Registry, conns: dict[int, Conn]):
+    """
+    Sends the membership changes to every connection, the same message for
+    all of them, the peers that just joined drop themselves from it
+    """
+    joined, left = registry.take_deltas()
+    if not joined and not left:
+        return
+
+    encoded = encode_deltas(joined.values(), left.values())
+    # A peer that joined alone has nothing to learn from it
+    alone = len(joined) == 1 and not left
+    for conn in conns.values():
+        if conn.state == STATE_CLUSTER:
+            continue
+        if alone and conn.peer is not None and conn.peer.key in joined:
+            continue
+        conn.send(encoded)
 
 
 def handle_new_peer(
-        conn: socket,
-        host: str,
-        port: int,
-        peers: dict[int, Peer],
-        select_map: dict[int, socket]
+        sock: socket,
+        conns: dict[int, Conn],
+        registry: Registry,
+        timers: TimerWheel
 ):
-    print(f"[i] + {host}:{port} Connected")
-    send_peers(conn, peers)
-    port_msg = conn.recv(4096)
-    peer_listening_port = msgs_capnp.PeerListeningPort.from_bytes(port_msg)
-    peer = Peer(conn, host, peer_listening_port.port)
-    peers[conn.fileno()] = peer
-    select_map[conn.fileno()] = conn
+    """
+    Accepts every pending connection and sends it the peer list, the peer is
+    registered once its listening port arrives through the event loop
+    """
+    while True:
+        try:
+            conn_sock, addr = sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        conn = Conn(conn_sock, addr)
+        print(f"[i] + {conn} Connected")
+        conns[conn_sock.fileno()] = conn
+        send_peers(conn, registry)
+
+        # Schedule the eviction in case the handshake stalls, the same timer
+        # checks the heartbeats once it is registered
+        timers.schedule(conn, conn.accepted_at + HANDSHAKE_TIMEOUT)
 
 
 def handle_msg(
-        sock: socket,
-        peers: dict[int, Peer],
-        select_map: dict[int, socket]
+        conn: Conn,
+        conns: dict[int, Conn],
+        registry: Registry,
+        cluster: Cluster,
+        stats: JoinStats
 ):
-    # TODO: Detect closed connections and dispatch
-    data = sock.recv(2048)
+    """
+    Handles the messages of a connection, registering the peer when its port
+    arrives or unregistering it when it disconnects
+    """
+    try:
+        data = conn.sock.recv(RECV_SIZE)
+        frames = conn.decoder.feed_raw(data)
+    except (BlockingIOError, InterruptedError):
+        return
+    except (OSError, ValueError):
+        data = b''
+
     if len(data) == 0:
-        peer = peers[sock.fileno()]
+        close_conn(conn, conns, registry, cluster)
+        return
+
+    conn.last_seen = time.monotonic()
+    for flag, msg in frames:
+        if conn.state == STATE_AWAITING_PORT and flag == CLUSTER_HELLO:
+            # Another instance linked with us, it waits for our hello
+            node = int.from_bytes(msg, byteorder='big')
+            if not 0 <= node < len(cluster.addrs) or node == cluster.index:
+                print(f"[x] {conn} claims to be an unknown instance")
+                close_conn(conn, conns, registry, cluster)
+                return
+            conn.send(cluster.hello())
+            cluster.link_up(conn, node, conns, registry)
+        elif conn.state == STATE_LINKING:
+            # The instance we linked with answered, it sent the peer list
+            # every new connection gets before it read our hello
+            if flag == 0:
+                continue
+            if flag != CLUSTER_HELLO or \
+                    int.from_bytes(msg, byteorder='big') != conn.node:
+                print(f"[x] {conn} is not instance {conn.node}")
+                close_conn(conn, conns, registry, cluster)
+                return
+            del cluster.opening[conn.node]
+            cluster.link_up(conn, conn.node, conns, registry)
+        elif flag != 0:
+            print(f"[x] {conn} sent an invalid frame")
+            close_conn(conn, conns, registry, cluster)
+            return
+        elif conn.state == STATE_CLUSTER:
+            # Empty frames are just heartbeats
+            if msg:
+                cluster.handle(conn, msg, registry)
+        elif conn.state == STATE_AWAITING_PORT:
+            # The first message is the port the peer is listening on
+            try:
+                port_msg = decode_msg(msgs_capnp.PeerListeningPort, msg)
+            except Exception:
+                print(f"[x] {conn} sent an invalid handshake")
+                close_conn(conn, conns, registry, cluster)
+                return
+            conn.peer = Peer(
+                parse_host(conn.addr[0]), port_msg.port, cluster.index,
+                port_msg.hostId, port_msg.unixPath
+            )
+            cluster.register(conn.peer, registry)
+            conn.state = STATE_REGISTERED
+            stats.record(time.monotonic() - conn.accepted_at)
+
+
+def close_conn(
+        conn: Conn,
+        conns: dict[int, Conn],
+        registry: Registry,
+        cluster: Cluster
+):
+    """
+    Closes a connection unregistering its peer
+    """
+    fd = conn.sock.fileno()
+    peer = conn.peer
+    if peer is not None:
+        cluster.unregister(peer, registry)
         host = ipaddress.IPv4Address(peer.host).exploded
         print(f"[i] - {host}:{peer.port} Disconnected")
-        del select_map[sock.fileno()]
-        del peers[sock.fileno()]
+    del conns[fd]
+    sel.unregister(conn.sock)
+    conn.sock.close()
+    if conn.state == STATE_CLUSTER and cluster.links.get(conn.node) is conn:
+        cluster.link_down(conn.node, conns, registry)
+    elif cluster.opening.get(conn.node) is conn:
+        del cluster.opening[conn.node]
 
 
-def main():
-    if len(sys.argv) != 2:
-        print(f"Usage:\n\t{sys.argv[0]} <port>")
+def expire(
+        timers: TimerWheel,
+        conns: dict[int, Conn],
+        registry: Registry,
+        cluster: Cluster
+):
+    """
+    Evicts the connections whose handshake didn't finish in time and the
+    peers and instances that stopped sending heartbeats, the ones still
+    alive are checked again when their heartbeat would expire
+    """
+    now = time.monotonic()
+    for conn in timers.expired(now):
+        # The grace periods of the instances that went down are timers too
+        if isinstance(conn, int):
+            cluster.expire_node(conn, registry)
+            continue
+        # The connection may be gone already
+        if conns.get(conn.sock.fileno()) is not conn:
+            continue
+        if conn.state == STATE_CONNECTING:
+            # The other instance is still down, it is tried again later
+            close_conn(conn, conns, registry, cluster)
+        elif conn.state in (STATE_AWAITING_PORT, STATE_LINKING):
+            # The timer of the connection of a link may fire after it was
+            # accepted, the one of its handshake is still pending then
+            if conn.accepted_at + HANDSHAKE_TIMEOUT <= now:
+                print(f"[-] {conn} Handshake timed out")
+                close_conn(conn, conns, registry, cluster)
+        elif conn.last_seen + HEARTBEAT_TIMEOUT <= now:
+            print(f"[-] {conn} Stopped sending heartbeats")
+            close_conn(conn, conns, registry, cluster)
+        else:
+            # Heartbeats only update the time they arrived, the timer is
+            # moved when it fires, once per timeout and not per heartbeat
+            timers.schedule(conn, conn.last_seen + HEARTBEAT_TIMEOUT)
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Bootstrap server of the p2p chat")
+    parser.add_argument("port", type=int, help="port to listen on")
+    parser.add_argument(
+        "--cluster",
+        help="comma separated host:port of every instance sharing the "
+             "registry, this one included, in the same order in all of them"
+    )
+    parser.add_argument(
+        "--node",
+        type=int,
+        help="position of this instance in the cluster list, by default the "
+             "one with its port"
+    )
+    parser.add_argument(
+        "--replicas",
+        type=int,
+        default=DEFAULT_REPLICAS,
+        help="instances that keep every peer"
+    )
+    return parser.parse_args()
+
+
+def setup_cluster(args: Namespace, timers: TimerWheel) -> Cluster:
+    """
+    Creates the cluster from the arguments, a single instance is a cluster
+    of one
+    """
+    if args.cluster is None:
+        return Cluster(0, [("127.0.0.1", args.port)], 1, timers)
+
+    try:
+        addrs = []
+        for addr in args.cluster.split(","):
+            host, port = addr.rsplit(":", 1)
+            addrs.append((host, int(port)))
+    except ValueError:
+        print(f"The cluster {args.cluster} is not a list of host:port")
+        sys.exit(EXIT_ERR)
+
+    index = args.node
+    if index is None:
+        matches = [i for i, (_, port) in enumerate(addrs) if port == args.port]
+        if len(matches) != 1:
+            print("Can't tell which instance of the cluster this is, use "
+                  "--node")
+            sys.exit(EXIT_ERR)
+        index = matches[0]
+    if not 0 <= index < len(addrs):
+        print(f"The cluster has no instance {index}")
         sys.exit(EXIT_ERR)
 
-    # The map containing peers and socket identifier
-    peers: dict[int, Peer] = {}
+    return Cluster(index, addrs, max(1, args.replicas), timers)
+
+
+def main():
+    args = parse_args()
+
+    # The registry containing every peer by its id
+    registry = Registry()
+    # Every open connection by its socket identifier
+    conns: dict[int, Conn] = {}
+    # The handshake and heartbeat deadlines of the connections and the grace
+    # periods of the instances that went down, by their index
+    timers: TimerWheel[Union[Conn, int]] = TimerWheel(
+        WHEEL_TICK, WHEEL_SIZE, time.monotonic()
+    )
+    cluster = setup_cluster(args, timers)
+    stats = JoinStats()
 
     # Try to bind and listen to the given port
     sock = socket(AF_INET)
+    # An instance that restarts must get its port back while the connections
+    # of the previous run are closing
+    sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
     try:
-        print(f"[i] Binding to {sys.argv[1]}")
-        sock.bind(('0.0.0.0', int(sys.argv[1])))
-        print(f"[i] Listening on {sys.argv[1]}")
-        sock.listen(5)
+        print(f"[i] Binding to {args.port}")
+        sock.bind(('0.0.0.0', args.port))
+        print(f"[i] Listening on {args.port}")
+        sock.listen(1024)
         sock.setblocking(False)
-    except ValueError:
-        print(f"The value {sys.argv[1]} is not a valid port number")
+    except OverflowError:
+        print(f"The value {args.port} is not a valid port number")
         sys.exit(EXIT_ERR)
     except OSError as e:
         print(e)
         sys.exit(EXIT_ERR)
 
     print("[i] Waiting for connections")
-    select_map = {}
-    select_map[sock.fileno()] = sock
-
-    while(True):
-        selected, x, y = select(select_map, [], [])
-        for s in selected:
-            if s == sock.fileno():
-                conn, (host, port) = sock.accept()
-                handle_new_peer(conn, host, port, peers, select_map)
-            else:
-                f = select_map[s]
-                handle_msg(f, peers, select_map)
+    sel.register(sock, selectors.EVENT_READ, None)
+    # When the changes gathered are announced, right away after a quiet
+    # period
+    next_announce = 0.0
+
+    try:
+        while(True):
+            cluster.connect(conns)
+            cluster.heartbeat()
+
+            # Wake up in time for the next tick of the timers
+            now = time.monotonic()
+            timeout = timers.timeout(now)
+            cluster_timeout = cluster.timeout()
+            if cluster_timeout is not None:
+                timeout = min(timeout or cluster_timeout, cluster_timeout)
+            if registry.pending() or cluster.outbox:
+                until_announce = max(0.0, next_announce - now)
+                timeout = until_announce if timeout is None \
+                    else min(timeout, until_announce)
+
+            for key, mask in sel.select(timeout):
+                if key.data is None:
+                    handle_new_peer(sock, conns, registry, timers)
+                    continue
+
+                conn = key.data
+                # It may have been closed by a previous event
+                if conns.get(conn.sock.fileno()) is not conn:
+                    continue
+                if conn.state == STATE_CONNECTING:
+                    cluster.connected(conn, conns, registry)
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    conn.flush()
+                if mask & selectors.EVENT_READ:
+                    handle_msg(conn, conns, registry, cluster, stats)
+
+            # The expired peers leave the cached peer list right away, and
+            # the others are told about it below
+            expire(timers, conns, registry, cluster)
+
+            # Tell the other instances and everyone connected here about the
+            # peers that came and went since the last time
+            now = time.monotonic()
+            if now >= next_announce and \
+                    (registry.pending() or cluster.outbox):
+                cluster.flush()
+                announce(registry, conns)
+                next_announce = now + ANNOUNCE_INTERVAL
+    except KeyboardInterrupt:
+        print(f"[i] {stats}")
 
     sock.close()
-    print(peers)
 
 
 if __name__ == "__main__":
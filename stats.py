@@ -0,0 +1,76 @@
+"""
+This module contains cheap counters and histograms for the hot paths of the
+servers, they are rendered as text lines of the form `name value`
+"""
+
+from typing import Callable
+
+
+class Histogram:
+    """
+    A histogram of durations with power of two buckets in microseconds, an
+    observation costs a couple of integer operations
+    """
+    buckets: list[int]
+    count: int
+    total: float
+
+    def __init__(self, size: int = 32):
+        self.buckets = [0] * size
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        micros = int(seconds * 1000000)
+        index = min(micros.bit_length(), len(self.buckets) - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+
+    def render(self, name: str) -> list[str]:
+        """
+        Renders the cumulative buckets up to the last one with data
+        """
+        lines = []
+        last = max((i for i, c in enumerate(self.buckets) if c), default=-1)
+        cumulative = 0
+        for i in range(last + 1):
+            cumulative += self.buckets[i]
+            # Bucket i holds the values below 2^i microseconds
+            lines.append(f'{name}_bucket{{le_us="{1 << i}"}} {cumulative}')
+        lines.append(f"{name}_count {self.count}")
+        lines.append(f"{name}_sum_seconds {self.total:.6f}")
+        return lines
+
+
+class Stats:
+    """
+    The counters, gauges and histograms of a server
+    """
+    counters: dict[str, int]
+    gauges: dict[str, Callable[[], int]]
+    histograms: dict[str, Histogram]
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def counter(self, name: str):
+        self.counters.setdefault(name, 0)
+
+    def gauge(self, name: str, read: Callable[[], int]):
+        """
+        Registers a value that is only computed when rendering
+        """
+        self.gauges[name] = read
+
+    def histogram(self, name: str) -> Histogram:
+        return self.histograms.setdefault(name, Histogram())
+
+    def render(self) -> bytes:
+        lines = [f"{name} {value}" for name, value in self.counters.items()]
+        lines += [f"{name} {read()}" for name, read in self.gauges.items()]
+        for name, histogram in self.histograms.items():
+            lines += histogram.render(name)
+        return ("\n".join(lines) + "\n").encode()
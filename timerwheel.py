@@ -0,0 +1,75 @@
+"""
+This module contains a hashed timer wheel, timers are hashed by their
+deadline into a ring of slots and every tick only looks at the slot that
+expires, so the cost doesn't depend on how many timers there are
+"""
+
+import math
+from typing import Generic, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class TimerWheel(Generic[T]):
+    """
+    A ring of slots, each one holds the timers whose deadline falls in its
+    tick, deadlines further than a whole turn of the ring wait in their slot
+    for the following turns
+
+    Deadlines are rounded up to the next tick, so timers fire up to a tick
+    late but never early
+    """
+    tick: float
+    slots: list[list[tuple[int, T]]]
+    current: int
+    count: int
+
+    def __init__(self, tick: float, size: int, now: float):
+        self.tick = tick
+        self.slots = [[] for _ in range(size)]
+        # The last tick whose slot was processed
+        self.current = int(now / tick)
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def schedule(self, item: T, deadline: float):
+        """
+        Adds a timer that fires once the deadline passes
+        """
+        deadline_tick = max(math.ceil(deadline / self.tick), self.current + 1)
+        self.slots[deadline_tick % len(self.slots)].append(
+            (deadline_tick, item)
+        )
+        self.count += 1
+
+    def expired(self, now: float) -> list[T]:
+        """
+        Removes and returns the timers whose deadline passed, it only visits
+        the slots of the ticks elapsed since the previous call
+        """
+        now_tick = int(now / self.tick)
+        size = len(self.slots)
+        # After a whole turn every slot has been visited already
+        steps = min(now_tick - self.current, size)
+
+        due = []
+        for t in range(now_tick - steps + 1, now_tick + 1):
+            slot = self.slots[t % size]
+            if not slot:
+                continue
+            due.extend(item for deadline, item in slot if deadline <= now_tick)
+            self.slots[t % size] = [e for e in slot if e[0] > now_tick]
+
+        self.current = max(self.current, now_tick)
+        self.count -= len(due)
+        return due
+
+    def timeout(self, now: float) -> Optional[float]:
+        """
+        Returns the seconds until the next tick, None if there are no timers
+        """
+        if not self.count:
+            return None
+        return max(0.0, (int(now / self.tick) + 1) * self.tick - now)
@@ -0,0 +1,106 @@
+"""
+This module runs the blocking work of the peers and the relay, like disk
+access, on a pool of threads so the event loop never waits for it
+
+The results are handed back to the loop through a queue and a wake up
+socket that the loop watches, so the callbacks always run on the loop thread
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, SimpleQueue
+from socket import socketpair
+from threading import Lock
+from typing import Any, Callable, Optional
+
+# Threads of the pool
+WORKERS = 4
+
+# A callback receives the result of the task and the exception it raised
+Done = Callable[[Any, Optional[BaseException]], None]
+
+_pool = ThreadPoolExecutor(max_workers=WORKERS)
+_results: SimpleQueue = SimpleQueue()
+
+# The loop watches the reading end, the threads write to the other one
+wakeup, _wakeup_w = socketpair()
+wakeup.setblocking(False)
+_wakeup_w.setblocking(False)
+
+
+def _finish(task: Callable[[], Any], done: Optional[Done]):
+    """
+    Runs a task and queues its result for the loop
+    """
+    result, error = None, None
+    try:
+        result = task()
+    except BaseException as e:
+        error = e
+
+    if done is None:
+        return
+    _results.put((done, result, error))
+    try:
+        _wakeup_w.send(b'\0')
+    except BlockingIOError:
+        # The loop has pending wake ups already
+        pass
+
+
+def run(task: Callable[[], Any], done: Optional[Done] = None):
+    """
+    Runs a task on the pool, done is called on the loop with its result
+    """
+    _pool.submit(_finish, task, done)
+
+
+def process():
+    """
+    Calls the callbacks of the finished tasks, it must be called by the loop
+    when the wake up socket is readable
+    """
+    try:
+        while wakeup.recv(4096):
+            pass
+    except BlockingIOError:
+        pass
+
+    while True:
+        try:
+            done, result, error = _results.get_nowait()
+        except Empty:
+            return
+        done(result, error)
+
+
+class Serial:
+    """
+    Runs tasks on the pool one after the other in the order they were given,
+    different Serial objects run in parallel
+    """
+    tasks: deque
+    running: bool
+    lock: Lock
+
+    def __init__(self):
+        self.tasks = deque()
+        self.running = False
+        self.lock = Lock()
+
+    def run(self, task: Callable[[], Any], done: Optional[Done] = None):
+        with self.lock:
+            self.tasks.append((task, done))
+            if self.running:
+                return
+            self.running = True
+        _pool.submit(self._drain)
+
+    def _drain(self):
+        while True:
+            with self.lock:
+                if not self.tasks:
+                    self.running = False
+                    return
+                task, done = self.tasks.popleft()
+            _finish(task, done)